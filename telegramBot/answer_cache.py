@@ -0,0 +1,144 @@
+import os
+import re
+import json
+import hashlib
+import unicodedata
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from ttl_cache import TTLCache
+from structured_logging import get_logger
+
+log = get_logger(__name__)
+
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+# Optional shared second tier so hits survive cold starts: '', 'firestore' or 'redis'
+ANSWER_CACHE_TIER = os.getenv("ANSWER_CACHE_TIER", "").lower()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a question so trivially different phrasings share a cache key"""
+    text = unicodedata.normalize("NFKC", query or "").casefold()
+    text = _PUNCTUATION.sub(" ", text)
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def _key_hash(key: str) -> str:
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class FirestoreAnswerTier:
+    """Shared tier in a Firestore collection - expired docs are ignored (pair with a TTL policy on expires_at)"""
+
+    def __init__(self, collection_ref, ttl: float = ANSWER_CACHE_TTL):
+        self.collection_ref = collection_ref
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        doc = self.collection_ref.document(_key_hash(key)).get()
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        expires_at = data.get("expires_at")
+        if expires_at and expires_at <= datetime.now(timezone.utc):
+            return None
+        return {"answer": data["answer"], "sources": data.get("sources", [])}
+
+    def set(self, key: str, entry: Dict[str, Any]) -> None:
+        self.collection_ref.document(_key_hash(key)).set({
+            "query": key,
+            "answer": entry["answer"],
+            "sources": entry["sources"],
+            "expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.ttl),
+        })
+
+
+class RedisAnswerTier:
+    """Shared tier in Redis (or any Redis-protocol store such as Memorystore)"""
+
+    def __init__(self, url: str = REDIS_URL, ttl: float = ANSWER_CACHE_TTL, prefix: str = "arems:answer:"):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        raw = self.client.get(self.prefix + _key_hash(key))
+        return json.loads(raw) if raw else None
+
+    def set(self, key: str, entry: Dict[str, Any]) -> None:
+        self.client.setex(self.prefix + _key_hash(key), int(self.ttl), json.dumps(entry))
+
+
+class AnswerCache:
+    """Normalized-query cache of formatted knowledge answers and their sources"""
+
+    def __init__(self, maxsize: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL, tier=None):
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.tier = tier
+        self.tier_hits = 0
+        self.tier_misses = 0
+        self.tier_errors = 0
+
+    def get(self, question: str) -> Optional[Dict[str, Any]]:
+        key = normalize_query(question)
+        if not key:
+            return None
+        entry = self.local.get(key)
+        if entry is not None or self.tier is None:
+            return entry
+
+        try:
+            entry = self.tier.get(key)
+        except Exception as e:
+            self.tier_errors += 1
+            log.warning("⚠️ Answer cache tier lookup failed", error=str(e))
+            return None
+        if entry is None:
+            self.tier_misses += 1
+            return None
+        self.tier_hits += 1
+        self.local.set(key, entry)
+        return entry
+
+    def set(self, question: str, answer: str, sources: List[str]) -> None:
+        key = normalize_query(question)
+        if not key:
+            return
+        entry = {"answer": answer, "sources": sources}
+        self.local.set(key, entry)
+        if self.tier is not None:
+            try:
+                self.tier.set(key, entry)
+            except Exception as e:
+                self.tier_errors += 1
+                log.warning("⚠️ Answer cache tier write failed", error=str(e))
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.local.stats()
+        stats.update({
+            "tier": self.tier.__class__.__name__ if self.tier is not None else None,
+            "tier_hits": self.tier_hits,
+            "tier_misses": self.tier_misses,
+            "tier_errors": self.tier_errors,
+        })
+        return stats
+
+
+def build_answer_cache(db=None, tier: str = ANSWER_CACHE_TIER) -> AnswerCache:
+    """Create the answer cache with the configured second tier"""
+    shared = None
+    if tier == "firestore" and db is not None:
+        shared = FirestoreAnswerTier(
+            db.collection('arems-profiles').document('knowledge-cache').collection('answers'))
+    elif tier == "redis":
+        shared = RedisAnswerTier(REDIS_URL)
+    elif tier:
+        raise ValueError(f"Unknown ANSWER_CACHE_TIER: {tier}")
+    return AnswerCache(tier=shared)
@@ -0,0 +1,244 @@
+"""Async execution mode for the webhook
+
+Telegram updates are handled on one event loop with the async Firestore
+client and httpx, so one instance serves many updates concurrently without a
+request thread each. The chain is main's own: the same update deduplicator
+(its marker created on the async client), and the same per-message steps
+from main.build_message_steps, given their coroutine versions - the batched
+store through the shared profile cache is awaited on the AsyncClient, and
+replies go to the prioritised outbound dispatcher, or straight out through
+httpx when it is off. run_steps_async overlaps them on the loop. Steps with
+no async client (knowledge search, GCS media upload, Pub/Sub media
+queueing) and Dialogflow CX requests run in worker threads.
+
+Serve it as an ASGI app (e.g. on Cloud Run, needs httpx and uvicorn):
+
+    uvicorn async_app:app --host 0.0.0.0 --port 8080
+
+or keep the functions_framework entry and set WEBHOOK_ASYNC_MODE=1 - the
+telegramWebhook function then hands Telegram updates to this chain.
+"""
+import os
+import json
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, Optional
+
+import metrics
+from dispatch import loads, classify_request, ROUTE_DIALOGFLOW
+from fanout import FanOutResult, run_steps_async
+from update_dedup import UpdateDeduplicator, markers_collection
+from structured_logging import get_logger, begin_request
+
+log = get_logger(__name__)
+
+# Upper bound on one update when the sync entry waits for the event loop
+ASYNC_REQUEST_TIMEOUT = float(os.getenv("ASYNC_REQUEST_TIMEOUT", "60"))
+# Threads for the blocking steps - sized for the updates one instance keeps in flight
+ASYNC_WORKER_THREADS = int(os.getenv("ASYNC_WORKER_THREADS", "64"))
+
+
+class AsyncTelegramWebhook:
+    """handle_telegram_webhook / handle_telegram_message on asyncio
+
+    build_steps(message, chat_id, text, username) returns the message's
+    independent steps - coroutine functions awaited on the loop, sync ones
+    run in worker threads - and finish(fan_out) turns their outcome into the
+    webhook response: main.build_message_steps / main.finish_message_steps
+    in production, fakes in the benchmark. The inline step is the one the
+    update can't be acknowledged without, so it is never queue-cancelled.
+    With markers_ref (the marker collection on the async client) the dedup
+    claim is awaited too; otherwise it runs in a worker thread.
+    """
+
+    def __init__(self, deduplicator: UpdateDeduplicator,
+                 build_steps: Callable[[Dict[str, Any], Any, str, str], Dict[str, Callable[[], Any]]],
+                 finish: Callable[[FanOutResult], Any], markers_ref=None,
+                 worker_threads: int = ASYNC_WORKER_THREADS, inline: Optional[str] = "store_message"):
+        self.deduplicator = deduplicator
+        self.build_steps = build_steps
+        self.finish = finish
+        self.markers_ref = markers_ref
+        self.inline = inline
+        self.executor = ThreadPoolExecutor(max_workers=worker_threads, thread_name_prefix="async-steps")
+
+    async def to_thread(self, func, *args):
+        """asyncio.to_thread on this chain's pool rather than the loop's small default one"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, contextvars.copy_context().run, func, *args)
+
+    async def claim(self, update_id) -> bool:
+        if self.markers_ref is not None:
+            return await self.deduplicator.claim_async(update_id, self.markers_ref)
+        return await self.to_thread(self.deduplicator.claim, update_id)
+
+    async def release(self, update_id) -> None:
+        if self.markers_ref is not None:
+            await self.deduplicator.release_async(update_id, self.markers_ref)
+        else:
+            await self.to_thread(self.deduplicator.release, update_id)
+
+    async def handle_update(self, req_json):
+        try:
+            if not req_json:
+                log.error("❌ No JSON data in Telegram request")
+                return {"status": "error", "message": "No data"}, 400
+
+            update_id = req_json.get("update_id")
+            if not await self.claim(update_id):
+                log.info("🔁 Duplicate Telegram update skipped", update_id=update_id)
+                return {"status": "success", "message": "Duplicate update ignored"}
+
+            if "message" in req_json:
+                result = await self.handle_message(req_json["message"])
+                if isinstance(result, tuple):
+                    await self.release(update_id)
+                elif update_id is not None and self.deduplicator.markers_ref is not None:
+                    # The dedup marker create() is this update's first Firestore RPC
+                    result["firestore_rpcs"] = result.get("firestore_rpcs", 0) + 1
+                return result
+            log.info("📱 Non-message Telegram update received", update_keys=list(req_json))
+            return {"status": "success", "message": "Update processed"}
+
+        except Exception as e:
+            log.exception("❌ ERROR in Telegram webhook", error=str(e))
+            if req_json:
+                await self.release(req_json.get("update_id"))
+            return {"status": "error", "message": str(e)}, 500
+
+    async def handle_message(self, message):
+        try:
+            chat_id = message["chat"]["id"]
+            text = message.get("text", "")
+            username = message["from"].get("username", "unknown")
+
+            log.info("📱 Telegram message", username=username, chat_id=chat_id, text=text, mode="async")
+
+            with metrics.timed("telegram.async_update_seconds"):
+                fan_out = await run_steps_async(self.build_steps(message, chat_id, text, username),
+                                                executor=self.executor, inline=self.inline)
+            return self.finish(fan_out)
+
+        except Exception as e:
+            log.exception("❌ ERROR processing Telegram message", error=str(e))
+            return {"status": "error", "message": str(e)}, 500
+
+
+# ============================================================================
+# WIRING - clients are created on the loop that uses them
+# ============================================================================
+
+_webhook: Optional[AsyncTelegramWebhook] = None
+_telegram = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def _main():
+    # Imported lazily: main imports this module for WEBHOOK_ASYNC_MODE
+    import main
+    return main
+
+
+def get_webhook() -> AsyncTelegramWebhook:
+    """The process-wide async chain, built on main's singletons - must be first called on the loop that serves it"""
+    global _webhook, _telegram
+    if _webhook is None:
+        from google.cloud import firestore
+        from telegram_client import AsyncTelegramClient
+
+        main = _main()
+        db = firestore.AsyncClient(project='arems-project', database='arems-platform-core-db')
+        _telegram = AsyncTelegramClient(main.TELEGRAM_TOKEN)
+        build_steps = partial(main.build_message_steps,
+                              store=partial(main.store_message_async, client=db),
+                              send=partial(main.send_message_async, client=_telegram),
+                              text_reply=partial(main.send_text_reply_async, client=_telegram))
+        markers_ref = markers_collection(db) if main.update_deduplicator.markers_ref is not None else None
+        _webhook = AsyncTelegramWebhook(main.update_deduplicator, build_steps, main.finish_message_steps,
+                                        markers_ref=markers_ref)
+    return _webhook
+
+
+async def handle_telegram_update(req_json):
+    begin_request("telegram")
+    return await get_webhook().handle_update(req_json)
+
+
+def run_sync(coro, timeout: float = ASYNC_REQUEST_TIMEOUT):
+    """Run a coroutine on the process-wide background loop and wait for its result"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="async-webhook", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result(timeout)
+
+
+# ============================================================================
+# ASGI ENTRY POINT
+# ============================================================================
+
+async def _read_body(receive) -> bytes:
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def _respond(send, status: int, payload: Dict[str, Any]) -> None:
+    body = json.dumps(payload, default=str).encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def app(scope, receive, send):
+    """ASGI app with telegramWebhook's routing - Telegram updates on the loop, Dialogflow in a thread"""
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                get_webhook()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if _telegram is not None:
+                    await _telegram.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    headers = {name.decode("latin-1").title(): value.decode("latin-1") for name, value in scope["headers"]}
+    try:
+        raw = await _read_body(receive)
+        try:
+            req_json = loads(raw) if raw else None
+        except ValueError:
+            req_json = None
+        if not isinstance(req_json, dict):
+            req_json = None
+
+        route, reason = classify_request(headers, req_json)
+        begin_request(route)
+        log.info("📥 NEW REQUEST RECEIVED", method=scope["method"], route_reason=reason, mode="async")
+
+        if route == ROUTE_DIALOGFLOW:
+            result = await asyncio.to_thread(_main().handle_dialogflow_cx_webhook, req_json)
+        else:
+            result = await get_webhook().handle_update(req_json)
+        payload, status = result if isinstance(result, tuple) else (result, 200)
+        await _respond(send, status, payload)
+
+    except Exception as e:
+        log.exception("❌ CRITICAL ERROR in async webhook handler", error=str(e))
+        if "Google-Dialogflow" in headers.get("User-Agent", ""):
+            await _respond(send, 200, {"fulfillmentResponse": {
+                "messages": [{"text": {"text": ["System error occurred. Please try again."]}}]}})
+        else:
+            await _respond(send, 500, {"status": "error", "message": "Internal server error"})
@@ -0,0 +1,1703 @@
+"""Local benchmarks for the AREMS webhook building blocks
+
+Run from the telegramBot directory, e.g.:
+
+    python benchmarks.py media-rss --sizes 1,10,20
+
+Benchmarks only use local stand-ins - no Google Cloud or Telegram access is needed.
+"""
+import argparse
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+
+# ============================================================================
+# MEDIA STREAMING - peak RSS per file size
+# ============================================================================
+
+class _FakeStreamingResponse:
+    """Stand-in for a streamed requests.Response that generates bytes on demand"""
+
+    def __init__(self, size):
+        self.size = size
+
+    def iter_content(self, chunk_size=1):
+        remaining = self.size
+        block = os.urandom(min(chunk_size, self.size) or 1)
+        while remaining > 0:
+            n = min(chunk_size, remaining)
+            yield block[:n]
+            remaining -= n
+
+    @property
+    def content(self):
+        return b"".join(self.iter_content(64 * 1024))
+
+
+class _FakeBlobWriter:
+    """Mimics BlobWriter: buffers up to chunk_size, then 'uploads' (drops) the chunk"""
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            del self.buffer[:self.chunk_size]
+
+    def close(self):
+        self.buffer = bytearray()
+
+
+class _FakeBlob:
+    name = "benchmark/object"
+    crc32c = None
+    md5_hash = None
+    content_type = None
+
+    def open(self, mode, chunk_size=None, **kwargs):
+        return _FakeBlobWriter(chunk_size)
+
+    def upload_from_string(self, data):
+        bytes(data)
+
+    def reload(self):
+        pass
+
+
+def _peak_rss_mb():
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _media_rss_child(size_mb, mode):
+    size = int(size_mb * 1024 * 1024)
+    import media_storage
+    baseline = _peak_rss_mb()
+    response = _FakeStreamingResponse(size)
+    if mode == "streaming":
+        media_storage.stream_to_blob(response, _FakeBlob(), "file.bin")
+    else:
+        _FakeBlob().upload_from_string(response.content)
+    print(f"{_peak_rss_mb() - baseline:.1f}")
+
+
+def bench_media_rss(args):
+    sizes = [float(s) for s in args.sizes.split(",")]
+    print(f"{'size':>8} {'buffered (MB)':>15} {'streaming (MB)':>15}")
+    for size in sizes:
+        row = []
+        for mode in ("buffered", "streaming"):
+            out = subprocess.run(
+                [sys.executable, __file__, "_media-rss-child", str(size), mode],
+                capture_output=True, text=True, check=True,
+            )
+            row.append(out.stdout.strip().splitlines()[-1])
+        print(f"{size:>6.0f}MB {row[0]:>15} {row[1]:>15}")
+
+
+# ============================================================================
+# SEMANTIC QUERY INDEX - lookup latency vs index size
+# ============================================================================
+
+_QUESTION_WORDS = (
+    "flood fire earthquake storm cyclone landslide drought cholera outbreak evacuation shelter route "
+    "kit water food medicine radio battery school hospital clinic market bridge road river dam village "
+    "lagos kano ibadan abuja enugu benue niger plateau delta coastal upland children elderly disabled "
+    "pregnant livestock farm crops power outage gas leak chemical spill collapse building warning siren"
+).split()
+
+
+def _synthetic_question(rng):
+    return " ".join(rng.sample(_QUESTION_WORDS, rng.randint(3, 7)))
+
+
+def bench_semantic_lookup(args):
+    from semantic_cache import SemanticQueryIndex
+
+    rng = random.Random(7)
+    for size in [int(s) for s in args.sizes.split(",")]:
+        index = SemanticQueryIndex(max_questions=size)
+        start = time.perf_counter()
+        while len(index) < size:
+            index.add(_synthetic_question(rng), "answer")
+        build_s = time.perf_counter() - start
+
+        queries = [_synthetic_question(rng) for _ in range(args.queries)]
+        latencies = []
+        hits = 0
+        for query in queries:
+            t0 = time.perf_counter()
+            hits += index.lookup(query) is not None
+            latencies.append(time.perf_counter() - t0)
+        latencies.sort()
+        p50 = latencies[len(latencies) // 2] * 1e6
+        p99 = latencies[int(len(latencies) * 0.99)] * 1e6
+        print(f"{size:>8} questions: build {build_s:.1f}s, lookup p50 {p50:.0f}us p99 {p99:.0f}us, "
+              f"hit rate {hits / len(queries):.2f}")
+
+
+# ============================================================================
+# LOGGING - per-request overhead of the old print+logger style vs structured logs
+# ============================================================================
+
+_SAMPLE_UPDATE = {
+    "update_id": 912345678,
+    "message": {
+        "message_id": 4321,
+        "from": {"id": 55501, "is_bot": False, "first_name": "Ada", "username": "ada_lagos"},
+        "chat": {"id": 55501, "type": "private", "first_name": "Ada", "username": "ada_lagos"},
+        "date": 1760000000,
+        "text": "Flood water is rising on our street near the market, we need help " * 4,
+    },
+}
+
+
+def _legacy_request_logs(logger, req_json):
+    """The baseline pattern: every line printed and logged, full payloads formatted eagerly"""
+    message = req_json["message"]
+    lines = [
+        "📥 NEW REQUEST RECEIVED!",
+        "=== INCOMING REQUEST DEBUG ===",
+        "Request Method: POST",
+        "User-Agent: No User-Agent",
+        "Content-Type: application/json",
+        f"Parsed JSON payload: {req_json}",
+        f"Found Dialogflow CX indicators: {[]}",
+        "📱 TELEGRAM REQUEST DETECTED - Routing to Telegram handler",
+        "📱 === PROCESSING TELEGRAM WEBHOOK ===",
+        f"📱 Telegram request data: {req_json}",
+        f"📱 Telegram message from {message['from']['username']} ({message['chat']['id']}): {message['text']}",
+        f"💬 Message stored for {message['from']['username']}: {message['text'][:50]}...",
+        f"✅ Message sent to {message['chat']['id']}: {message['text'][:50]}...",
+        "✅ Telegram message processed successfully",
+    ]
+    for line in lines:
+        print(line)
+        logger.info(line)
+
+
+def _structured_request_logs(log, begin_request, req_json):
+    message = req_json["message"]
+    begin_request("telegram")
+    log.info("📥 NEW REQUEST RECEIVED", method="POST", user_agent="No User-Agent",
+             content_type="application/json", cx_indicators=[])
+    log.debug("Parsed JSON payload", payload=req_json)
+    log.info("📱 TELEGRAM REQUEST DETECTED - Routing to Telegram handler")
+    log.info("📱 Telegram message", username=message["from"]["username"],
+             chat_id=message["chat"]["id"], text=message["text"])
+    log.info("💬 Message stored", username=message["from"]["username"], text=message["text"][:50])
+    log.info("✅ Message sent", chat_id=message["chat"]["id"], text=message["text"][:50])
+    log.info("✅ Telegram message processed successfully", firestore_rpcs=2)
+
+
+def bench_logging(args):
+    import contextlib
+    import logging
+    import structured_logging
+
+    devnull = open(os.devnull, "w")
+    legacy_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    root = logging.getLogger()
+
+    with contextlib.redirect_stdout(devnull):
+        legacy = logging.getLogger("bench.legacy")
+        run_legacy = lambda: _legacy_request_logs(legacy, _SAMPLE_UPDATE)
+        log = structured_logging.get_logger("bench.structured")
+        run_structured = lambda: _structured_request_logs(log, structured_logging.begin_request, _SAMPLE_UPDATE)
+
+        results = []
+        for label, fn, rates in [
+            ("print + logger (baseline)", run_legacy, {}),
+            ("structured, all requests", run_structured, {}),
+            ("structured, telegram sampled 10%", run_structured, {"telegram": 0.1}),
+        ]:
+            structured_logging.SAMPLE_RATES.clear()
+            structured_logging.SAMPLE_RATES.update(rates)
+            structured_logging.setup_logging("INFO", stream=devnull)
+            if fn is run_legacy:
+                root.handlers[0].setFormatter(legacy_format)
+            start = time.perf_counter()
+            for _ in range(args.requests):
+                fn()
+            results.append((label, (time.perf_counter() - start) / args.requests * 1e6))
+        structured_logging.SAMPLE_RATES.clear()
+
+    for label, per_request in results:
+        print(f"{label:<34} {per_request:8.1f} us/request")
+
+
+# ============================================================================
+# ID GENERATOR - uniqueness and throughput across threads and processes
+# ============================================================================
+
+def _generate_ids_in_threads(threads, per_thread):
+    from concurrent.futures import ThreadPoolExecutor
+    from id_generator import generate_id
+
+    def worker(_):
+        return [generate_id("INC") for _ in range(per_thread)]
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return [i for chunk in executor.map(worker, range(threads)) for i in chunk]
+
+
+def bench_ids(args):
+    import multiprocessing
+
+    # Import first so forked children exercise the at-fork reset
+    import id_generator  # noqa: F401
+
+    per_thread = args.count // (args.processes * args.threads)
+    start = time.perf_counter()
+    with multiprocessing.get_context("fork").Pool(args.processes) as pool:
+        chunks = pool.starmap(_generate_ids_in_threads, [(args.threads, per_thread)] * args.processes)
+    elapsed = time.perf_counter() - start
+
+    total = 0
+    unique = set()
+    ordered = True
+    for chunk in chunks:
+        total += len(chunk)
+        unique.update(chunk)
+    for chunk in chunks:
+        # Each thread's slice must be strictly increasing
+        for t in range(args.threads):
+            part = chunk[t * per_thread:(t + 1) * per_thread]
+            ordered &= all(a < b for a, b in zip(part, part[1:]))
+    print(f"{total} IDs from {args.processes} processes x {args.threads} threads in {elapsed:.1f}s "
+          f"({total / elapsed:,.0f}/s): {total - len(unique)} collisions, "
+          f"per-thread order {'monotonic' if ordered else 'NOT monotonic'}")
+    if total != len(unique) or not ordered:
+        sys.exit(1)
+
+
+# ============================================================================
+# MESSAGE LOG - burst load against the append-only, sharded message layout
+# ============================================================================
+
+class _RecordingRef:
+    """Collection/document reference stand-in that only tracks its path"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def collection(self, name):
+        return _RecordingRef(f"{self.path}/{name}" if self.path else name)
+
+    def document(self, name):
+        return _RecordingRef(f"{self.path}/{name}")
+
+
+class _RecordingBatch:
+    def __init__(self, writes, second):
+        self.writes = writes
+        self.second = second
+
+    def set(self, ref, data, merge=False):
+        self.writes.append((ref.path, self.second))
+
+    create = set
+
+
+def bench_message_load(args):
+    from collections import Counter
+    from datetime import datetime, timedelta
+    from message_log import add_message_writes
+    from profile_cache import ProfileCache, CachedProfile
+
+    db = _RecordingRef("")
+    writes = []
+    legacy_keys = set()
+    clock = [0.0]
+    profiles = ProfileCache(None, clock=lambda: clock[0])
+    profile_writes = Counter()
+    profile_total = Counter()
+    start_time = datetime(2025, 1, 1, 9, 0)
+    per_chat = args.rate * args.minutes
+    interval = 60.0 / args.rate
+
+    start = time.perf_counter()
+    for chat in range(args.chats):
+        chat_key = f"{chat}_user{chat}"
+        for i in range(per_chat):
+            offset = i * interval
+            sent = start_time + timedelta(seconds=offset)
+            add_message_writes(db, _RecordingBatch(writes, int(offset)), chat_key, f"message {i}", f"user{chat}")
+            clock[0] = offset
+            updates = profiles.coalesce(chat, CachedProfile({"username": f"user{chat}"}),
+                                        {"username": f"user{chat}", "total_messages": 1, "last_message": f"message {i}"})
+            if updates is not None:
+                profile_writes[chat] += 1
+                profile_total[chat] += updates["total_messages"]
+            # The old layout keyed messages by '%I:%M %p'
+            legacy_keys.add((chat_key, sent.strftime('%I:%M %p')))
+    elapsed = time.perf_counter() - start
+
+    total = args.chats * per_chat
+    message_docs = {path for path, _ in writes if "/daily_messages/" in path}
+    shard_writes = Counter(path for path, _ in writes if "/summary_shards/" in path)
+    shard_seconds = Counter(write for write in writes if "/summary_shards/" in write[0])
+
+    print(f"{args.chats} chats x {args.rate} msgs/min x {args.minutes} min = {total} messages "
+          f"({elapsed / total * 1e6:.1f} us to queue each message)")
+    print(f"legacy '%I:%M %p' layout: {len(legacy_keys)} docs kept, {total - len(legacy_keys)} overwritten")
+    print(f"append-only layout:      {len(message_docs)} docs kept, {total - len(message_docs)} overwritten")
+    print(f"summary writes per doc:  {max(shard_writes.values()) / (args.minutes * 60):.2f}/s average on the "
+          f"hottest shard, {max(shard_seconds.values())} in its busiest second "
+          f"(unsharded: {args.rate / 60:.2f}/s)")
+    # Whatever is still deferred rides on the chat's next write, or the flush once its interval passes
+    counted = sum(profile_total.values()) + sum(p[1] for p in profiles._pending.values())
+    print(f"profile doc writes:      {max(profile_writes.values()) / (args.minutes * 60):.2f}/s on the busiest "
+          f"profile (undebounced: {args.rate / 60:.2f}/s), {counted}/{total} messages counted")
+    if len(message_docs) != total or counted != total:
+        sys.exit(1)
+
+
+# ============================================================================
+# DISPATCH - per-request parse and classify overhead
+# ============================================================================
+
+_DISPATCH_PAYLOADS = {
+    "telegram": ({}, {
+        "update_id": 912345678,
+        "message": {"message_id": 42, "date": 1735689600, "text": "There is flooding near the river bridge",
+                    "chat": {"id": 123456789, "type": "private", "username": "reporter"},
+                    "from": {"id": 123456789, "is_bot": False, "first_name": "Ada", "username": "reporter"}},
+    }),
+    "telegram+secret": ({"X-Telegram-Bot-Api-Secret-Token": "s3cret"}, None),
+    "dialogflow": ({"User-Agent": "Google-Dialogflow"}, {
+        "detectIntentResponseId": "b8c1-2f",
+        "fulfillmentInfo": {"tag": "risk-assessment"},
+        "pageInfo": {"currentPage": "projects/p/locations/global/agents/a/flows/f/pages/p1", "displayName": "Risk"},
+        "sessionInfo": {"session": "projects/p/sessions/s", "parameters": {
+            "location": "Lagos", "disaster_type": "flood", "population_density": "high"}},
+        "text": "how risky is flooding in lagos",
+    }),
+}
+
+
+def _legacy_dispatch(request):
+    req_json = request.get_json(silent=True)
+    user_agent = request.headers.get('User-Agent', '')
+    cx_indicators = ['fulfillmentInfo', 'sessionInfo', 'pageInfo', 'intentInfo']
+    found_indicators = [field for field in cx_indicators if field in req_json] if req_json else []
+    is_dialogflow_cx = bool(found_indicators) or 'Google-Dialogflow' in user_agent
+    # ...and each handler parsed the body again
+    return is_dialogflow_cx, request.get_json(silent=True)
+
+
+def _rewind(environ):
+    stream = environ["wsgi.input"]
+    stream.seek(0)
+    return stream
+
+
+def bench_dispatch(args):
+    import json
+    from flask import Request
+    from werkzeug.test import EnvironBuilder
+    import dispatch
+
+    def single_parse(request):
+        body = dispatch.parse_json_body(request)
+        return dispatch.classify_request(request.headers, body), body
+
+    variants = [("Request object only", lambda request: None), ("legacy get_json x2", _legacy_dispatch)]
+    if dispatch.orjson is not None:
+        variants.append(("single parse (orjson)", single_parse))
+    variants.append(("single parse (json)", single_parse))
+
+    print(f"{'request':<16} {'variant':<24} {'us/request':>10}")
+    for name, (headers, payload) in _DISPATCH_PAYLOADS.items():
+        payload = payload or _DISPATCH_PAYLOADS["telegram"][1]
+        environ = EnvironBuilder(method="POST", headers=headers, data=json.dumps(payload),
+                                 content_type="application/json").get_environ()
+        for label, fn in variants:
+            saved = dispatch.orjson
+            if label.endswith("(json)"):
+                dispatch.orjson = None
+            try:
+                start = time.perf_counter()
+                for _ in range(args.requests):
+                    # A fresh Request per call so no parse is served from a previous iteration
+                    fn(Request(dict(environ, **{"wsgi.input": _rewind(environ)})))
+                elapsed = time.perf_counter() - start
+            finally:
+                dispatch.orjson = saved
+            print(f"{name:<16} {label:<24} {elapsed / args.requests * 1e6:10.2f}")
+
+
+
+# ============================================================================
+# RISK SCORING - scalar loop vs NumPy batch scorer
+# ============================================================================
+
+def bench_risk_batch(args):
+    import numpy as np
+    from risk_model import load_model
+    from risk_scoring import calculate_risk_score, get_risk_level
+
+    rng = np.random.default_rng(7)
+    # Include values outside the tables so the unknown-category path is covered
+    start = time.perf_counter()
+    model = load_model(args.model)
+    build = time.perf_counter() - start
+
+    hazard_pool = np.array([*model.base_scores, "earthquake", ""], dtype=object)
+    population_pool = np.array([*model.population_multipliers, "students", ""], dtype=object)
+    hazards = hazard_pool[rng.integers(0, len(hazard_pool), args.rows)]
+    populations = population_pool[rng.integers(0, len(population_pool), args.rows)]
+
+    start = time.perf_counter()
+    hazard_codes = model.encode_hazards(hazards)
+    population_codes = model.encode_populations(populations)
+    encode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scores = model.score_codes(hazard_codes, population_codes)
+    levels = model.levels(scores)
+    batch = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scalar_scores = [calculate_risk_score(h, p, model) for h, p in zip(hazards, populations)]
+    scalar_levels = [get_risk_level(s, model) for s in scalar_scores]
+    scalar = time.perf_counter() - start
+
+    identical = scores.tolist() == scalar_scores and levels.tolist() == scalar_levels
+    print(f"{args.rows:,} rows")
+    print(f"scalar functions:        {scalar:8.3f}s")
+    print(f"compile model:           {build * 1e3:8.3f}ms ({model.version})")
+    print(f"batch encode columns:    {encode:8.3f}s")
+    print(f"batch score + levels:    {batch:8.3f}s ({scalar / (encode + batch):.0f}x faster incl. encoding)")
+    print(f"results identical to scalar: {identical}")
+    if not identical:
+        sys.exit(1)
+
+
+# ============================================================================
+# GEOSPATIAL SCORING - gazetteer + raster lookup latency per request
+# ============================================================================
+
+def _write_synthetic_geo_data(data_dir, places, grid, rng):
+    import csv
+    import numpy as np
+    from geo_risk import RiskRaster, GAZETTEER_FILE, RASTER_FILE
+
+    bbox = (4.0, 2.5, 14.0, 15.0)
+    cell_deg = (bbox[2] - bbox[0]) / grid
+    with open(os.path.join(data_dir, GAZETTEER_FILE), "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["name", "lat", "lon", "aliases"])
+        for i in range(places):
+            writer.writerow([f"Town {i}", rng.uniform(bbox[0], bbox[2]), rng.uniform(bbox[1], bbox[3]),
+                             f"T{i}|Town {i} Market"])
+    layers = {
+        "all": rng.integers(0, 256, (grid, grid), dtype=np.uint8),
+        "natural_disaster": rng.integers(0, 256, (grid, grid), dtype=np.uint8),
+        "population_density": rng.integers(0, 256, (grid, grid), dtype=np.uint8),
+    }
+    RiskRaster(bbox[0], bbox[1], cell_deg, layers).save(os.path.join(data_dir, RASTER_FILE))
+
+
+def bench_geo_score(args):
+    import tempfile
+    import numpy as np
+    from geo_risk import load_geo_scorer
+
+    rng = np.random.default_rng(11)
+    with tempfile.TemporaryDirectory() as data_dir:
+        _write_synthetic_geo_data(data_dir, args.places, args.grid, rng)
+        start = time.perf_counter()
+        scorer = load_geo_scorer(data_dir)
+        load = time.perf_counter() - start
+
+    # Mix of exact names, names inside free text, coordinates and unknown areas
+    ids = rng.integers(0, args.places, args.requests)
+    areas = []
+    for n, i in enumerate(ids):
+        kind = n % 4
+        if kind == 0:
+            areas.append(f"Town {i}")
+        elif kind == 1:
+            areas.append(f"flooding near town {i} market, north district")
+        elif kind == 2:
+            areas.append(f"{rng.uniform(4, 14):.4f}, {rng.uniform(2.5, 15):.4f}")
+        else:
+            areas.append(f"somewhere unknown {i}")
+
+    latencies = np.empty(len(areas))
+    placed = 0
+    for n, area in enumerate(areas):
+        start = time.perf_counter()
+        result = scorer.assess(area, "natural_disaster")
+        latencies[n] = time.perf_counter() - start
+        placed += result is not None
+
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1e6
+    print(f"{args.places:,} places, {args.grid}x{args.grid} raster: loaded in {load:.2f}s")
+    print(f"{args.requests:,} requests ({placed:,} placed): p50 {p50:.1f} us, p99 {p99:.1f} us, "
+          f"mean {latencies.mean() * 1e6:.1f} us")
+
+
+# ============================================================================
+# INCIDENT DEDUP - bursty report stream through the cluster index
+# ============================================================================
+
+def bench_incident_dedup(args):
+    import tracemalloc
+    from collections import Counter
+    import numpy as np
+    from incident_dedup import IncidentClusterIndex
+
+    rng = np.random.default_rng(5)
+    total = args.rate * args.minutes
+    duration = args.minutes * 60.0
+    types = ["flood", "fire", "building collapse", "road accident", "landslide"]
+
+    # Each real incident gets a burst of reports jittered ~300 m around it over
+    # 10 minutes; some reports carry only free-text locations (not geocoded)
+    events = max(1, total // args.burst)
+    event_at = rng.uniform(0, duration, events)
+    event_lat = rng.uniform(4.0, 14.0, events)
+    event_lon = rng.uniform(2.5, 15.0, events)
+    event_type = rng.integers(0, len(types), events)
+    report_event = rng.integers(0, events, total)
+    report_at = np.minimum(event_at[report_event] + rng.exponential(120.0, total), duration)
+    jitter = rng.normal(0, 0.3 / 111.32, (total, 2))
+    geocoded = rng.random(total) >= args.text_only
+    order = np.argsort(report_at)
+
+    reports = []
+    for r in order.tolist():
+        e = int(report_event[r])
+        lat, lon = (event_lat[e] + jitter[r, 0], event_lon[e] + jitter[r, 1]) if geocoded[r] else (None, None)
+        reports.append((r, types[event_type[e]], f"Event {e} area", lat, lon, float(report_at[r])))
+
+    def replay(latencies=None):
+        index = IncidentClusterIndex(window_seconds=args.window, radius_km=args.radius_km,
+                                     max_clusters=args.max_clusters, clock=lambda: 0.0)
+        assigned, peak_clusters = {}, 0
+        for n, (r, incident_type, location, lat, lon, at) in enumerate(reports):
+            start = time.perf_counter()
+            cluster, _ = index.add(f"INC-{r}", incident_type, location, lat, lon, at=at)
+            if latencies is not None:
+                latencies[n] = time.perf_counter() - start
+            assigned[r] = cluster.cluster_id
+            peak_clusters = max(peak_clusters, len(index))
+        return index, assigned, peak_clusters
+
+    latencies = np.empty(total)
+    index, assigned, peak_clusters = replay(latencies)
+    # Second pass under tracemalloc for the index's memory only (it slows add() down)
+    tracemalloc.start()
+    replay()
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Purity: reports whose cluster's majority event is their own event
+    by_cluster = {}
+    for r, cluster_id in assigned.items():
+        by_cluster.setdefault(cluster_id, Counter())[int(report_event[r])] += 1
+    pure = sum(c.most_common(1)[0][1] for c in by_cluster.values())
+    seen_events = len(set(report_event.tolist()))
+
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1e6
+    stats = index.stats()
+    print(f"{total:,} reports over {args.minutes} min ({args.rate:,}/min) from {seen_events:,} incidents")
+    print(f"clusters created {stats['created']:,} ({stats['created'] / seen_events:.2f} per incident), "
+          f"reports merged {stats['matched']:,}, purity {pure / total:.2%}")
+    print(f"add(): p50 {p50:.1f} us, p99 {p99:.1f} us, {total / latencies.sum():,.0f} reports/s single-threaded")
+    print(f"memory: peak {peak_clusters:,} clusters held (cap {args.max_clusters:,}), "
+          f"{stats['clusters']:,} at end, traced peak {peak_bytes / 2**20:.1f} MB")
+
+
+# ============================================================================
+# KEYWORD MATCHING - compiled matcher vs per-keyword scans
+# ============================================================================
+
+def bench_keywords(args):
+    import numpy as np
+    from keyword_matcher import KeywordMatcher, tokenize, GENERAL
+
+    rng = random.Random(3)
+    syllables = [c + v for c in ["b", "k", "r", "j", "mb", "ṣ", "ɗ", "n", "w", "h", "l", "g", "y", "t", "d", "f"]
+                 for v in ["a", "á", "e", "ẹ", "i", "o", "ọ̀", "u"]]
+
+    def word():
+        return "".join(rng.choice(syllables) for _ in range(rng.randint(3, 4)))
+
+    categories = ["emergency", "risk"]
+    keywords = {c: [" ".join(word() for _ in range(rng.randint(1, 3))) for _ in range(args.keywords // 2)]
+                for c in categories}
+    flat = [(c, kw) for c in categories for kw in keywords[c]]
+    texts = []
+    for n in range(args.messages):
+        words = [word() for _ in range(rng.randint(5, 40))]
+        if n % 3 == 0:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(flat)[1].upper())
+        texts.append(" ".join(words))
+
+    start = time.perf_counter()
+    matcher = KeywordMatcher(keywords)
+    build = time.perf_counter() - start
+
+    # Reference: the previous approach (one scan per keyword), made word-boundary safe
+    padded = [(c, f" {' '.join(tokenize(kw))} ") for c, kw in flat]
+
+    def scan(text):
+        haystack = f" {' '.join(tokenize(text))} "
+        for c, kw in padded:
+            if kw in haystack:
+                return c
+        return GENERAL
+
+    def legacy(text):
+        text_lower = text.lower()
+        return any(kw in text_lower for _, kw in flat)
+
+    results = {}
+    for name, fn in (("substring any()", legacy), ("per-keyword scan", scan), ("Aho-Corasick", matcher.category)):
+        latencies = np.empty(len(texts))
+        out = []
+        for n, text in enumerate(texts):
+            start = time.perf_counter()
+            out.append(fn(text))
+            latencies[n] = time.perf_counter() - start
+        results[name] = out
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1e6
+        print(f"{name:>17}: p50 {p50:8.1f} us, p99 {p99:8.1f} us")
+
+    # Category priority differs from first-hit order, so compare match / no-match
+    agree = sum((a == GENERAL) == (b == GENERAL)
+                for a, b in zip(results["per-keyword scan"], results["Aho-Corasick"]))
+    matched = sum(c != GENERAL for c in results["Aho-Corasick"])
+    print(f"{matcher.size:,} keywords compiled in {build * 1e3:.0f} ms; {matched:,} messages matched, "
+          f"{agree:,}/{len(texts):,} messages agree with the per-keyword scan")
+    if agree != len(texts):
+        sys.exit(1)
+
+
+# ============================================================================
+# INTENT CLASSIFIER - per-message latency of the local model
+# ============================================================================
+
+def bench_intent(args):
+    import numpy as np
+    from intent_classifier import IntentClassifier, read_examples, evaluate
+
+    texts, labels = read_examples(args.data)
+    classifier = IntentClassifier.load(args.model)
+    report = evaluate(classifier, texts, labels)
+
+    # Eval messages plus longer synthetic ones (several sentences joined)
+    rng = random.Random(9)
+    messages = [rng.choice(texts) if n % 2 else " ".join(rng.sample(texts, 4)) for n in range(args.messages)]
+    for text in messages[:100]:
+        classifier.predict(text)
+    latencies = np.empty(len(messages))
+    for n, text in enumerate(messages):
+        start = time.perf_counter()
+        classifier.predict(text)
+        latencies[n] = time.perf_counter() - start
+
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1e6
+    print(f"model {args.model}: {classifier.dim:,} hashed features x {len(classifier.labels)} labels")
+    print(f"eval accuracy {report['accuracy']:.1%} on {report['examples']} examples, errors {report['errors']}")
+    print(f"predict(): p50 {p50:.1f} us, p99 {p99:.1f} us, max {latencies.max() * 1e6:.1f} us "
+          f"over {len(messages):,} messages")
+
+
+# ============================================================================
+# UPDATE REPLAY - redelivered Telegram updates are processed once
+# ============================================================================
+
+class _FakeMarkerDoc:
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+
+    def create(self, data):
+        from google.api_core import exceptions as api_exceptions
+
+        time.sleep(self.store.rpc_seconds)
+        with self.store.lock:
+            if self.key in self.store.docs:
+                raise api_exceptions.AlreadyExists(f"Document already exists: {self.key}")
+            self.store.docs[self.key] = data
+
+    def delete(self):
+        with self.store.lock:
+            self.store.docs.pop(self.key, None)
+
+
+class _FakeMarkers:
+    """Stand-in for the markers collection - create() fails if the document exists"""
+
+    def __init__(self, rpc_seconds):
+        import threading
+
+        self.docs = {}
+        self.lock = threading.Lock()
+        self.rpc_seconds = rpc_seconds
+
+    def document(self, key):
+        return _FakeMarkerDoc(self, key)
+
+
+def bench_update_replay(args):
+    import threading
+    from collections import Counter
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy as np
+    from update_dedup import UpdateDeduplicator
+
+    markers = _FakeMarkers(args.rpc_ms / 1000.0)
+    # Two instances behind the same webhook, sharing only Firestore
+    instances = [UpdateDeduplicator(markers, maxsize=args.updates) for _ in range(2)]
+    processed = Counter()
+    failed = Counter()
+    lock = threading.Lock()
+    rng = random.Random(21)
+    fail_first = {u for u in range(args.updates) if rng.random() < args.fail_rate}
+
+    def deliver(update_id, instance):
+        dedup = instances[instance]
+        start = time.perf_counter()
+        if not dedup.claim(update_id):
+            return time.perf_counter() - start, False
+        with lock:
+            # The first attempt at some updates fails (500) - their claim is released for the retry
+            if update_id in fail_first and not failed[update_id]:
+                failed[update_id] += 1
+                dedup.release(update_id)
+                return time.perf_counter() - start, True
+            processed[update_id] += 1
+        return time.perf_counter() - start, True
+
+    deliveries = [(u, rng.randrange(2)) for u in range(args.updates) for _ in range(args.replays)]
+    rng.shuffle(deliveries)
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        results = list(pool.map(lambda d: deliver(*d), deliveries))
+
+    skipped = np.array([seconds for seconds, claimed in results if not claimed])
+    once = sum(processed[u] == 1 for u in range(args.updates))
+    never = [u for u in range(args.updates) if processed[u] == 0]
+    twice = [u for u in range(args.updates) if processed[u] > 1]
+    memory_hits = sum(d.seen.hits for d in instances)
+    print(f"{args.updates:,} updates x {args.replays} deliveries over 2 instances, {args.threads} threads, "
+          f"{len(fail_first):,} first attempts failed")
+    print(f"processed exactly once: {once:,}/{args.updates:,} (never: {len(never)}, more than once: {len(twice)})")
+    if len(skipped):
+        p50, p99 = np.percentile(skipped, [50, 99]) * 1e6
+        print(f"repeats skipped: {len(skipped):,} ({memory_hits:,} from memory, no RPC), "
+              f"p50 {p50:.1f} us, p99 {p99:.1f} us")
+    # Retries of a failed first attempt only exist when replays > 1
+    if twice or (args.replays > 1 and never):
+        sys.exit(1)
+
+
+# ============================================================================
+# ASYNC WEBHOOK - sync vs asyncio handler chain against simulated I/O latency
+# ============================================================================
+
+class _FakeSnapshot:
+    def __init__(self, data):
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class _FakeFirestore:
+    """Minimal Firestore stand-in: path-keyed docs, batches, create(); every RPC sleeps its latency
+
+    asynchronous=True makes it an AsyncClient stand-in - RPCs return coroutines that asyncio.sleep.
+    """
+
+    def __init__(self, latencies, asynchronous=False):
+        import threading
+
+        self.docs = {}
+        self.lock = threading.Lock()
+        self.latencies = latencies
+        self.asynchronous = asynchronous
+
+    def collection(self, name):
+        return _FakeRef(self, name)
+
+    def batch(self):
+        return _FakeBatch(self)
+
+    def rpc(self, kind, apply):
+        if self.asynchronous:
+            return self._rpc_async(kind, apply)
+        time.sleep(self.latencies[kind])
+        with self.lock:
+            return apply()
+
+    async def _rpc_async(self, kind, apply):
+        import asyncio
+
+        await asyncio.sleep(self.latencies[kind])
+        with self.lock:
+            return apply()
+
+
+class _FakeRef:
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+
+    def collection(self, name):
+        return _FakeRef(self.db, f"{self.path}/{name}")
+
+    def document(self, name):
+        return _FakeRef(self.db, f"{self.path}/{name}")
+
+    def get(self):
+        return self.db.rpc("read", lambda: _FakeSnapshot(self.db.docs.get(self.path)))
+
+    def create(self, data):
+        def apply():
+            from google.api_core import exceptions as api_exceptions
+
+            if self.path in self.db.docs:
+                raise api_exceptions.AlreadyExists(self.path)
+            self.db.docs[self.path] = dict(data)
+        return self.db.rpc("write", apply)
+
+    def delete(self):
+        return self.db.rpc("write", lambda: self.db.docs.pop(self.path, None))
+
+
+class _FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, ref, data, merge=False):
+        self.writes.append((ref.path, data))
+
+    def create(self, ref, data):
+        self.writes.append((ref.path, data))
+
+    def update(self, ref, data):
+        self.writes.append((ref.path, data))
+
+    def commit(self):
+        def apply():
+            for path, data in self.writes:
+                self.db.docs.setdefault(path, {}).update(data)
+        return self.db.rpc("commit", apply)
+
+
+class _FakeTelegram:
+    class _Response:
+        status_code = 200
+
+    def __init__(self, latency, asynchronous=False):
+        import threading
+
+        self.latency = latency
+        self.asynchronous = asynchronous
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text):
+        with self.lock:
+            self.sent += 1
+        if self.asynchronous:
+            return self._send_async()
+        time.sleep(self.latency)
+        return self._Response()
+
+    async def _send_async(self):
+        import asyncio
+
+        await asyncio.sleep(self.latency)
+        return self._Response()
+
+
+def _text_update(update_id, chats):
+    chat_id = 1000 + update_id % chats
+    return {"update_id": update_id,
+            "message": {"chat": {"id": chat_id}, "from": {"username": f"user{chat_id}"}, "text": "Hello there"}}
+
+
+def _message_steps(db, telegram, profiles):
+    """main.build_message_steps for a text message, against the fakes
+
+    With asynchronous fakes the steps are coroutine functions, as the async
+    chain's store_message_async / send_text_reply_async are.
+    """
+    from message_log import add_message_writes
+    from profile_cache import build_profile_write
+
+    def prepare(chat_id, text, username, user_doc):
+        batch = db.batch()
+        written = add_message_writes(db, batch, f"{chat_id}_{username}", text, username)
+        data, is_new = build_profile_write(chat_id, user_doc, {
+            "username": username, "total_messages": 1, "last_message": text,
+            "last_message_time": written["date_str"]})
+        (batch.set if is_new else batch.update)(profiles.ref(chat_id), data)
+        return batch, data, is_new
+
+    def build_steps(message, chat_id, text, username):
+        def store_message():
+            user_doc = profiles.get(chat_id)
+            batch, data, is_new = prepare(chat_id, text, username, user_doc)
+            batch.commit()
+            profiles.write_through(chat_id, user_doc, data, created=is_new)
+
+        async def store_message_async():
+            user_doc = await profiles.get_async(chat_id, profiles.profiles_ref)
+            batch, data, is_new = prepare(chat_id, text, username, user_doc)
+            await batch.commit()
+            profiles.write_through(chat_id, user_doc, data, created=is_new)
+
+        async def reply_async():
+            await telegram.send_message(chat_id, f"Message received: {text}")
+
+        if db.asynchronous:
+            return {"store_message": store_message_async, "reply": reply_async}
+        return {"store_message": store_message,
+                "reply": lambda: telegram.send_message(chat_id, f"Message received: {text}")}
+
+    return build_steps
+
+
+def _finish_steps(fan_out):
+    if fan_out.errors:
+        return {"status": "error", "step_errors": fan_out.errors}, 500
+    return {"status": "success"}
+
+
+def bench_async_webhook(args):
+    import asyncio
+    import logging
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy as np
+    from async_app import AsyncTelegramWebhook
+    from fanout import run_steps
+    from profile_cache import ProfileCache
+    from update_dedup import UpdateDeduplicator
+
+    logging.disable(logging.CRITICAL)
+    latencies = {"read": args.read_ms / 1000.0, "write": args.write_ms / 1000.0, "commit": args.commit_ms / 1000.0}
+    send_seconds = args.send_ms / 1000.0
+    updates = [_text_update(n, args.chats) for n in range(args.updates)]
+
+    # Sync mode: main.handle_telegram_webhook - a request thread per update in flight claims the
+    # update and stores it, the reply goes to a fan-out pool of the same size
+    db = _FakeFirestore(latencies)
+    telegram = _FakeTelegram(send_seconds)
+    dedup = UpdateDeduplicator(db.collection("markers"))
+    build_steps = _message_steps(db, telegram, ProfileCache(db.collection("profiles")))
+    fanout_pool = ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="fanout")
+
+    def sync_update(update):
+        start = time.perf_counter()
+        if dedup.claim(update["update_id"]):
+            message = update["message"]
+            result = _finish_steps(run_steps(build_steps(message, message["chat"]["id"], message["text"],
+                                                         message["from"]["username"]),
+                                             executor=fanout_pool, inline="store_message"))
+            assert not isinstance(result, tuple), result
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        sync_latencies = np.array(list(pool.map(sync_update, updates)))
+    sync_elapsed = time.perf_counter() - start
+    fanout_pool.shutdown()
+
+    # Async mode: the real AsyncTelegramWebhook chain on one event loop - marker, profile read,
+    # batch commit and sendMessage all awaited on async stand-ins, the same number of updates in flight
+    adb = _FakeFirestore(latencies, asynchronous=True)
+    atelegram = _FakeTelegram(send_seconds, asynchronous=True)
+    webhook = AsyncTelegramWebhook(UpdateDeduplicator(None),
+                                   _message_steps(adb, atelegram, ProfileCache(adb.collection("profiles"))),
+                                   _finish_steps, markers_ref=adb.collection("markers"))
+
+    async def run_async():
+        limit = asyncio.Semaphore(args.concurrency)
+
+        async def one(update):
+            async with limit:
+                start = time.perf_counter()
+                result = await webhook.handle_update(update)
+                assert not isinstance(result, tuple), result
+                return time.perf_counter() - start
+
+        return await asyncio.gather(*(one(u) for u in updates))
+
+    start = time.perf_counter()
+    async_latencies = np.array(asyncio.run(run_async()))
+    async_elapsed = time.perf_counter() - start
+    logging.disable(logging.NOTSET)
+
+    print(f"{args.updates:,} text updates from {args.chats} chats; simulated read {args.read_ms} ms, "
+          f"marker {args.write_ms} ms, commit {args.commit_ms} ms, sendMessage {args.send_ms} ms")
+    print(f"{args.concurrency} updates in flight per instance in both modes")
+    for name, values, elapsed, workers in (
+            ("sync", sync_latencies, sync_elapsed, f"{args.concurrency} request + {args.concurrency} fan-out threads"),
+            ("async", async_latencies, async_elapsed, "1 event loop")):
+        p50, p99 = np.percentile(values, [50, 99]) * 1000
+        print(f"{name:>5} ({workers}): p50 {p50:.1f} ms, p99 {p99:.1f} ms, {args.updates / elapsed:,.0f} updates/s")
+    stored = [sum(1 for path in store.docs if "/daily_messages/" in path) for store in (db, adb)]
+    print(f"messages stored: sync {stored[0]:,}, async {stored[1]:,}; "
+          f"sent: sync {telegram.sent:,}, async {atelegram.sent:,}")
+    if stored != [args.updates] * 2 or telegram.sent != args.updates or atelegram.sent != args.updates:
+        sys.exit(1)
+
+
+# ============================================================================
+# FAN-OUT - independent per-update steps, one after another vs concurrently
+# ============================================================================
+
+def bench_fanout(args):
+    import logging
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy as np
+    from fanout import run_steps
+
+    logging.disable(logging.CRITICAL)
+    rng = random.Random(7)
+    store_seconds = (args.read_ms + args.commit_ms) / 1000.0
+    media_seconds = (args.get_file_ms + args.download_ms) / 1000.0
+    send_seconds = args.send_ms / 1000.0
+    # Photo updates do store + getFile/download, text updates do store + reply; a few media steps hang
+    updates = [("photo" if rng.random() < args.media_share else "reply",
+                rng.random() < args.stall_rate) for _ in range(args.updates)]
+
+    def jitter(seconds):
+        time.sleep(seconds * rng.uniform(0.8, 1.2))
+
+    def steps_for(kind, stalls):
+        def media():
+            jitter(media_seconds * (20 if stalls else 1))
+        return {"store_message": lambda: jitter(store_seconds),
+                kind: media if kind == "photo" else (lambda: jitter(send_seconds))}
+
+    def sequential(update):
+        start = time.perf_counter()
+        for step in steps_for(*update).values():
+            step()
+        return time.perf_counter() - start, 0
+
+    pool = ThreadPoolExecutor(max_workers=args.pool_size, thread_name_prefix="fanout")
+    deadlines = {"photo": args.deadline_ms / 1000.0}
+    queue_timeout = args.queue_timeout_ms / 1000.0
+
+    def fanned_out(update):
+        start = time.perf_counter()
+        result = run_steps(steps_for(*update), deadlines=deadlines, executor=pool, queue_timeout=queue_timeout,
+                           inline="store_message")
+        return time.perf_counter() - start, len(result.errors)
+
+    print(f"{args.updates:,} updates ({args.media_share:.0%} photos, {args.stall_rate:.0%} stalled downloads), "
+          f"{args.threads} request threads, fan-out pool {args.pool_size}")
+    failures = 0
+    for name, handler in (("sequential", sequential), ("fan-out", fanned_out)):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as requests:
+            measured = list(requests.map(handler, updates))
+        elapsed = time.perf_counter() - start
+        values = np.array([seconds for seconds, _ in measured])
+        step_errors = sum(errors for _, errors in measured)
+        by_kind = {kind: np.array([seconds for (seconds, _), (k, stalls) in zip(measured, updates)
+                                   if k == kind and not stalls]) for kind in ("reply", "photo")}
+        p50, p99 = np.percentile(values, [50, 99]) * 1000
+        per_kind = ", ".join(f"{kind} p50 {np.percentile(v, 50) * 1000:.1f} ms"
+                             for kind, v in by_kind.items() if len(v))
+        print(f"{name:>10}: p50 {p50:.1f} ms, p99 {p99:.1f} ms, max {values.max() * 1000:.1f} ms "
+              f"({per_kind}), {args.updates / elapsed:,.0f} updates/s, step errors {step_errors}")
+        if name == "fan-out":
+            stalled = sum(stalls for kind, stalls in updates if kind == "photo")
+            if step_errors != stalled:
+                print(f"FAIL: expected {stalled} deadline errors, got {step_errors}")
+                failures += 1
+            # Deadlines count from a step's start, so the bound is queue wait plus deadline
+            if values.max() * 1000 > (args.queue_timeout_ms + args.deadline_ms) * 1.5:
+                print(f"FAIL: an update outlived the {args.queue_timeout_ms:g} ms queue timeout "
+                      f"plus the {args.deadline_ms:g} ms step deadline")
+                failures += 1
+    pool.shutdown(wait=True)
+    logging.disable(logging.NOTSET)
+    if failures:
+        sys.exit(1)
+
+
+# ============================================================================
+# OUTBOUND - sendMessage under Telegram's flood limits, direct vs dispatcher
+# ============================================================================
+
+class _SimulatedTelegramAPI:
+    """sendMessage stand-in that enforces Telegram's limits over sliding one-second windows
+
+    Over the global or a chat's limit it answers 429 with a retry_after,
+    like the Bot API does.
+    """
+
+    class _Response:
+        def __init__(self, status_code, retry_after=None):
+            self.status_code = status_code
+            self.headers = {}
+            self._body = {"ok": status_code == 200}
+            if retry_after is not None:
+                self._body["parameters"] = {"retry_after": retry_after}
+
+        def json(self):
+            return self._body
+
+    def __init__(self, latency, global_limit, chat_limit):
+        import threading
+        from collections import defaultdict, deque
+
+        self.latency = latency
+        self.global_limit = global_limit
+        self.chat_limit = chat_limit
+        self._lock = threading.Lock()
+        self._global = deque()
+        self._chats = defaultdict(deque)
+        self.requests = 0
+        self.rejected = 0
+        self.delivered = defaultdict(list)
+
+    def send_message(self, chat_id, text, **extra):
+        time.sleep(self.latency)
+        with self._lock:
+            now = time.monotonic()
+            self.requests += 1
+            chat = self._chats[chat_id]
+            for window in (self._global, chat):
+                while window and window[0] <= now - 1.0:
+                    window.popleft()
+            if len(self._global) >= self.global_limit or len(chat) >= self.chat_limit:
+                self.rejected += 1
+                blocked = self._global if len(self._global) >= self.global_limit else chat
+                return self._Response(429, retry_after=round(blocked[0] + 1.0 - now, 3))
+            self._global.append(now)
+            chat.append(now)
+            self.delivered[chat_id].append(text)
+        return self._Response(200)
+
+
+def bench_outbound(args):
+    import logging
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy as np
+    from outbound import OutboundDispatcher, EMERGENCY, NORMAL, BROADCAST
+    from telegram_client import retry_after_seconds
+
+    logging.disable(logging.CRITICAL)
+    rng = random.Random(11)
+    speedup = args.speedup
+    # Interactive traffic: bursts of replies to one chat, a share of them emergency replies
+    work = [(chat_id, BROADCAST, f"alert {chat_id}") for chat_id in range(args.recipients)]
+    for n in range(args.replies):
+        chat_id = 100_000 + rng.randrange(args.reply_chats)
+        priority = EMERGENCY if rng.random() < args.emergency_share else NORMAL
+        work.insert(rng.randrange(len(work) + 1), (chat_id, priority, f"reply {n}"))
+    total_messages = len(work)
+
+    def direct(api):
+        """What send_message does today: one blocking POST per message, retried on 429 like TelegramClient"""
+        latencies = {EMERGENCY: [], NORMAL: [], BROADCAST: []}
+        failed = 0
+
+        def send(item):
+            nonlocal failed
+            chat_id, priority, text = item
+            start = time.perf_counter()
+            for attempt in range(args.max_attempts):
+                response = api.send_message(chat_id, text)
+                if response.status_code == 200:
+                    latencies[priority].append(time.perf_counter() - start)
+                    return
+                time.sleep(retry_after_seconds(response) or 0.5 * 2 ** attempt)
+            failed += 1
+
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            list(pool.map(send, work))
+        return latencies, failed
+
+    def dispatched(api, work=work, instances=1):
+        # Each instance takes its share of the bot-wide budget, as OUTBOUND_INSTANCES arranges
+        dispatcher = OutboundDispatcher(api.send_message, global_rate=args.global_rate * speedup / instances,
+                                        global_burst=5 / instances, chat_rate=1.0 * speedup, chat_burst=1,
+                                        group_rate=1.0 * speedup, workers=args.threads,
+                                        max_attempts=args.max_attempts, max_pending=args.max_pending)
+        start = time.perf_counter()
+        messages = []
+        broadcast = []
+        for chat_id, priority, text in work:
+            if priority == BROADCAST:
+                broadcast.append(chat_id)
+                continue
+            if broadcast:
+                messages += dispatcher.broadcast(broadcast, "alert").messages
+                broadcast = []
+            messages.append(dispatcher.enqueue(chat_id, text, priority))
+        if broadcast:
+            messages += dispatcher.broadcast(broadcast, "alert").messages
+        for message in messages:
+            message.wait()
+        latencies = {EMERGENCY: [], NORMAL: [], BROADCAST: []}
+        for message in messages:
+            if message.ok:
+                latencies[message.priority].append(message.finished_at - message.queued_at)
+        dispatcher.close()
+        return latencies, sum(not m.ok for m in messages), dispatcher.stats(), time.perf_counter() - start
+
+    def spread(api):
+        """args.instances dispatchers on one bot token, each handed every Nth update"""
+        with ThreadPoolExecutor(max_workers=args.instances) as instances:
+            runs = list(instances.map(lambda n: dispatched(api, work[n::args.instances], args.instances),
+                                      range(args.instances)))
+        latencies = {priority: [value for run in runs for value in run[0][priority]]
+                     for priority in (EMERGENCY, NORMAL, BROADCAST)}
+        stats = {key: sum(run[2][key] for run in runs) for key in ("coalesced", "retries")}
+        return latencies, sum(run[1] for run in runs), stats
+
+    print(f"{args.recipients:,} broadcast recipients + {args.replies} replies to {args.reply_chats} chats "
+          f"({args.emergency_share:.0%} emergency), {args.threads} senders; simulated Telegram limits "
+          f"{30 * speedup:g}/s global, {speedup:g}/s per chat, {args.latency_ms:g} ms per call "
+          f"(limits x{speedup:g} to keep the run short)")
+    failures = 0
+    for name in ("direct", "dispatcher", f"{args.instances} instances"):
+        api = _SimulatedTelegramAPI(args.latency_ms / 1000.0, 30 * speedup, speedup)
+        start = time.perf_counter()
+        if name == "direct":
+            latencies, failed = direct(api)
+            stats = None
+        elif name == "dispatcher":
+            latencies, failed, stats, _ = dispatched(api)
+        else:
+            latencies, failed, stats = spread(api)
+        elapsed = time.perf_counter() - start
+        delivered = sum(len(texts) for texts in api.delivered.values())
+        line = (f"{name:>10}: {elapsed:.1f} s, {api.requests:,} requests, {api.rejected:,} 429s, "
+                f"{failed} failed, {total_messages / elapsed:,.0f} messages/s")
+        for priority, label in ((EMERGENCY, "emergency"), (NORMAL, "reply"), (BROADCAST, "broadcast")):
+            if latencies[priority]:
+                p50, p99 = np.percentile(latencies[priority], [50, 99]) * 1000
+                line += f"; {label} p50 {p50:.0f} ms p99 {p99:.0f} ms"
+        print(line)
+        if stats is not None:
+            print(f"{'':>12}coalesced {stats['coalesced']} messages, {stats['retries']} retries, "
+                  f"{delivered:,} sendMessage calls delivered")
+            if failed or api.rejected > total_messages * 0.01:
+                print("FAIL: the dispatcher should stay under the limits and deliver everything")
+                failures += 1
+    logging.disable(logging.NOTSET)
+    if failures:
+        sys.exit(1)
+
+
+# ============================================================================
+# BROADCAST - paged profile scan -> dispatcher, crash and resume
+# ============================================================================
+
+class _FakeProfileDoc:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class _FakeProfilesRef:
+    """Profiles collection stand-in for document-ID paging: order_by/select/limit/start_after/stream"""
+
+    def __init__(self, profiles, page_latency):
+        self.ids = sorted(profiles)
+        self.profiles = profiles
+        self.page_latency = page_latency
+        self.pages = 0
+        self.largest_page = 0
+
+    def document(self, doc_id):
+        return _FakeProfileDoc(doc_id, {})
+
+    def order_by(self, field):
+        return _FakeProfileQuery(self)
+
+
+class _FakeProfileQuery:
+    def __init__(self, ref):
+        self.ref = ref
+        self.fields = None
+        self.n = None
+        self.after = None
+
+    def select(self, fields):
+        self.fields = list(fields)
+        return self
+
+    def limit(self, n):
+        self.n = n
+        return self
+
+    def start_after(self, values):
+        self.after = values["__name__"].id
+        return self
+
+    def stream(self):
+        import bisect
+
+        time.sleep(self.ref.page_latency)
+        ids = self.ref.ids
+        start = bisect.bisect_right(ids, self.after) if self.after is not None else 0
+        page = ids[start:start + self.n]
+        self.ref.pages += 1
+        self.ref.largest_page = max(self.ref.largest_page, len(page))
+        return iter([_FakeProfileDoc(doc_id, {field: self.ref.profiles[doc_id][field] for field in self.fields
+                                              if field in self.ref.profiles[doc_id]}) for doc_id in page])
+
+
+class _FakeJobSnapshot:
+    def __init__(self, data, update_time):
+        self.exists = data is not None
+        self._data = data
+        self.update_time = update_time
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class _FakeJobsRef:
+    """Job docs with create(), get() and update() honouring a last_update_time precondition"""
+
+    def __init__(self):
+        import threading
+
+        self.docs = {}
+        self.versions = {}
+        self.lock = threading.Lock()
+        self.down = False
+        self.writes = 0
+
+    def document(self, doc_id):
+        return _FakeJobRef(self, doc_id)
+
+
+class _FakeJobRef:
+    def __init__(self, jobs, doc_id):
+        self.jobs = jobs
+        self.id = doc_id
+
+    def create(self, data):
+        with self.jobs.lock:
+            self.jobs.docs[self.id] = {}
+            self._apply(data)
+
+    def get(self):
+        with self.jobs.lock:
+            return _FakeJobSnapshot(self.jobs.docs.get(self.id), self.jobs.versions.get(self.id))
+
+    def update(self, data, option=None):
+        from google.api_core import exceptions as api_exceptions
+
+        with self.jobs.lock:
+            if self.jobs.down:
+                raise api_exceptions.ServiceUnavailable("instance is gone")
+            if option is not None and option._last_update_time != self.jobs.versions.get(self.id):
+                raise api_exceptions.FailedPrecondition("job changed since it was read")
+            self._apply(data)
+
+    def _apply(self, data):
+        from google.cloud import firestore
+
+        doc = self.jobs.docs[self.id]
+        for key, value in data.items():
+            if isinstance(value, firestore.Increment):
+                doc[key] = doc.get(key, 0) + value.value
+            elif value is firestore.SERVER_TIMESTAMP:
+                doc[key] = time.time()
+            else:
+                doc[key] = value
+        self.jobs.versions[self.id] = self.jobs.versions.get(self.id, 0) + 1
+        self.jobs.writes += 1
+
+
+def bench_broadcast(args):
+    import logging
+    from collections import Counter
+    from broadcast import AudienceFilter, BroadcastRunner, LeaseLost
+    from geo_risk import geohash_encode
+    from outbound import OutboundDispatcher
+
+    logging.disable(logging.CRITICAL)
+    rng = random.Random(5)
+    speedup = args.speedup
+    target = geohash_encode(9.06, 7.49, 4)
+    # Profiles spread over a wide box; a share placed inside the target cell, a few have blocked the bot
+    profiles = {}
+    for n in range(args.profiles):
+        chat_id = 10_000_000 + n
+        profile = {"chat_id": chat_id, "username": f"user{n}", "total_messages": rng.randrange(1, 50)}
+        if rng.random() < args.area_share:
+            profile["geohash"] = target + geohash_encode(rng.uniform(-90, 90), rng.uniform(-180, 180), 2)
+        elif rng.random() < 0.7:
+            profile["geohash"] = geohash_encode(rng.uniform(4, 14), rng.uniform(3, 15), 6)
+        profiles[str(chat_id)] = profile
+    blocked = {profile["chat_id"] for profile in profiles.values() if rng.random() < args.blocked_share}
+    audience = AudienceFilter(cells=[target])
+    expected = {profile["chat_id"] for profile in profiles.values() if audience.matches(profile)}
+
+    api = _SimulatedTelegramAPI(args.latency_ms / 1000.0, 30 * speedup, speedup)
+
+    class _Instance:
+        """One function instance's sender - after kill() its sends hang, like a frozen instance"""
+
+        def __init__(self):
+            import threading
+
+            self.alive = threading.Event()
+            self.alive.set()
+
+        def send(self, chat_id, text, **extra):
+            self.alive.wait()
+            if chat_id in blocked:
+                return _SimulatedTelegramAPI._Response(403)
+            return api.send_message(chat_id, text)
+
+    profiles_ref = _FakeProfilesRef(profiles, args.page_ms / 1000.0)
+    jobs = _FakeJobsRef()
+
+    def runner_for(instance):
+        dispatcher = OutboundDispatcher(instance.send, global_rate=args.global_rate * speedup, global_burst=5,
+                                        chat_rate=speedup, chat_burst=1, workers=args.workers)
+        return BroadcastRunner(profiles_ref, jobs, dispatcher, page_size=args.page_size,
+                               max_in_flight=args.max_in_flight, checkpoint_seconds=0.5,
+                               lease_seconds=args.lease_seconds, drain_seconds=3)
+
+    print(f"{args.profiles:,} profiles, {len(expected):,} in cell {target} "
+          f"({len(expected & blocked)} have blocked the bot); pages of {args.page_size}, "
+          f"{args.max_in_flight} in flight, limits x{speedup:g}")
+
+    # Run 1 dies partway: its sends freeze and its checkpoint writes start failing
+    first = _Instance()
+    runner = runner_for(first)
+    broadcast_id = runner.create("🚨 Flood warning for your area - move to higher ground.", audience)
+
+    def kill():
+        time.sleep(args.kill_after)
+        first.alive.clear()
+        jobs.down = True
+
+    import threading
+    threading.Thread(target=kill, daemon=True).start()
+    start = time.perf_counter()
+    try:
+        runner.run(broadcast_id)
+        print("FAIL: run 1 should have died")
+        sys.exit(1)
+    except Exception:
+        crashed = time.perf_counter() - start
+    job = jobs.docs[broadcast_id]
+    delivered_before = sum(len(texts) for texts in api.delivered.values())
+    print(f"run 1 died after {crashed:.1f} s: {delivered_before:,} delivered, checkpoint at "
+          f"{job['sent'] + job['failed']:,} recipients (cursor {job['cursor']})")
+
+    # A second run may not start while run 1's lease is live, then resumes from the checkpoint
+    jobs.down = False
+    busy = runner_for(_Instance()).run(broadcast_id)
+    time.sleep(args.lease_seconds)
+    resumed_runner = runner_for(_Instance())
+    report = resumed_runner.run(broadcast_id)
+    print(f"run 2 while the lease was live: {busy['status']}; after expiry: {report['status']}, "
+          f"{report['run_sent']:,} recipients in {report['run_seconds']:.1f} s, "
+          f"{report['messages_per_second']:,.0f} messages/s")
+
+    # Run 1's lease is long gone - a checkpoint from it must not land on the job
+    final_job = dict(jobs.docs[broadcast_id])
+    try:
+        runner._update_if_owner(jobs.document(broadcast_id), "run-1", {"cursor": None, "sent": 0})
+        stale_rejected = False
+    except LeaseLost:
+        stale_rejected = jobs.docs[broadcast_id] == final_job
+    try:
+        AudienceFilter()
+        empty_rejected = False
+    except ValueError:
+        empty_rejected = True
+    print(f"stale checkpoint rejected: {stale_rejected}; empty audience rejected: {empty_rejected}")
+
+    received = Counter(chat_id for chat_id, texts in api.delivered.items() for _ in texts)
+    duplicates = sum(count - 1 for count in received.values() if count > 1)
+    missing = expected - blocked - set(received)
+    outside = set(received) - expected
+    print(f"job: scanned {report['scanned']:,}, matched {report['matched']:,}, sent {report['sent']:,}, "
+          f"failed {report['failed']} {report['failures']}; profile pages read {profiles_ref.pages}, "
+          f"largest {profiles_ref.largest_page}; job writes {jobs.writes}")
+    print(f"recipients: {len(received):,} reached, {len(missing)} missed, {len(outside)} outside the area, "
+          f"{duplicates} duplicates from the crash (bound {args.max_in_flight + args.page_size})")
+    logging.disable(logging.NOTSET)
+
+    failures = []
+    if report["status"] != "completed" or busy["status"] != "busy":
+        failures.append("job did not complete, or the lease let a second run in")
+    if missing or outside:
+        failures.append("audience mismatch")
+    if not stale_rejected or not empty_rejected:
+        failures.append("a stale checkpoint or an empty audience got through")
+    if duplicates > args.max_in_flight + args.page_size:
+        failures.append("too many resends")
+    if report["matched"] != len(expected) or report["sent"] + report["failed"] != len(expected) \
+            or report["failed"] != len(expected & blocked):
+        failures.append("job counters don't add up")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    media = sub.add_parser("media-rss", help="Peak RSS growth of buffered vs streamed media uploads")
+    media.add_argument("--sizes", default="1,10,20", help="Comma-separated file sizes in MB")
+    media.set_defaults(func=bench_media_rss)
+
+    child = sub.add_parser("_media-rss-child")
+    child.add_argument("size", type=float)
+    child.add_argument("mode")
+    child.set_defaults(func=lambda a: _media_rss_child(a.size, a.mode))
+
+    semantic = sub.add_parser("semantic-lookup", help="Semantic query index lookup latency")
+    semantic.add_argument("--sizes", default="10000,100000", help="Comma-separated index sizes")
+    semantic.add_argument("--queries", type=int, default=2000)
+    semantic.set_defaults(func=bench_semantic_lookup)
+
+    logs = sub.add_parser("logging", help="Per-request logging overhead, baseline vs structured")
+    logs.add_argument("--requests", type=int, default=5000)
+    logs.set_defaults(func=bench_logging)
+
+    ids = sub.add_parser("ids", help="ID generator collision check across threads and processes")
+    ids.add_argument("--count", type=int, default=2_000_000)
+    ids.add_argument("--processes", type=int, default=4)
+    ids.add_argument("--threads", type=int, default=8)
+    ids.set_defaults(func=bench_ids)
+
+    load = sub.add_parser("message-load", help="Burst replay against the message log - overwrites and per-doc write rate")
+    load.add_argument("--chats", type=int, default=50)
+    load.add_argument("--rate", type=int, default=100, help="Messages per minute per chat")
+    load.add_argument("--minutes", type=int, default=10)
+    load.set_defaults(func=bench_message_load)
+
+    disp = sub.add_parser("dispatch", help="Webhook parse and classify overhead per request type")
+    disp.add_argument("--requests", type=int, default=20000)
+    disp.set_defaults(func=bench_dispatch)
+
+    risk = sub.add_parser("risk-batch", help="Batch risk scoring vs the scalar functions")
+    risk.add_argument("--rows", type=int, default=1_000_000)
+    risk.add_argument("--model", help="Risk model JSON (default: built-in tables)")
+    risk.set_defaults(func=bench_risk_batch)
+
+    geo = sub.add_parser("geo-score", help="Gazetteer + raster lookup latency per request")
+    geo.add_argument("--places", type=int, default=50_000)
+    geo.add_argument("--grid", type=int, default=2000, help="Raster rows and columns")
+    geo.add_argument("--requests", type=int, default=20_000)
+    geo.set_defaults(func=bench_geo_score)
+
+    dedup = sub.add_parser("incident-dedup", help="Duplicate incident clustering on a bursty report stream")
+    dedup.add_argument("--rate", type=int, default=10_000, help="Reports per minute")
+    dedup.add_argument("--minutes", type=int, default=10)
+    dedup.add_argument("--burst", type=int, default=20, help="Mean reports per real incident")
+    dedup.add_argument("--text-only", type=float, default=0.2, help="Share of reports without coordinates")
+    dedup.add_argument("--window", type=float, default=1800.0)
+    dedup.add_argument("--radius-km", type=float, default=1.0)
+    dedup.add_argument("--max-clusters", type=int, default=20_000)
+    dedup.set_defaults(func=bench_incident_dedup)
+
+    kw = sub.add_parser("keywords", help="Compiled keyword matcher vs per-keyword scans")
+    kw.add_argument("--keywords", type=int, default=5000)
+    kw.add_argument("--messages", type=int, default=5000)
+    kw.set_defaults(func=bench_keywords)
+
+    intent = sub.add_parser("intent", help="Intent classifier accuracy and per-message latency")
+    intent.add_argument("--model", default="intent_model.npz")
+    intent.add_argument("--data", default="intent_data/eval.jsonl")
+    intent.add_argument("--messages", type=int, default=20000)
+    intent.set_defaults(func=bench_intent)
+
+    replay = sub.add_parser("update-replay", help="Replay each Telegram update N times - side effects must happen once")
+    replay.add_argument("--updates", type=int, default=5000)
+    replay.add_argument("--replays", type=int, default=5)
+    replay.add_argument("--threads", type=int, default=16)
+    replay.add_argument("--rpc-ms", type=float, default=2.0, help="Simulated marker create() latency")
+    replay.add_argument("--fail-rate", type=float, default=0.05, help="Share of updates whose first attempt fails")
+    replay.set_defaults(func=bench_update_replay)
+
+    aw = sub.add_parser("async-webhook", help="Sync vs async Telegram handler chain against simulated I/O")
+    aw.add_argument("--updates", type=int, default=2000)
+    aw.add_argument("--chats", type=int, default=200)
+    aw.add_argument("--concurrency", type=int, default=64, help="Updates in flight per instance, in both modes")
+    aw.add_argument("--read-ms", type=float, default=8.0)
+    aw.add_argument("--write-ms", type=float, default=10.0, help="Update marker create()")
+    aw.add_argument("--commit-ms", type=float, default=15.0)
+    aw.add_argument("--send-ms", type=float, default=40.0)
+    aw.set_defaults(func=bench_async_webhook)
+
+    fo = sub.add_parser("fanout", help="Per-update steps run sequentially vs on the bounded fan-out pool")
+    fo.add_argument("--updates", type=int, default=2000)
+    fo.add_argument("--threads", type=int, default=8, help="Concurrent requests per instance")
+    fo.add_argument("--pool-size", type=int, default=16)
+    fo.add_argument("--media-share", type=float, default=0.3, help="Share of updates carrying a photo")
+    fo.add_argument("--stall-rate", type=float, default=0.01, help="Share of photo downloads that hang")
+    fo.add_argument("--deadline-ms", type=float, default=500.0, help="Photo step deadline")
+    fo.add_argument("--queue-timeout-ms", type=float, default=500.0,
+                    help="Cancel a step still waiting for a pool thread after this long")
+    fo.add_argument("--read-ms", type=float, default=8.0)
+    fo.add_argument("--commit-ms", type=float, default=15.0)
+    fo.add_argument("--send-ms", type=float, default=40.0)
+    fo.add_argument("--get-file-ms", type=float, default=30.0)
+    fo.add_argument("--download-ms", type=float, default=60.0)
+    fo.set_defaults(func=bench_fanout)
+
+    ob = sub.add_parser("outbound", help="Direct sendMessage vs the rate-limited dispatcher against simulated flood limits")
+    ob.add_argument("--recipients", type=int, default=3000, help="Broadcast recipients")
+    ob.add_argument("--replies", type=int, default=600)
+    ob.add_argument("--reply-chats", type=int, default=100)
+    ob.add_argument("--emergency-share", type=float, default=0.1)
+    ob.add_argument("--threads", type=int, default=16)
+    ob.add_argument("--latency-ms", type=float, default=20.0)
+    ob.add_argument("--global-rate", type=float, default=25.0, help="Dispatcher global rate before the speedup")
+    ob.add_argument("--max-attempts", type=int, default=5)
+    ob.add_argument("--max-pending", type=int, default=1000)
+    ob.add_argument("--instances", type=int, default=4, help="Function instances sharing the bot token")
+    ob.add_argument("--speedup", type=float, default=10.0, help="Scale every limit to shorten the run")
+    ob.set_defaults(func=bench_outbound)
+
+    bc = sub.add_parser("broadcast", help="Area broadcast over paged profiles - crash mid-run, resume, check delivery")
+    bc.add_argument("--profiles", type=int, default=100_000)
+    bc.add_argument("--area-share", type=float, default=0.1, help="Share of profiles inside the target cell")
+    bc.add_argument("--blocked-share", type=float, default=0.02, help="Share of users who blocked the bot")
+    bc.add_argument("--page-size", type=int, default=500)
+    bc.add_argument("--page-ms", type=float, default=30.0, help="Simulated profile page read")
+    bc.add_argument("--max-in-flight", type=int, default=250)
+    bc.add_argument("--workers", type=int, default=16)
+    bc.add_argument("--latency-ms", type=float, default=20.0)
+    bc.add_argument("--global-rate", type=float, default=25.0, help="Dispatcher global rate before the speedup")
+    bc.add_argument("--speedup", type=float, default=20.0, help="Scale every limit to shorten the run")
+    bc.add_argument("--kill-after", type=float, default=5.0, help="Seconds before run 1's instance dies")
+    bc.add_argument("--lease-seconds", type=float, default=2.0)
+    bc.set_defaults(func=bench_broadcast)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+"""Mass emergency broadcasts to stored Telegram profiles
+
+A broadcast is a job document under arems-profiles/broadcasts/jobs. A run
+streams the profiles collection in document-ID pages (only the fields the
+audience filter needs), keeps the profiles in the target regions / risk
+cells and hands them to the rate-limited outbound dispatcher.
+
+After a page's messages have all been sent or failed, the job's cursor and
+counters move past it. Each run stops after a time budget, or when its
+instance dies, and the next run resumes from the cursor. Recipients of pages
+that were only partly sent before a crash get the alert again (at most
+BROADCAST_MAX_IN_FLIGHT plus one page), never a gap. A lease on the job doc
+stops two runs from sending the same broadcast at once; every checkpoint is
+conditional on still holding it, and a run that has lost it stops sending.
+"""
+import os
+import time
+import uuid
+import threading
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, Optional
+
+from google.api_core import exceptions as api_exceptions
+from google.cloud import firestore
+
+import metrics
+from id_generator import generate_id
+from outbound import OutboundDispatcher, OutboundMessage, BROADCAST
+from structured_logging import get_logger
+
+log = get_logger(__name__)
+
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "500"))
+# Messages of one run queued or sending at a time - bounds resends after a crash and the final drain
+BROADCAST_MAX_IN_FLIGHT = int(os.getenv("BROADCAST_MAX_IN_FLIGHT", "250"))
+# Keep well under the function timeout; the caller invokes again until status is "completed"
+BROADCAST_TIME_BUDGET = float(os.getenv("BROADCAST_TIME_BUDGET", "420"))
+BROADCAST_DRAIN_SECONDS = float(os.getenv("BROADCAST_DRAIN_SECONDS", "60"))
+BROADCAST_CHECKPOINT_SECONDS = float(os.getenv("BROADCAST_CHECKPOINT_SECONDS", "5"))
+BROADCAST_LEASE_SECONDS = float(os.getenv("BROADCAST_LEASE_SECONDS", "120"))
+
+RUNNING = "running"
+COMPLETED = "completed"
+
+# Failed chat IDs kept on the job for follow-up
+_FAILED_SAMPLE = 50
+
+
+class LeaseLost(Exception):
+    """The run's lease on a broadcast job expired and another run took it"""
+
+
+class AudienceFilter:
+    """Profiles in any of regions (profile 'region', case-insensitive) or cells (prefixes of 'geohash')
+
+    A filter with no regions or cells raises ValueError - sending to every
+    profile takes an explicit everyone=True ("all": true in the job).
+    """
+
+    FIELDS = ['chat_id', 'region', 'geohash']
+
+    def __init__(self, regions: Iterable[str] = (), cells: Iterable[str] = (), everyone: bool = False):
+        self.regions = sorted({r.strip().casefold() for r in regions if r and r.strip()})
+        self.cells = sorted({c.strip().lower() for c in cells if c and c.strip()})
+        self.everyone = bool(everyone)
+        if not self.everyone and not self.regions and not self.cells:
+            raise ValueError('Audience filter is empty - give regions or cells, or "all": true for every profile')
+        self._regions = frozenset(self.regions)
+        self._cells = tuple(self.cells)
+
+    def matches(self, profile: Dict[str, Any]) -> bool:
+        if self.everyone:
+            return True
+        if self._regions and str(profile.get('region') or '').casefold() in self._regions:
+            return True
+        return bool(self._cells) and str(profile.get('geohash') or '').startswith(self._cells)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'regions': self.regions, 'cells': self.cells, 'all': self.everyone}
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> "AudienceFilter":
+        data = data or {}
+        return cls(data.get('regions') or (), data.get('cells') or (), everyone=data.get('all') is True)
+
+
+class _Page:
+    """Delivery state of one profile page - the cursor may pass it once outstanding is 0"""
+
+    __slots__ = ("last_id", "scanned", "matched", "outstanding", "sent", "failed", "failures")
+
+    def __init__(self, last_id: str, scanned: int, matched: int):
+        self.last_id = last_id
+        self.scanned = scanned
+        self.matched = matched
+        self.outstanding = matched
+        self.sent = 0
+        self.failed = 0
+        self.failures = Counter()
+
+
+class BroadcastRunner:
+    """Runs broadcast jobs: profile pages -> audience filter -> dispatcher, with checkpoints"""
+
+    def __init__(self, profiles_ref, jobs_ref, dispatcher: OutboundDispatcher,
+                 page_size: int = BROADCAST_PAGE_SIZE, max_in_flight: int = BROADCAST_MAX_IN_FLIGHT,
+                 checkpoint_seconds: float = BROADCAST_CHECKPOINT_SECONDS,
+                 lease_seconds: float = BROADCAST_LEASE_SECONDS, drain_seconds: float = BROADCAST_DRAIN_SECONDS):
+        self.profiles_ref = profiles_ref
+        self.jobs_ref = jobs_ref
+        self.dispatcher = dispatcher
+        self.page_size = page_size
+        self.max_in_flight = max_in_flight
+        self.checkpoint_seconds = checkpoint_seconds
+        self.lease_seconds = lease_seconds
+        self.drain_seconds = drain_seconds
+
+    def create(self, text: str, audience: AudienceFilter, priority: int = BROADCAST) -> str:
+        """Store a new broadcast job - returns its ID for run()"""
+        if not text or not text.strip():
+            raise ValueError("Broadcast text is empty")
+        broadcast_id = generate_id("BCAST")
+        self.jobs_ref.document(broadcast_id).create({
+            'broadcast_id': broadcast_id,
+            'text': text,
+            'audience': audience.to_dict(),
+            'priority': priority,
+            'status': RUNNING,
+            'cursor': None,
+            'scanned': 0,
+            'matched': 0,
+            'sent': 0,
+            'failed': 0,
+            'failures': {},
+            'failed_chat_ids': [],
+            'runs': 0,
+            'created_at': firestore.SERVER_TIMESTAMP
+        })
+        log.info("📢 Broadcast created", broadcast_id=broadcast_id, audience=audience.to_dict(), priority=priority)
+        return broadcast_id
+
+    def status(self, broadcast_id: str) -> Optional[Dict[str, Any]]:
+        snapshot = self.jobs_ref.document(broadcast_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def _pages(self, cursor: Optional[str]):
+        """Profile pages in document-ID order after cursor, projected to the filter's fields"""
+        while True:
+            query = self.profiles_ref.order_by('__name__').select(AudienceFilter.FIELDS).limit(self.page_size)
+            if cursor is not None:
+                query = query.start_after({'__name__': self.profiles_ref.document(cursor)})
+            docs = list(query.stream())
+            if not docs:
+                return
+            cursor = docs[-1].id
+            yield docs
+
+    def _claim(self, job_ref, snapshot, owner: str) -> bool:
+        """Take the job's lease unless another live run holds it - conditional on the snapshot we read"""
+        job = snapshot.to_dict()
+        now = datetime.now(timezone.utc)
+        expires = job.get('lease_expires_at')
+        if job.get('lease_owner') is not None and expires is not None and expires > now:
+            return False
+        try:
+            job_ref.update({
+                'lease_owner': owner,
+                'lease_expires_at': now + timedelta(seconds=self.lease_seconds),
+                'runs': firestore.Increment(1)
+            }, option=firestore.Client.write_option(last_update_time=snapshot.update_time))
+        except (api_exceptions.FailedPrecondition, api_exceptions.Conflict):
+            return False
+        return True
+
+    def _update_if_owner(self, job_ref, owner: str, data: Dict[str, Any], attempts: int = 3) -> None:
+        """Write data only while owner still holds the lease - conditional on the snapshot we read
+
+        Raises LeaseLost once another run holds the lease, so a run that
+        stalled past its lease can't overwrite the new holder's cursor.
+        """
+        for _ in range(attempts):
+            snapshot = job_ref.get()
+            if not snapshot.exists or (snapshot.to_dict() or {}).get('lease_owner') != owner:
+                raise LeaseLost(job_ref.id)
+            try:
+                job_ref.update(data, option=firestore.Client.write_option(last_update_time=snapshot.update_time))
+                return
+            except (api_exceptions.FailedPrecondition, api_exceptions.Conflict):
+                continue
+        raise LeaseLost(job_ref.id)
+
+    def run(self, broadcast_id: str, time_budget: float = BROADCAST_TIME_BUDGET) -> Dict[str, Any]:
+        """Send the job's next pages until the profiles run out or time_budget passes"""
+        job_ref = self.jobs_ref.document(broadcast_id)
+        snapshot = job_ref.get()
+        if not snapshot.exists:
+            raise KeyError(f"Unknown broadcast {broadcast_id}")
+        job = snapshot.to_dict()
+        if job.get('status') == COMPLETED:
+            return self._report(job, run_sent=0, elapsed=0.0)
+        owner = uuid.uuid4().hex
+        if not self._claim(job_ref, snapshot, owner):
+            log.info("📢 Broadcast is being sent by another run", broadcast_id=broadcast_id)
+            return {**self._report(job, run_sent=0, elapsed=0.0), 'status': 'busy'}
+
+        audience = AudienceFilter.from_dict(job.get('audience'))
+        text, priority = job['text'], job.get('priority', BROADCAST)
+        totals = Counter({key: job.get(key, 0) for key in ('scanned', 'matched', 'sent', 'failed')})
+        failures = Counter(job.get('failures') or {})
+        failed_ids = list(job.get('failed_chat_ids') or [])
+        cursor = job.get('cursor')
+
+        lock = threading.Lock()
+        changed = threading.Condition(lock)
+        pages = deque()
+        in_flight = 0
+
+        def delivered(page: _Page, message: OutboundMessage) -> None:
+            nonlocal in_flight
+            with lock:
+                in_flight -= 1
+                page.outstanding -= 1
+                if message.ok:
+                    page.sent += 1
+                else:
+                    page.failed += 1
+                    page.failures[str(message.status_code or 'error')] += 1
+                    if len(failed_ids) < _FAILED_SAMPLE:
+                        failed_ids.append(message.chat_id)
+                changed.notify_all()
+
+        def advance() -> None:
+            # Completed pages at the head move the cursor; a later page can't pass an unfinished one
+            nonlocal cursor
+            while pages and pages[0].outstanding == 0:
+                page = pages.popleft()
+                cursor = page.last_id
+                totals.update(scanned=page.scanned, matched=page.matched, sent=page.sent, failed=page.failed)
+                failures.update(page.failures)
+
+        def checkpoint(status: str = RUNNING, final: bool = False) -> None:
+            with lock:
+                advance()
+                data = {**totals, 'cursor': cursor, 'status': status, 'failures': dict(failures),
+                        'failed_chat_ids': list(failed_ids), 'updated_at': firestore.SERVER_TIMESTAMP,
+                        'lease_expires_at': datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds)}
+            if final:
+                # Hand the job straight to the next run
+                data.update(lease_owner=None, lease_expires_at=None)
+            if status == COMPLETED:
+                data['completed_at'] = firestore.SERVER_TIMESTAMP
+            self._update_if_owner(job_ref, owner, data)
+
+        start = time.monotonic()
+        deadline = start + time_budget
+        last_checkpoint = start
+        sent_before = totals['sent'] + totals['failed']
+        exhausted = False
+        log.info("📢 Broadcast run started", broadcast_id=broadcast_id, cursor=cursor, sent=totals['sent'])
+
+        try:
+            for docs in self._pages(cursor):
+                recipients = []
+                for doc in docs:
+                    data = doc.to_dict() or {}
+                    if audience.matches(data):
+                        recipients.append(data.get('chat_id') or doc.id)
+                page = _Page(docs[-1].id, len(docs), len(recipients))
+                with lock:
+                    pages.append(page)
+
+                for chat_id in recipients:
+                    while True:
+                        with lock:
+                            if in_flight < self.max_in_flight:
+                                in_flight += 1
+                                break
+                            changed.wait(self.checkpoint_seconds)
+                        # Keep the lease alive while the window is full
+                        if time.monotonic() - last_checkpoint >= self.checkpoint_seconds:
+                            checkpoint()
+                            last_checkpoint = time.monotonic()
+                    self.dispatcher.enqueue(chat_id, text, priority, on_done=lambda m, page=page: delivered(page, m))
+
+                now = time.monotonic()
+                if now - last_checkpoint >= self.checkpoint_seconds:
+                    checkpoint()
+                    last_checkpoint = now
+                if now >= deadline:
+                    break
+            else:
+                exhausted = True
+
+            # Let this run's messages finish so the cursor can pass them
+            drain_deadline = time.monotonic() + self.drain_seconds
+            with lock:
+                while in_flight and time.monotonic() < drain_deadline:
+                    changed.wait(drain_deadline - time.monotonic())
+                done = exhausted and not in_flight
+            checkpoint(COMPLETED if done else RUNNING, final=True)
+        except LeaseLost:
+            # Another run resumes from the last checkpoint it saw; messages already queued still go out
+            elapsed = time.monotonic() - start
+            metrics.incr("broadcast.lease_lost")
+            log.warning("📢 Broadcast lease lost - stopping this run", broadcast_id=broadcast_id,
+                        run_seconds=round(elapsed, 2))
+            job = {**job, **totals, 'cursor': cursor}
+            return {**self._report(job, run_sent=totals['sent'] + totals['failed'] - sent_before, elapsed=elapsed),
+                    'status': 'lease_lost'}
+
+        elapsed = time.monotonic() - start
+        job = {**job, **totals, 'cursor': cursor, 'status': COMPLETED if done else RUNNING,
+               'failures': dict(failures), 'failed_chat_ids': failed_ids}
+        report = self._report(job, run_sent=totals['sent'] + totals['failed'] - sent_before, elapsed=elapsed)
+        metrics.incr("broadcast.messages_sent", report['run_sent'])
+        log.info("📢 Broadcast run finished", **report)
+        return report
+
+    @staticmethod
+    def _report(job: Dict[str, Any], run_sent: int, elapsed: float) -> Dict[str, Any]:
+        return {
+            'broadcast_id': job.get('broadcast_id'),
+            'status': job.get('status'),
+            'scanned': job.get('scanned', 0),
+            'matched': job.get('matched', 0),
+            'sent': job.get('sent', 0),
+            'failed': job.get('failed', 0),
+            'failures': job.get('failures') or {},
+            'run_sent': run_sent,
+            'run_seconds': round(elapsed, 2),
+            'messages_per_second': round(run_sent / elapsed, 1) if elapsed else 0.0
+        }
+
+
+def build_broadcast_runner(db, dispatcher: OutboundDispatcher) -> BroadcastRunner:
+    profiles = db.collection('arems-profiles').document('users').collection('profiles')
+    jobs = db.collection('arems-profiles').document('broadcasts').collection('jobs')
+    return BroadcastRunner(profiles, jobs, dispatcher)
@@ -0,0 +1,55 @@
+import json
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # optional faster backend
+    orjson = None
+
+ROUTE_DIALOGFLOW = "dialogflow"
+ROUTE_TELEGRAM = "telegram"
+
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+# Top-level fields only a Dialogflow CX webhook request carries
+CX_INDICATORS = ("fulfillmentInfo", "sessionInfo", "pageInfo", "intentInfo")
+
+
+def loads(raw: bytes) -> Any:
+    """Decode JSON bytes with orjson when installed, else the stdlib"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def parse_json_body(request) -> Optional[Dict[str, Any]]:
+    """Parse the request body exactly once - None when empty, invalid or not an object"""
+    raw = request.get_data(cache=True)
+    if not raw:
+        return None
+    try:
+        body = loads(raw)
+    except ValueError:  # orjson.JSONDecodeError and json.JSONDecodeError both subclass it
+        return None
+    return body if isinstance(body, dict) else None
+
+
+def classify_request(headers, body: Optional[Dict[str, Any]]) -> Tuple[str, str]:
+    """Pick the route for a webhook call - returns (route, reason)
+
+    Headers are checked first so the common cases never look at the body:
+    Dialogflow CX identifies itself in the User-Agent and Telegram sends the
+    secret token header when the webhook was registered with one.
+    """
+    if "Google-Dialogflow" in headers.get("User-Agent", ""):
+        return ROUTE_DIALOGFLOW, "user-agent"
+    if "X-Telegram-Bot-Api-Secret-Token" in headers:
+        return ROUTE_TELEGRAM, "secret-token"
+    if body:
+        # Every Telegram update carries update_id
+        if "update_id" in body:
+            return ROUTE_TELEGRAM, "update_id"
+        for field in CX_INDICATORS:
+            if field in body:
+                return ROUTE_DIALOGFLOW, field
+    return ROUTE_TELEGRAM, "default"
@@ -0,0 +1,241 @@
+import os
+import time
+import asyncio
+import inspect
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, Mapping, NamedTuple, Optional
+
+import metrics
+from structured_logging import get_logger
+
+log = get_logger(__name__)
+
+# Threads shared by every update on this instance
+FANOUT_POOL_SIZE = int(os.getenv("FANOUT_POOL_SIZE", "8"))
+# How long an update waits on any one step, plus per-step overrides as "name=seconds,..."
+FANOUT_STEP_DEADLINE = float(os.getenv("FANOUT_STEP_DEADLINE", "15"))
+FANOUT_STEP_DEADLINES = {
+    name.strip(): float(seconds)
+    for name, _, seconds in (item.partition("=") for item in
+                             os.getenv("FANOUT_STEP_DEADLINES", "document=60,photo=60").split(","))
+    if name.strip() and seconds
+}
+# A step still queued for a pool thread this long after the fan-out began is cancelled
+FANOUT_QUEUE_TIMEOUT = float(os.getenv("FANOUT_QUEUE_TIMEOUT", "5"))
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+class FanOutResult(NamedTuple):
+    results: Dict[str, Any]
+    errors: Dict[str, str]
+    spans: Dict[str, float]
+    elapsed: float
+
+
+class _StepTracker:
+    """Start times and spans of one fan-out's steps, and late-finish reporting for abandoned ones
+
+    Steps run through run(), which records when each one actually got a
+    thread - deadlines count from there, not from submission.
+    """
+
+    def __init__(self, names, metric_prefix: str, on_start: Optional[Callable[[str], None]] = None):
+        self.metric_prefix = metric_prefix
+        self.started = {name: threading.Event() for name in names}
+        self.started_at: Dict[str, float] = {}
+        self.spans: Dict[str, float] = {}
+        self._on_start = on_start
+
+    def run(self, name, step):
+        step_start = time.perf_counter()
+        self.started_at[name] = step_start
+        self.started[name].set()
+        if self._on_start:
+            self._on_start(name)
+        try:
+            return step()
+        finally:
+            self.spans[name] = time.perf_counter() - step_start
+            metrics.observe(f"{self.metric_prefix}.{name}.seconds", self.spans[name])
+
+    async def run_async(self, name, step):
+        step_start = time.perf_counter()
+        self.started_at[name] = step_start
+        self.started[name].set()
+        try:
+            return await step()
+        finally:
+            self.spans[name] = time.perf_counter() - step_start
+            metrics.observe(f"{self.metric_prefix}.{name}.seconds", self.spans[name])
+
+    def not_started(self, name, queue_timeout: float) -> str:
+        metrics.incr(f"{self.metric_prefix}.{name}.not_started")
+        return f"not started within {queue_timeout:g}s"
+
+    def timed_out(self, name, deadline: float) -> str:
+        metrics.incr(f"{self.metric_prefix}.{name}.timeouts")
+        return f"timed out after {deadline:g}s"
+
+    def abandon(self, name, deadline: float, future: Future) -> str:
+        """Record a timeout; the step keeps its thread, so report when (and how) it really ends"""
+
+        def finished_late(done: Future):
+            error = done.exception()
+            metrics.incr(f"{self.metric_prefix}.{name}.late")
+            log.warning("⏳ Step finished after its deadline", step=name, deadline_s=deadline,
+                        seconds=lambda: round(self.spans.get(name, 0.0), 3),
+                        error=f"{error.__class__.__name__}: {error}" if error else None)
+
+        future.add_done_callback(finished_late)
+        return self.timed_out(name, deadline)
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Process-wide bounded pool - created on first use"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=FANOUT_POOL_SIZE, thread_name_prefix="fanout")
+    return _executor
+
+
+def run_steps(steps: Mapping[str, Callable[[], Any]], deadlines: Optional[Mapping[str, float]] = None,
+              default_deadline: float = FANOUT_STEP_DEADLINE, executor: Optional[ThreadPoolExecutor] = None,
+              metric_prefix: str = "fanout", queue_timeout: float = FANOUT_QUEUE_TIMEOUT,
+              inline: Optional[str] = None) -> FanOutResult:
+    """Run independent steps concurrently and wait for all of them, each up to its deadline
+
+    A step's deadline counts from when it gets a pool thread, so time spent
+    queued behind other updates doesn't eat into it; a step still queued
+    queue_timeout after the fan-out began is cancelled and never runs. A
+    step's exception, timeout or cancellation is recorded in errors under its
+    name instead of failing the others.
+
+    A step that has started can't be stopped: on timeout it keeps running
+    after the webhook has answered, when Cloud Functions throttles the CPU,
+    so it may finish much later or not at all. Its result is dropped, its
+    end is logged as a late finish (metric <metric_prefix>.<step>.late), and
+    a retried update will run it again - steps must be idempotent and bound
+    their own I/O. Each step's duration is kept in spans (and the metric
+    <metric_prefix>.<step>.seconds), so the critical path is max(spans)
+    against elapsed.
+
+    The inline step (one the update can't do without) runs on the calling
+    thread once the others are submitted, so a busy pool can neither delay
+    nor cancel it; it bounds its own I/O and has no deadline here.
+    """
+    deadlines = {**FANOUT_STEP_DEADLINES, **(deadlines or {})}
+    results: Dict[str, Any] = {}
+    errors: Dict[str, str] = {}
+    tracker = _StepTracker(steps, metric_prefix)
+    start = time.perf_counter()
+
+    def run_inline(name):
+        try:
+            results[name] = tracker.run(name, steps[name])
+        except Exception as e:
+            errors[name] = f"{e.__class__.__name__}: {e}"
+
+    if len(steps) == 1:
+        # Nothing to overlap - skip the pool hop
+        run_inline(next(iter(steps)))
+        return FanOutResult(results, errors, tracker.spans, time.perf_counter() - start)
+
+    pool = executor or get_executor()
+    # Each step runs in a copy of the caller's context, so request-scoped log fields follow it
+    futures = {name: pool.submit(contextvars.copy_context().run, tracker.run, name, step)
+               for name, step in steps.items() if name != inline}
+    if inline in steps:
+        run_inline(inline)
+    for name, future in futures.items():
+        deadline = deadlines.get(name, default_deadline)
+        started = tracker.started[name]
+        if not started.wait(max(0.0, start + queue_timeout - time.perf_counter())) and future.cancel():
+            errors[name] = tracker.not_started(name, queue_timeout)
+            continue
+        # Cancel only fails once a worker has picked the step up, so it is about to mark itself started
+        started.wait()
+        try:
+            results[name] = future.result(timeout=max(0.0, tracker.started_at[name] + deadline - time.perf_counter()))
+        except FutureTimeoutError:
+            errors[name] = tracker.abandon(name, deadline, future)
+        except Exception as e:
+            errors[name] = f"{e.__class__.__name__}: {e}"
+
+    elapsed = time.perf_counter() - start
+    spans = dict(tracker.spans)
+    log.info("⏱️ Fan-out finished", spans_ms={name: round(s * 1000, 1) for name, s in spans.items()},
+             elapsed_ms=round(elapsed * 1000, 1), errors=errors or None)
+    return FanOutResult(results, errors, spans, elapsed)
+
+
+async def run_steps_async(steps: Mapping[str, Callable[[], Any]], deadlines: Optional[Mapping[str, float]] = None,
+                          default_deadline: float = FANOUT_STEP_DEADLINE,
+                          executor: Optional[ThreadPoolExecutor] = None,
+                          metric_prefix: str = "fanout", queue_timeout: float = FANOUT_QUEUE_TIMEOUT,
+                          inline: Optional[str] = None) -> FanOutResult:
+    """run_steps() for the event loop - coroutine steps on the loop, sync ones in worker threads
+
+    A coroutine function step (async def, or a partial of one) is awaited
+    right away in its own task: no thread, no queueing, and on timeout it is
+    cancelled rather than abandoned. Sync steps get run_steps()' treatment -
+    deadlines counted from their start, queue cancellation, late-finish
+    reporting, and the caveat that a timed-out step keeps running - on
+    executor (the shared fan-out pool when None) in a copy of the caller's
+    context, so request-scoped log fields follow them. The event loop can't
+    block on a sync inline step, so it goes to the pool too, but is never
+    queue-cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    deadlines = {**FANOUT_STEP_DEADLINES, **(deadlines or {})}
+    results: Dict[str, Any] = {}
+    errors: Dict[str, str] = {}
+    started = {name: asyncio.Event() for name in steps}
+    tracker = _StepTracker(steps, metric_prefix,
+                           on_start=lambda name: loop.call_soon_threadsafe(started[name].set))
+    pool = executor or get_executor()
+    start = time.perf_counter()
+
+    async def run(name, step):
+        deadline = deadlines.get(name, default_deadline)
+        if inspect.iscoroutinefunction(step):
+            try:
+                results[name] = await asyncio.wait_for(tracker.run_async(name, step), deadline)
+            except asyncio.TimeoutError:
+                errors[name] = tracker.timed_out(name, deadline)
+            except Exception as e:
+                errors[name] = f"{e.__class__.__name__}: {e}"
+            return
+        future = pool.submit(contextvars.copy_context().run, tracker.run, name, step)
+        try:
+            await asyncio.wait_for(started[name].wait(),
+                                   None if name == inline else max(0.0, start + queue_timeout - time.perf_counter()))
+        except asyncio.TimeoutError:
+            if future.cancel():
+                errors[name] = tracker.not_started(name, queue_timeout)
+                return
+            await started[name].wait()
+        waiting = asyncio.wrap_future(future)
+        done, _ = await asyncio.wait({waiting}, timeout=max(0.0, tracker.started_at[name] + deadline
+                                                                 - time.perf_counter()))
+        if not done:
+            # The thread can't be interrupted; the tracker reports how it ends
+            waiting.add_done_callback(lambda f: f.cancelled() or f.exception())
+            errors[name] = tracker.abandon(name, deadline, future)
+            return
+        try:
+            results[name] = waiting.result()
+        except Exception as e:
+            errors[name] = f"{e.__class__.__name__}: {e}"
+
+    await asyncio.gather(*(run(name, step) for name, step in steps.items()))
+    elapsed = time.perf_counter() - start
+    spans = dict(tracker.spans)
+    log.info("⏱️ Fan-out finished", spans_ms={name: round(s * 1000, 1) for name, s in spans.items()},
+             elapsed_ms=round(elapsed * 1000, 1), errors=errors or None, mode="async")
+    return FanOutResult(results, errors, spans, elapsed)
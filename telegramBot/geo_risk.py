@@ -0,0 +1,369 @@
+"""Geospatial risk factors from a local gazetteer and precomputed rasters
+
+Everything is read from GEO_DATA_DIR at startup, so scoring runs offline:
+
+    gazetteer.csv     name,lat,lon[,aliases separated by |][,region]
+    risk_raster.npz   hazard/population-density grids written by build-raster
+
+Build the raster from point observations (layer,lat,lon,value rows, where
+layer is a hazard type, 'all' for every hazard, or 'population_density'):
+
+    python geo_risk.py build-raster points.csv --bbox 4.0,2.5,14.0,15.0 --cell 0.05 -o geo_data/risk_raster.npz
+"""
+import os
+import re
+import csv
+import json
+import argparse
+from typing import Any, Dict, Iterable, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from answer_cache import normalize_query
+from structured_logging import get_logger
+
+log = get_logger(__name__)
+
+GEO_DATA_DIR = os.getenv("GEO_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "geo_data"))
+GEOHASH_PRECISION = int(os.getenv("GEOHASH_PRECISION", "6"))
+# A shared location further than this from every gazetteer place gets no region
+GEO_REGION_MAX_KM = float(os.getenv("GEO_REGION_MAX_KM", "50"))
+
+GAZETTEER_FILE = "gazetteer.csv"
+RASTER_FILE = "risk_raster.npz"
+
+# Raster layers are stored as uint8 - 0..255 maps onto an index of 0.0..1.0
+_RASTER_SCALE = 255.0
+DENSITY_LAYER = "population_density"
+ALL_HAZARDS_LAYER = "all"
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+_EARTH_RADIUS_KM = 6371.0
+_COORDINATES = re.compile(r"^\s*(-?\d+(?:\.\d+)?)\s*[, ]\s*(-?\d+(?:\.\d+)?)\s*$")
+
+
+# ============================================================================
+# GEOHASH
+# ============================================================================
+
+def geohash_encode(lat: float, lon: float, precision: int = GEOHASH_PRECISION) -> str:
+    """Standard base32 geohash of a point"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        rng, coord = (lon_range, lon) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        if coord >= mid:
+            value = (value << 1) | 1
+            rng[0] = mid
+        else:
+            value <<= 1
+            rng[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_BASE32[value])
+            bits = 0
+            value = 0
+    return "".join(chars)
+
+
+def geohash_bounds(geohash: str) -> Tuple[float, float, float, float]:
+    """(min_lat, min_lon, max_lat, max_lon) of a geohash cell"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        value = _BASE32.index(char)
+        for shift in range(4, -1, -1):
+            rng = lon_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if (value >> shift) & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+    return lat_range[0], lon_range[0], lat_range[1], lon_range[1]
+
+
+def geohash_center(geohash: str) -> Tuple[float, float]:
+    min_lat, min_lon, max_lat, max_lon = geohash_bounds(geohash)
+    return (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+
+
+# ============================================================================
+# GAZETTEER
+# ============================================================================
+
+class Place(NamedTuple):
+    name: str
+    lat: float
+    lon: float
+    region: Optional[str] = None
+
+
+def parse_coordinates(text: str) -> Optional[Tuple[float, float]]:
+    """'6.45, 3.39' style input - returns (lat, lon) when valid"""
+    match = _COORDINATES.match(text or "")
+    if not match:
+        return None
+    lat, lon = float(match.group(1)), float(match.group(2))
+    if -90 <= lat <= 90 and -180 <= lon <= 180:
+        return lat, lon
+    return None
+
+
+class Gazetteer:
+    """Normalized place name (and alias) -> Place, loaded from a local CSV"""
+
+    def __init__(self, places: Iterable[Tuple[str, float, float, Iterable[str]]] = ()):
+        self._index: Dict[str, Place] = {}
+        self._places = []
+        self._coordinates: Optional[np.ndarray] = None
+        self.max_words = 1
+        for name, lat, lon, aliases in places:
+            self.add(name, lat, lon, aliases)
+
+    def add(self, name: str, lat: float, lon: float, aliases: Iterable[str] = (),
+            region: Optional[str] = None) -> None:
+        place = Place(name, float(lat), float(lon), region or None)
+        self._places.append(place)
+        self._coordinates = None
+        for label in (name, *aliases):
+            key = normalize_query(label)
+            if key:
+                # First entry wins, so list the most important place of a shared name first
+                self._index.setdefault(key, place)
+                self.max_words = max(self.max_words, len(key.split()))
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @classmethod
+    def load_csv(cls, path: str) -> "Gazetteer":
+        gazetteer = cls()
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                aliases = [a for a in (row.get("aliases") or "").split("|") if a]
+                gazetteer.add(row["name"], row["lat"], row["lon"], aliases, (row.get("region") or "").strip())
+        return gazetteer
+
+    def lookup(self, text: str) -> Optional[Place]:
+        """Resolve free text such as 'Ikeja, Lagos' or 'flooding near ikeja market'
+
+        Tries the whole text, then each comma-separated part, then word
+        n-grams longest first, so the most specific match wins.
+        """
+        key = normalize_query(text)
+        if not key:
+            return None
+        place = self._index.get(key)
+        if place is not None:
+            return place
+        for part in text.split(","):
+            place = self._index.get(normalize_query(part))
+            if place is not None:
+                return place
+        words = key.split()
+        for size in range(min(self.max_words, len(words)), 0, -1):
+            for start in range(len(words) - size + 1):
+                place = self._index.get(" ".join(words[start:start + size]))
+                if place is not None:
+                    return place
+        return None
+
+    def nearest(self, lat: float, lon: float, max_km: float = GEO_REGION_MAX_KM) -> Optional[Place]:
+        """Closest place to a point (equirectangular distance) - None when none is within max_km"""
+        if not self._places:
+            return None
+        if self._coordinates is None:
+            self._coordinates = np.radians([(p.lat, p.lon) for p in self._places])
+        lat_r, lon_r = np.radians(lat), np.radians(lon)
+        dx = (self._coordinates[:, 1] - lon_r) * np.cos((self._coordinates[:, 0] + lat_r) / 2)
+        dy = self._coordinates[:, 0] - lat_r
+        distances = np.hypot(dx, dy)
+        best = int(np.argmin(distances))
+        if distances[best] * _EARTH_RADIUS_KM > max_km:
+            return None
+        return self._places[best]
+
+
+# ============================================================================
+# RASTERS
+# ============================================================================
+
+class RiskRaster:
+    """Hazard and population-density layers on one regular lat/lon grid
+
+    A point maps to its cell with two subtractions and two divisions, so a
+    lookup is a constant-time array read regardless of the grid size.
+    """
+
+    def __init__(self, min_lat: float, min_lon: float, cell_deg: float, layers: Dict[str, np.ndarray]):
+        shapes = {layer.shape for layer in layers.values()}
+        if len(shapes) != 1:
+            raise ValueError(f"Raster layers must share one shape, got {shapes}")
+        self.min_lat = float(min_lat)
+        self.min_lon = float(min_lon)
+        self.cell_deg = float(cell_deg)
+        self.rows, self.cols = shapes.pop()
+        self.layers = {name: np.ascontiguousarray(layer, dtype=np.uint8) for name, layer in layers.items()}
+
+    def cell(self, lat: float, lon: float) -> Optional[Tuple[int, int]]:
+        row = int((lat - self.min_lat) // self.cell_deg)
+        col = int((lon - self.min_lon) // self.cell_deg)
+        if 0 <= row < self.rows and 0 <= col < self.cols:
+            return row, col
+        return None
+
+    def value(self, layer: str, cell: Tuple[int, int]) -> float:
+        """Layer value at a cell as 0.0..1.0 (0 for a missing layer)"""
+        grid = self.layers.get(layer)
+        if grid is None:
+            return 0.0
+        return float(grid[cell]) / _RASTER_SCALE
+
+    def hazard_index(self, hazard_type: str, cell: Tuple[int, int]) -> float:
+        """Hazard-specific layer when there is one, otherwise the all-hazards layer"""
+        layer = hazard_type if hazard_type in self.layers and hazard_type != DENSITY_LAYER else ALL_HAZARDS_LAYER
+        return self.value(layer, cell)
+
+    def save(self, path: str) -> None:
+        meta = {"min_lat": self.min_lat, "min_lon": self.min_lon, "cell_deg": self.cell_deg}
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(tmp_path, __meta__=np.array(json.dumps(meta)), **self.layers)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "RiskRaster":
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["__meta__"]))
+            layers = {name: data[name] for name in data.files if name != "__meta__"}
+        return cls(meta["min_lat"], meta["min_lon"], meta["cell_deg"], layers)
+
+    @classmethod
+    def from_points(cls, points: Iterable[Tuple[str, float, float, float]],
+                    bbox: Tuple[float, float, float, float], cell_deg: float) -> "RiskRaster":
+        """Grid point observations - each cell keeps the maximum value per layer
+
+        Hazard values are expected in 0..1. Population density is raw (people
+        per km2) and is log-scaled against the densest cell.
+        """
+        min_lat, min_lon, max_lat, max_lon = bbox
+        rows = int(np.ceil((max_lat - min_lat) / cell_deg))
+        cols = int(np.ceil((max_lon - min_lon) / cell_deg))
+        grids: Dict[str, np.ndarray] = {}
+        for layer, lat, lon, value in points:
+            row = int((lat - min_lat) // cell_deg)
+            col = int((lon - min_lon) // cell_deg)
+            if not (0 <= row < rows and 0 <= col < cols):
+                continue
+            grid = grids.setdefault(layer, np.zeros((rows, cols), dtype=np.float64))
+            grid[row, col] = max(grid[row, col], value)
+
+        layers = {}
+        for layer, grid in grids.items():
+            if layer == DENSITY_LAYER:
+                peak = np.log1p(grid.max())
+                grid = np.log1p(grid) / peak if peak > 0 else grid
+            layers[layer] = np.rint(np.clip(grid, 0.0, 1.0) * _RASTER_SCALE).astype(np.uint8)
+        if not layers:
+            layers[ALL_HAZARDS_LAYER] = np.zeros((rows, cols), dtype=np.uint8)
+        return cls(min_lat, min_lon, cell_deg, layers)
+
+
+# ============================================================================
+# SCORER
+# ============================================================================
+
+class GeoRiskScorer:
+    """Geocodes an area description and reads its hazard and density indexes"""
+
+    def __init__(self, gazetteer: Gazetteer, raster: Optional[RiskRaster] = None,
+                 precision: int = GEOHASH_PRECISION):
+        self.gazetteer = gazetteer
+        self.raster = raster
+        self.precision = precision
+
+    def locate(self, text: str) -> Optional[Place]:
+        coordinates = parse_coordinates(text)
+        if coordinates is not None:
+            return Place(text.strip(), *coordinates)
+        return self.gazetteer.lookup(text)
+
+    def region(self, lat: float, lon: float) -> Optional[str]:
+        """Broadcast region of a point - the nearest place's region column, else its name"""
+        place = self.gazetteer.nearest(lat, lon)
+        if place is None:
+            return None
+        return place.region or place.name
+
+    def assess(self, area: str, hazard_type: str) -> Optional[Dict[str, Any]]:
+        """Location and raster indexes for an assessment - None when the area can't be placed"""
+        place = self.locate(area)
+        if place is None:
+            return None
+        hazard_index = density_index = 0.0
+        cell = self.raster.cell(place.lat, place.lon) if self.raster is not None else None
+        if cell is not None:
+            hazard_index = self.raster.hazard_index(hazard_type, cell)
+            density_index = self.raster.value(DENSITY_LAYER, cell)
+        return {
+            "place": place.name,
+            "lat": place.lat,
+            "lon": place.lon,
+            "geohash": geohash_encode(place.lat, place.lon, self.precision),
+            "hazard_index": round(hazard_index, 4),
+            "density_index": round(density_index, 4),
+            "in_raster": cell is not None,
+        }
+
+
+def load_geo_scorer(data_dir: str = GEO_DATA_DIR) -> Optional[GeoRiskScorer]:
+    """Load the gazetteer and raster from disk - None when no gazetteer is deployed"""
+    gazetteer_path = os.path.join(data_dir, GAZETTEER_FILE)
+    raster_path = os.path.join(data_dir, RASTER_FILE)
+    if not os.path.exists(gazetteer_path):
+        log.info("🗺️ No gazetteer found - geospatial risk factors disabled", data_dir=data_dir)
+        return None
+    try:
+        gazetteer = Gazetteer.load_csv(gazetteer_path)
+        raster = RiskRaster.load(raster_path) if os.path.exists(raster_path) else None
+    except Exception as e:
+        log.warning("⚠️ Could not load geospatial data", data_dir=data_dir, error=str(e))
+        return None
+    log.info("🗺️ Geospatial risk data loaded", places=len(gazetteer),
+             raster=f"{raster.rows}x{raster.cols}" if raster is not None else None)
+    return GeoRiskScorer(gazetteer, raster)
+
+
+# ============================================================================
+# RASTER BUILD CLI
+# ============================================================================
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build-raster", help="Grid point observations into risk_raster.npz")
+    build.add_argument("points", help="CSV with layer,lat,lon,value columns")
+    build.add_argument("--bbox", required=True, help="min_lat,min_lon,max_lat,max_lon")
+    build.add_argument("--cell", type=float, default=0.05, help="Cell size in degrees")
+    build.add_argument("-o", "--output", default=os.path.join(GEO_DATA_DIR, RASTER_FILE))
+    args = parser.parse_args(argv)
+
+    with open(args.points, newline="", encoding="utf-8") as f:
+        points = [(row["layer"], float(row["lat"]), float(row["lon"]), float(row["value"]))
+                  for row in csv.DictReader(f)]
+    bbox = tuple(float(v) for v in args.bbox.split(","))
+    raster = RiskRaster.from_points(points, bbox, args.cell)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    raster.save(args.output)
+    print(f"{raster.rows}x{raster.cols} cells, layers {sorted(raster.layers)} -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import os
+import time
+import socket
+import secrets
+import hashlib
+import threading
+from datetime import datetime, timezone
+from typing import Optional
+
+# Crockford base32 - sortable, case-insensitive, no ambiguous I/L/O/U
+_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+_DECODE = {c: i for i, c in enumerate(_ALPHABET)}
+
+_RANDOM_BITS = 63
+_RANDOM_MAX = (1 << 64) - 1
+
+
+def _encode(value: int, length: int) -> str:
+    chars = []
+    for _ in range(length):
+        chars.append(_ALPHABET[value & 31])
+        value >>= 5
+    return "".join(reversed(chars))
+
+
+def _default_node() -> int:
+    """16 node bits from ID_NODE, or hashed from host, pid and a random salt"""
+    configured = os.getenv("ID_NODE")
+    if configured:
+        return int(configured) & 0xFFFF
+    seed = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(8)}".encode()
+    return int.from_bytes(hashlib.blake2b(seed, digest_size=2).digest(), "big")
+
+
+class IdGenerator:
+    """ULID-style IDs: 48-bit ms timestamp | 16-bit node | 64-bit per-ms counter
+
+    The counter starts at a random value each millisecond and increments for
+    every further ID in that millisecond, so IDs from one generator are strictly
+    increasing and IDs from different instances differ in node and random bits.
+    No coordination or Firestore round-trip is needed.
+    """
+
+    def __init__(self, node: Optional[int] = None):
+        self._fixed_node = node
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self.node = self._fixed_node if self._fixed_node is not None else _default_node()
+        self._last_ms = -1
+        self._counter = 0
+
+    def new_ulid(self) -> str:
+        with self._lock:
+            now_ms = time.time_ns() // 1_000_000
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                self._counter = secrets.randbits(_RANDOM_BITS)
+            else:
+                # Same millisecond, or the clock went backwards - stay monotonic
+                self._counter += 1
+                if self._counter > _RANDOM_MAX:
+                    self._last_ms += 1
+                    self._counter = secrets.randbits(_RANDOM_BITS)
+            value = (self._last_ms << 80) | (self.node << 64) | self._counter
+        return _encode(value, 26)
+
+    def new_id(self, prefix: str) -> str:
+        """Human-readable, sortable ID such as INC-20250101-01JGX3...; the date is UTC"""
+        ulid = self.new_ulid()
+        date = datetime.fromtimestamp(ulid_timestamp(ulid), timezone.utc).strftime('%Y%m%d')
+        return f"{prefix}-{date}-{ulid}"
+
+
+def stable_id(prefix: str, at: float, sequence: int) -> str:
+    """new_id-format ID fixed by (at, sequence) - the same inputs always give the same ID
+
+    For records keyed by an external event (a Telegram message's date and
+    message_id), so a redelivered event maps onto the record already written.
+    IDs sort by time, then by sequence within a millisecond.
+    """
+    value = (int(at * 1000) << 80) | (sequence & ((1 << 80) - 1))
+    date = datetime.fromtimestamp(at, timezone.utc).strftime('%Y%m%d')
+    return f"{prefix}-{date}-{_encode(value, 26)}"
+
+
+def ulid_timestamp(ulid: str) -> float:
+    """Seconds since the epoch encoded in a ULID"""
+    value = 0
+    for char in ulid[:10]:
+        value = (value << 5) | _DECODE[char]
+    return value / 1000.0
+
+
+def id_timestamp(generated_id: str) -> datetime:
+    """UTC creation time of an ID produced by new_id"""
+    return datetime.fromtimestamp(ulid_timestamp(generated_id.rsplit("-", 1)[-1]), timezone.utc)
+
+
+_default_generator = IdGenerator()
+
+# A forked worker must not share the parent's node bits and counter
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_default_generator._reset)
+
+
+def generate_id(prefix: str) -> str:
+    return _default_generator.new_id(prefix)
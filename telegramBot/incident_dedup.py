@@ -0,0 +1,205 @@
+import os
+import math
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from answer_cache import normalize_query
+from id_generator import generate_id
+
+# Reports of the same type within this window and radius are one incident
+INCIDENT_DEDUP_WINDOW_SECONDS = float(os.getenv("INCIDENT_DEDUP_WINDOW_SECONDS", "1800"))
+INCIDENT_DEDUP_RADIUS_KM = float(os.getenv("INCIDENT_DEDUP_RADIUS_KM", "1.0"))
+# Hard cap on clusters held in memory - the least recently matched go first
+INCIDENT_DEDUP_MAX_CLUSTERS = int(os.getenv("INCIDENT_DEDUP_MAX_CLUSTERS", "20000"))
+
+_EARTH_RADIUS_KM = 6371.0
+_KM_PER_DEGREE = 111.32
+
+
+def parameter_text(value: Any) -> str:
+    """Dialogflow parameter as text - structured values (@sys.location, lists) joined from their parts"""
+    if value is None:
+        return ''
+    if isinstance(value, dict):
+        return ' '.join(parameter_text(v) for v in value.values() if v)
+    if isinstance(value, (list, tuple)):
+        return ' '.join(parameter_text(v) for v in value if v)
+    return str(value)
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * _EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+class IncidentCluster:
+    __slots__ = ("cluster_id", "incident_type", "location_key", "lat", "lon", "first_incident_id",
+                 "first_seen", "last_seen", "report_count", "geocoded", "keys")
+
+    def __init__(self, incident_type: str, location_key: str, lat: Optional[float], lon: Optional[float],
+                 incident_id: str, at: float, cluster_id: Optional[str] = None):
+        self.cluster_id = cluster_id or generate_id("CLU")
+        self.incident_type = incident_type
+        self.location_key = location_key
+        self.lat = lat
+        self.lon = lon
+        self.first_incident_id = incident_id
+        self.first_seen = at
+        self.last_seen = at
+        self.report_count = 1
+        self.geocoded = 0 if lat is None else 1
+        self.keys: List[Tuple] = []
+
+
+class IncidentClusterIndex:
+    """Sliding-window index that groups bursty reports of the same incident
+
+    Clusters are keyed by (incident_type, time bucket, place), where the place
+    is the normalized location text and, once geocoded, a grid cell about one
+    radius wide. A new report only compares against clusters in its own and
+    the previous time bucket under its text key and 3x3 neighbouring cells,
+    with a haversine check against the cluster's centroid - so matching cost
+    doesn't grow with the number of clusters held.
+    """
+
+    def __init__(self, window_seconds: float = INCIDENT_DEDUP_WINDOW_SECONDS,
+                 radius_km: float = INCIDENT_DEDUP_RADIUS_KM,
+                 max_clusters: int = INCIDENT_DEDUP_MAX_CLUSTERS, clock=time.time):
+        self.window = window_seconds
+        self.radius_km = radius_km
+        self.cell_deg = radius_km / _KM_PER_DEGREE
+        self.max_clusters = max_clusters
+        self._clock = clock
+        self._clusters: "OrderedDict[str, IncidentCluster]" = OrderedDict()
+        self._buckets: Dict[Tuple, List[IncidentCluster]] = {}
+        self._lock = threading.Lock()
+        self.matched = 0
+        self.created = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._clusters)
+
+    def _place_keys(self, location_key: str, lat: Optional[float], lon: Optional[float], neighbours: bool):
+        # Geocoded clusters are also keyed by their text, so text-only reports of the same place find them
+        keys = [("text", location_key)]
+        if lat is not None and lon is not None:
+            row, col = int(lat // self.cell_deg), int(lon // self.cell_deg)
+            if neighbours:
+                keys.extend(("cell", row + dr, col + dc) for dr in (-1, 0, 1) for dc in (-1, 0, 1))
+            else:
+                keys.append(("cell", row, col))
+        return keys
+
+    def _matches(self, cluster: IncidentCluster, lat: Optional[float], lon: Optional[float], at: float) -> bool:
+        if at - cluster.last_seen > self.window:
+            return False
+        if lat is None or cluster.lat is None:
+            return True  # same normalized location text
+        return haversine_km(lat, lon, cluster.lat, cluster.lon) <= self.radius_km
+
+    def _best(self, incident_type: str, location_key: str, lat: Optional[float], lon: Optional[float],
+              at: float, bucket: int) -> Optional[IncidentCluster]:
+        # Caller holds the lock
+        best = None
+        for place in self._place_keys(location_key, lat, lon, neighbours=True):
+            for b in (bucket, bucket - 1):
+                for cluster in self._buckets.get((incident_type, b, *place), ()):
+                    if self._matches(cluster, lat, lon, at) and (best is None or cluster.last_seen > best.last_seen):
+                        best = cluster
+        return best
+
+    def find(self, incident_type: Any, location: Any, lat: Optional[float] = None, lon: Optional[float] = None,
+             at: Optional[float] = None) -> Optional[IncidentCluster]:
+        """The cluster add() would put a report in, without changing the index"""
+        at = self._clock() if at is None else at
+        with self._lock:
+            self._expire(at)
+            return self._best(normalize_query(parameter_text(incident_type)),
+                              normalize_query(parameter_text(location)), lat, lon, at, int(at // self.window))
+
+    def add(self, incident_id: str, incident_type: Any, location: Any,
+            lat: Optional[float] = None, lon: Optional[float] = None,
+            at: Optional[float] = None, cluster_id: Optional[str] = None) -> Tuple[IncidentCluster, bool]:
+        """Assign a report to a cluster - returns (cluster, is_new_cluster)
+
+        With cluster_id (from an earlier find(), once the report is stored)
+        the report joins that cluster, or starts it under that ID if it has
+        since left the index.
+        """
+        at = self._clock() if at is None else at
+        incident_type = normalize_query(parameter_text(incident_type))
+        location_key = normalize_query(parameter_text(location))
+        bucket = int(at // self.window)
+
+        with self._lock:
+            self._expire(at)
+            if cluster_id is None:
+                best = self._best(incident_type, location_key, lat, lon, at, bucket)
+            else:
+                best = self._clusters.get(cluster_id)
+
+            if best is not None:
+                best.last_seen = max(best.last_seen, at)
+                best.report_count += 1
+                if lat is not None and lon is not None:
+                    # Running centroid of the geocoded reports keeps the anchor on the incident
+                    if best.lat is None:
+                        best.lat, best.lon, best.geocoded = lat, lon, 1
+                    else:
+                        best.geocoded += 1
+                        best.lat += (lat - best.lat) / best.geocoded
+                        best.lon += (lon - best.lon) / best.geocoded
+                self._clusters.move_to_end(best.cluster_id)
+                self._index(best, bucket)
+                self.matched += 1
+                return best, False
+
+            cluster = IncidentCluster(incident_type, location_key, lat, lon, incident_id, at, cluster_id)
+            self._clusters[cluster.cluster_id] = cluster
+            self._index(cluster, bucket)
+            self.created += 1
+            while len(self._clusters) > self.max_clusters:
+                self._drop(self._clusters.popitem(last=False)[1])
+            return cluster, True
+
+    def _index(self, cluster: IncidentCluster, bucket: int) -> None:
+        # A long-running (or drifting) cluster is re-indexed under each new bucket and cell it is seen in
+        for place in self._place_keys(cluster.location_key, cluster.lat, cluster.lon, neighbours=False):
+            key = (cluster.incident_type, bucket, *place)
+            if key not in cluster.keys:
+                cluster.keys.append(key)
+                self._buckets.setdefault(key, []).append(cluster)
+
+    def _drop(self, cluster: IncidentCluster) -> None:
+        for key in cluster.keys:
+            members = self._buckets.get(key)
+            if members is not None:
+                members.remove(cluster)
+                if not members:
+                    del self._buckets[key]
+        self.evicted += 1
+
+    def _expire(self, now: float) -> None:
+        # Clusters are ordered by last match, so expired ones sit at the front
+        while self._clusters:
+            cluster = next(iter(self._clusters.values()))
+            if now - cluster.last_seen <= self.window:
+                break
+            self._clusters.popitem(last=False)
+            self._drop(cluster)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "clusters": len(self._clusters),
+                "buckets": len(self._buckets),
+                "matched": self.matched,
+                "created": self.created,
+                "evicted": self.evicted,
+            }
@@ -0,0 +1,221 @@
+"""Local intent classifier for free-text messages
+
+Hashed word/bigram/character-trigram counts into a multinomial logistic
+regression, so a message is labelled on the CPU in well under a millisecond:
+
+    emergency_report    -> report flow
+    risk_assessment     -> risk assessment flow
+    knowledge_question  -> knowledge search
+    chit_chat           -> plain acknowledgement
+
+Train from JSON lines of {"text": ..., "label": ...} and evaluate a held-out set:
+
+    python intent_classifier.py train intent_data/train.jsonl -o intent_model.npz
+    python intent_classifier.py evaluate intent_data/eval.jsonl --model intent_model.npz
+"""
+import os
+import sys
+import json
+import zlib
+import argparse
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+from keyword_matcher import tokenize
+from structured_logging import get_logger
+
+log = get_logger(__name__)
+
+INTENT_MODEL_PATH = os.getenv("INTENT_MODEL_PATH",
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_model.npz"))
+# Below this probability the message is treated as unclassified
+INTENT_MIN_CONFIDENCE = float(os.getenv("INTENT_MIN_CONFIDENCE", "0.5"))
+
+EMERGENCY_REPORT = "emergency_report"
+RISK_ASSESSMENT = "risk_assessment"
+KNOWLEDGE_QUESTION = "knowledge_question"
+CHIT_CHAT = "chit_chat"
+
+DEFAULT_HASH_BITS = 18
+
+
+class Intent(NamedTuple):
+    label: str
+    confidence: float
+
+
+# Fibonacci hashing multiplier for the packed character trigrams
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+_SPACE = ord(" ")
+
+
+def text_features(text: str, dim: int) -> np.ndarray:
+    """Hashed feature indexes: words, adjacent-word bigrams and character trigrams of each word"""
+    words = tokenize(text)
+    if not words:
+        return np.empty(0, dtype=np.intp)
+    # crc32 is stable across processes (unlike hash()); the seed keeps words and bigrams apart
+    mask = dim - 1
+    hashes = [zlib.crc32(w.encode("utf-8"), 1) & mask for w in words]
+    hashes += [zlib.crc32(f"{a} {b}".encode("utf-8"), 2) & mask for a, b in zip(words, words[1:])]
+
+    # Trigrams of "<word>" for all words at once: pack 3 bytes per position, drop the ones
+    # spanning a space, then take the top bits of a multiplicative hash
+    b = np.frombuffer(f"<{'> <'.join(words)}>".encode("utf-8"), dtype=np.uint8).astype(np.uint64)
+    codes = (b[:-2] << np.uint64(16)) | (b[1:-1] << np.uint64(8)) | b[2:]
+    codes = codes[(b[:-2] != _SPACE) & (b[1:-1] != _SPACE) & (b[2:] != _SPACE)]
+    trigrams = (codes * _GOLDEN) >> np.uint64(64 - (dim.bit_length() - 1))
+    return np.concatenate((np.array(hashes, dtype=np.intp), trigrams.astype(np.intp)))
+
+
+class IntentClassifier:
+    """Softmax regression over hashed features - each row of weights is one feature bucket"""
+
+    def __init__(self, weights: np.ndarray, bias: np.ndarray, labels: Sequence[str],
+                 min_confidence: float = INTENT_MIN_CONFIDENCE, meta: Optional[Dict] = None):
+        if weights.shape[0] & (weights.shape[0] - 1):
+            raise ValueError("Intent model: feature dimension must be a power of two")
+        self.weights = weights
+        self.bias = bias
+        self.labels = list(labels)
+        self.dim = weights.shape[0]
+        self.min_confidence = min_confidence
+        self.meta = meta or {}
+
+    def probabilities(self, text: str) -> np.ndarray:
+        idx = text_features(text, self.dim)
+        # Features are scaled by 1/sqrt(n) so short and long messages score alike
+        logits = self.bias + (self.weights[idx].sum(axis=0) / np.sqrt(len(idx)) if len(idx) else 0.0)
+        exp = np.exp(logits - logits.max())
+        return exp / exp.sum()
+
+    def predict(self, text: str) -> Intent:
+        probs = self.probabilities(text)
+        best = int(probs.argmax())
+        return Intent(self.labels[best], float(probs[best]))
+
+    def classify(self, text: str) -> Optional[str]:
+        """Label for text, or None when the model isn't confident enough to route on it"""
+        intent = self.predict(text)
+        return intent.label if intent.confidence >= self.min_confidence else None
+
+    @classmethod
+    def train(cls, texts: Sequence[str], labels: Sequence[str], hash_bits: int = DEFAULT_HASH_BITS,
+              epochs: int = 30, learning_rate: float = 0.5, l2: float = 1e-4, seed: int = 0) -> "IntentClassifier":
+        """Fit with plain SGD - only the rows a message touches are updated"""
+        label_names = sorted(set(labels))
+        codes = [label_names.index(label) for label in labels]
+        dim = 1 << hash_bits
+        features = [text_features(text, dim) for text in texts]
+        weights = np.zeros((dim, len(label_names)), dtype=np.float64)
+        bias = np.zeros(len(label_names), dtype=np.float64)
+
+        rng = np.random.default_rng(seed)
+        for epoch in range(epochs):
+            lr = learning_rate / (1.0 + epoch * 0.1)
+            for i in rng.permutation(len(texts)):
+                idx = features[i]
+                if not len(idx):
+                    continue
+                # A repeated index (a word used twice) is updated once - fine at this data size
+                scale = 1.0 / np.sqrt(len(idx))
+                logits = bias + weights[idx].sum(axis=0) * scale
+                probs = np.exp(logits - logits.max())
+                probs /= probs.sum()
+                probs[codes[i]] -= 1.0
+                weights[idx] -= lr * (scale * probs + l2 * weights[idx])
+                bias -= lr * probs
+
+        meta = {"hash_bits": hash_bits, "epochs": epochs, "examples": len(texts),
+                "label_counts": dict(Counter(labels))}
+        return cls(weights.astype(np.float32), bias.astype(np.float32), label_names, meta=meta)
+
+    def save(self, path: str) -> None:
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(tmp_path, weights=self.weights, bias=self.bias, labels=np.array(self.labels),
+                            __meta__=np.array(json.dumps(self.meta)))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, min_confidence: float = INTENT_MIN_CONFIDENCE) -> "IntentClassifier":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["weights"], data["bias"], [str(label) for label in data["labels"]],
+                       min_confidence=min_confidence, meta=json.loads(str(data["__meta__"])))
+
+
+def load_intent_classifier(path: str = INTENT_MODEL_PATH) -> Optional[IntentClassifier]:
+    """Load the model file - None when it isn't deployed or can't be read"""
+    if not os.path.exists(path):
+        log.info("🧠 No intent model found - messages routed by keywords only", path=path)
+        return None
+    try:
+        classifier = IntentClassifier.load(path)
+    except Exception as e:
+        log.warning("⚠️ Could not load intent model", path=path, error=str(e))
+        return None
+    log.info("🧠 Intent model loaded", labels=classifier.labels, dim=classifier.dim, meta=classifier.meta)
+    return classifier
+
+
+# ============================================================================
+# TRAINING / EVALUATION CLI
+# ============================================================================
+
+def read_examples(path: str):
+    with open(path, encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    return [row["text"] for row in rows], [row["label"] for row in rows]
+
+
+def evaluate(classifier: IntentClassifier, texts: Sequence[str], labels: Sequence[str]) -> Dict:
+    """Accuracy, per-label precision/recall and the confusion counts (gold -> predicted)"""
+    predicted = [classifier.predict(text).label for text in texts]
+    confusion = Counter(zip(labels, predicted))
+    per_label = {}
+    for label in classifier.labels:
+        tp = confusion[(label, label)]
+        n_pred = sum(count for (_, p), count in confusion.items() if p == label)
+        n_gold = sum(count for (g, _), count in confusion.items() if g == label)
+        per_label[label] = {"precision": round(tp / n_pred, 3) if n_pred else 0.0,
+                            "recall": round(tp / n_gold, 3) if n_gold else 0.0}
+    return {
+        "examples": len(texts),
+        "accuracy": round(sum(g == p for g, p in zip(labels, predicted)) / len(texts), 3),
+        "per_label": per_label,
+        "errors": {f"{g} -> {p}": n for (g, p), n in sorted(confusion.items()) if g != p},
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    train = sub.add_parser("train", help="Fit a model on labelled JSON lines")
+    train.add_argument("data")
+    train.add_argument("-o", "--output", default=INTENT_MODEL_PATH)
+    train.add_argument("--hash-bits", type=int, default=DEFAULT_HASH_BITS)
+    train.add_argument("--epochs", type=int, default=30)
+    train.add_argument("--eval", help="Held-out JSON lines to report on after training")
+
+    ev = sub.add_parser("evaluate", help="Score a model on labelled JSON lines")
+    ev.add_argument("data")
+    ev.add_argument("--model", default=INTENT_MODEL_PATH)
+    args = parser.parse_args(argv)
+
+    if args.command == "train":
+        texts, labels = read_examples(args.data)
+        classifier = IntentClassifier.train(texts, labels, hash_bits=args.hash_bits, epochs=args.epochs)
+        classifier.save(args.output)
+        print(f"{len(texts)} examples, labels {classifier.labels} -> {args.output}", file=sys.stderr)
+        print(json.dumps({"train": evaluate(classifier, texts, labels)}))
+        if args.eval:
+            print(json.dumps({"eval": evaluate(classifier, *read_examples(args.eval))}))
+    else:
+        classifier = IntentClassifier.load(args.model)
+        print(json.dumps(evaluate(classifier, *read_examples(args.data))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import os
+import re
+import json
+import unicodedata
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from structured_logging import get_logger
+
+log = get_logger(__name__)
+
+# Optional JSON file of extra keyword lists, e.g. {"emergency": ["wahala", ...], "risk": [...]}
+KEYWORDS_PATH = os.getenv("KEYWORDS_PATH", "")
+
+# Telegram free-text replies: emergency reply / risk assessment pointer
+EMERGENCY = "emergency"
+RISK = "risk"
+# Dialogflow CX: questions for the emergency/risk flows rather than knowledge search
+CX_FLOW = "cx_flow"
+GENERAL = "general"
+
+# Built-in lists - each call site asks only for its own categories, so the
+# vocabularies stay separate while sharing one compiled automaton. Within a
+# call, categories are checked in this order, so emergency wins over risk.
+DEFAULT_KEYWORDS = {
+    EMERGENCY: [
+        'emergency', 'urgent', 'help', 'disaster'
+    ],
+    RISK: [
+        'assess risk', 'risk assessment'
+    ],
+    CX_FLOW: [
+        'report', 'emergency', 'incident', 'urgent', 'help me report',
+        'assess risk', 'risk assessment', 'i need to report', 'there is an emergency'
+    ],
+}
+
+# The categories each caller matches against
+TELEGRAM_CATEGORIES = (EMERGENCY, RISK)
+CX_ROUTING_CATEGORIES = (CX_FLOW,)
+
+_WORD = re.compile(r"\w+")
+# Combining diacritical mark blocks left behind by NFKD (tones, dots below, accents)
+_MARKS = re.compile(r"[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]")
+# Letters that carry their mark in the code point itself (Hausa hooked letters, etc.)
+_FOLD = str.maketrans({'ɓ': 'b', 'ɗ': 'd', 'ƙ': 'k', 'ƴ': 'y', 'ß': 'ss', 'ø': 'o', 'đ': 'd', 'ł': 'l'})
+
+
+def tokenize(text: str) -> List[str]:
+    """Case- and diacritic-insensitive words of text (ọ̀ -> o, ɗ -> d)"""
+    text = (text or '').casefold()
+    if not text.isascii():
+        text = _MARKS.sub('', unicodedata.normalize('NFKD', text)).translate(_FOLD)
+    return _WORD.findall(text)
+
+
+class KeywordMatcher:
+    """Aho-Corasick automaton over words, compiled once for every keyword list
+
+    Running over word tokens rather than characters gives whole-word matches
+    for free ('help' no longer fires inside 'helpful') and one transition per
+    word of input, however many keywords or phrases are loaded.
+    """
+
+    def __init__(self, keywords: Dict[str, Iterable[str]]):
+        self.categories = list(keywords)
+        self._priority = {category: rank for rank, category in enumerate(self.categories)}
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # Per state: (category, keyword) pairs that end here, including via fail links
+        self._out: List[List[Tuple[str, str]]] = [[]]
+        self.size = 0
+
+        for category, words in keywords.items():
+            for keyword in words:
+                self._add(category, keyword)
+        self._build_fail_links()
+
+    def _add(self, category: str, keyword: str) -> None:
+        tokens = tokenize(keyword)
+        if not tokens:
+            return
+        state = 0
+        for token in tokens:
+            nxt = self._goto[state].get(token)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][token] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            state = nxt
+        self._out[state].append((category, ' '.join(tokens)))
+        self.size += 1
+
+    def _build_fail_links(self) -> None:
+        # Breadth-first from the depth-1 states, whose fail link is the root
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and token not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(token, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def find(self, text: str) -> List[Tuple[str, str]]:
+        """Every (category, keyword) occurrence in text, in order of where it ends"""
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        found = []
+        for token in tokenize(text):
+            while state and token not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token, 0)
+            if out[state]:
+                found.extend(out[state])
+        return found
+
+    def category(self, text: str, categories: Optional[Iterable[str]] = None) -> str:
+        """Highest-priority category with a keyword in text, GENERAL when none match
+
+        categories restricts the match to those lists, so a keyword that only
+        belongs to another caller's vocabulary is ignored.
+        """
+        found = [category for category, _ in self.find(text)]
+        if categories is not None:
+            wanted = set(categories)
+            found = [category for category in found if category in wanted]
+        if not found:
+            return GENERAL
+        return min(found, key=self._priority.__getitem__)
+
+
+def load_keywords(path: Optional[str] = KEYWORDS_PATH) -> Dict[str, List[str]]:
+    """Built-in lists merged with the extra lists in path (new categories rank after the built-in ones)"""
+    keywords = {category: list(words) for category, words in DEFAULT_KEYWORDS.items()}
+    if path:
+        with open(path, encoding='utf-8') as f:
+            for category, words in json.load(f).items():
+                keywords.setdefault(category, []).extend(words)
+    return keywords
+
+
+def build_keyword_matcher(path: Optional[str] = KEYWORDS_PATH) -> KeywordMatcher:
+    matcher = KeywordMatcher(load_keywords(path))
+    log.info("🔤 Keyword matcher compiled", keywords=matcher.size, categories=matcher.categories,
+             path=path or None)
+    return matcher
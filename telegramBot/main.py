@@ -1,25 +1,50 @@
 import functions_framework
-import requests
 import os
 from google.cloud import storage
 from google.cloud import firestore
 from google.cloud import discoveryengine_v1 as discoveryengine
 from typing import Dict, Any
 from datetime import datetime
-import logging
-import sys
-
-# Setup enhanced logging for Cloud Functions
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    stream=sys.stdout
-)
-logger = logging.getLogger(__name__)
+from functools import partial
+import asyncio
+import threading
+import time
+from google.api_core import exceptions as api_exceptions
+from google.api_core.retry import Retry, if_exception_type
+import metrics
+from structured_logging import setup_logging, get_logger, begin_request
+from telegram_client import TelegramClient
+from id_generator import generate_id, stable_id
+from dispatch import parse_json_body, classify_request, ROUTE_DIALOGFLOW, JSON_BACKEND
+from message_log import add_message_writes
+from risk_model import build_model_registry
+from geo_risk import load_geo_scorer, geohash_encode
+from risk_map import build_risk_map, severity_rank, RISK_MAP_TILE_PRECISION
+from risk_scoring import calculate_risk_score, get_risk_level
+from incident_dedup import IncidentClusterIndex, parameter_text
+from keyword_matcher import (build_keyword_matcher, EMERGENCY, RISK, GENERAL, TELEGRAM_CATEGORIES,
+                             CX_ROUTING_CATEGORIES)
+from intent_classifier import (load_intent_classifier, EMERGENCY_REPORT, RISK_ASSESSMENT,
+                               KNOWLEDGE_QUESTION)
+from webhook_router import WebhookRouter, fulfillment_response
+from profile_cache import ProfileCache, build_profile_write
+from update_dedup import build_update_deduplicator
+from answer_cache import build_answer_cache
+from semantic_cache import SemanticQueryIndex
+from media_storage import stream_to_blob
+from fanout import run_steps
+from outbound import (build_outbound_dispatcher, EMERGENCY as SEND_EMERGENCY, NORMAL as SEND_NORMAL,
+                      BROADCAST as SEND_BROADCAST)
+from broadcast import AudienceFilter, build_broadcast_runner
+from media_queue import (get_media_queue, build_media_job, drain_media_queue,
+                         decode_pubsub_push, is_last_push_attempt, MEDIA_WORKER_CONCURRENCY)
+
+# Setup structured JSON logging for Cloud Functions
+setup_logging()
+log = get_logger(__name__)
 
 # Add immediate logging to verify deployment
-print("🚀 FULL-FEATURED AREMS SYSTEM WITH KNOWLEDGE SEARCH - Production version!")
-logger.info("🚀 FULL-FEATURED AREMS SYSTEM WITH KNOWLEDGE SEARCH - Production version!")
+log.info("🚀 FULL-FEATURED AREMS SYSTEM WITH KNOWLEDGE SEARCH - Production version!")
 
 # Initialize Firestore and Storage clients
 try:
@@ -29,88 +54,122 @@ try:
     )
     storage_client = storage.Client(project='arems-project')
     bucket = storage_client.bucket('arems-user-upload')
-    print("✅ Successfully initialized Firebase and Storage clients")
-    logger.info("✅ Successfully initialized Firebase and Storage clients")
+    log.info("✅ Successfully initialized Firebase and Storage clients")
 except Exception as e:
-    print(f"❌ Failed to initialize clients: {str(e)}")
-    logger.error(f"❌ Failed to initialize clients: {str(e)}")
+    log.exception("❌ Failed to initialize clients", error=str(e))
     raise
 
 # Environment variables
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
-AI_SEARCH_ENGINE_ID = os.getenv("AI_SEARCH_ENGINE_ID") 
+AI_SEARCH_ENGINE_ID = os.getenv("AI_SEARCH_ENGINE_ID")
+# Hand Telegram updates to the asyncio chain in async_app
+WEBHOOK_ASYNC_MODE = os.getenv("WEBHOOK_ASYNC_MODE", "0") == "1"
+
+# Discovery Engine serving config and call policy - computed once per instance
+AI_SEARCH_SERVING_CONFIG = (
+    f"projects/arems-project/locations/global/collections/default_collection/engines/{AI_SEARCH_ENGINE_ID}/servingConfigs/default_config"
+    if AI_SEARCH_ENGINE_ID else None
+)
+AI_SEARCH_TIMEOUT = float(os.getenv("AI_SEARCH_TIMEOUT", "8"))
+AI_SEARCH_RETRY = Retry(
+    predicate=if_exception_type(api_exceptions.ServiceUnavailable,
+                                api_exceptions.DeadlineExceeded,
+                                api_exceptions.InternalServerError),
+    initial=float(os.getenv("AI_SEARCH_RETRY_INITIAL", "0.2")),
+    maximum=float(os.getenv("AI_SEARCH_RETRY_MAXIMUM", "2")),
+    multiplier=2.0,
+    # Under the fan-out reply step's deadline, so a knowledge answer never outlives it
+    timeout=float(os.getenv("AI_SEARCH_RETRY_DEADLINE", "12")),
+)
+
+# Process-wide Discovery Engine client - created on first use, then reused
+_search_client = None
+_search_client_lock = threading.Lock()
+
+# Dialogflow CX tag router - handlers register themselves with @dialogflow_router.register
+dialogflow_router = WebhookRouter("dialogflow")
+
+# Telegram redelivers updates it didn't get a timely 2xx for - each update_id is processed once
+update_deduplicator = build_update_deduplicator(db)
+
+def profiles_collection(client):
+    """User profiles on client - the sync db, or the async chain's AsyncClient"""
+    return client.collection('arems-profiles').document('users').collection('profiles')
+
+# Per-instance profile cache - one profile read per chat per TTL window
+profile_cache = ProfileCache(profiles_collection(db), db=db)
+
+# Versioned risk scoring tables - hot-reloaded from RISK_MODEL_SOURCE when the version changes
+risk_models = build_model_registry(db)
+
+# Gazetteer and hazard/density rasters from GEO_DATA_DIR - None when not deployed.
+# Loaded at import like the risk model, so no assessment is scored without geo factors
+geo_scorer = load_geo_scorer()
+
+# Incremental per-geohash risk map - updated in the same batch as each incident/assessment
+risk_map = build_risk_map(db)
+
+# Sliding-window index of recent incidents - repeat reports of one incident share a cluster
+incident_clusters = IncidentClusterIndex()
+
+# Telegram and Dialogflow keyword lists compiled into one matcher (plus KEYWORDS_PATH lists when set)
+keyword_matcher = build_keyword_matcher()
+
+# Local intent model for free-text Telegram messages - None when no model file is deployed
+intent_classifier = load_intent_classifier()
+
+# Knowledge answer cache - in-process LRU with an optional shared tier
+answer_cache = build_answer_cache(db)
+
+# Near-duplicate question index - maps rephrasings onto already answered questions
+# (loaded in the background so a large index doesn't delay cold starts)
+semantic_index = SemanticQueryIndex()
+threading.Thread(target=semantic_index.load, kwargs={'bucket': bucket}, daemon=True).start()
+
+# Shared keep-alive Telegram client - one connection pool per instance
+telegram_client = TelegramClient(TELEGRAM_TOKEN)
+
+# Outgoing messages go through one rate-limited, prioritised queue - None sends directly
+outbound = build_outbound_dispatcher(TELEGRAM_TOKEN)
+
+# Deferred media processing - None keeps media handling inline
+media_queue = get_media_queue()
 
 # Validate required environment variables
 if not AI_SEARCH_ENGINE_ID:
-    print("⚠️ AI_SEARCH_ENGINE_ID environment variable not set - knowledge search will be disabled")
-    logger.warning("⚠️ AI_SEARCH_ENGINE_ID environment variable not set - knowledge search will be disabled")
+    log.warning("⚠️ AI_SEARCH_ENGINE_ID environment variable not set - knowledge search will be disabled")
 
 @functions_framework.http
 def telegramWebhook(request):
     """CORRECTED: Main webhook handler - routes between Telegram and Dialogflow CX"""
-    
-    print("📥 NEW REQUEST RECEIVED!")
-    logger.info("📥 NEW REQUEST RECEIVED!")
-    
+
     try:
-        req_json = request.get_json(silent=True)
-        
-        # Enhanced logging for debugging
-        print(f"=== INCOMING REQUEST DEBUG ===")
-        print(f"Request Method: {request.method}")
-        print(f"User-Agent: {request.headers.get('User-Agent', 'No User-Agent')}")
-        print(f"Content-Type: {request.content_type}")
-        print(f"Parsed JSON payload: {req_json}")
-        
-        logger.info(f"=== INCOMING REQUEST DEBUG ===")
-        logger.info(f"Request Method: {request.method}")
-        logger.info(f"User-Agent: {request.headers.get('User-Agent', 'No User-Agent')}")
-        logger.info(f"Content-Type: {request.content_type}")
-        logger.info(f"Parsed JSON payload: {req_json}")
-        
-        # Enhanced Dialogflow CX detection
-        is_dialogflow_cx = False
-        user_agent = request.headers.get('User-Agent', '')
-        
-        print(f"🔍 Analyzing request type...")
-        logger.info(f"🔍 Analyzing request type...")
-        
-        # Check for Dialogflow CX specific fields
-        if req_json:
-            cx_indicators = ['fulfillmentInfo', 'sessionInfo', 'pageInfo', 'intentInfo']
-            found_indicators = [field for field in cx_indicators if field in req_json]
-            
-            print(f"Found Dialogflow CX indicators: {found_indicators}")
-            logger.info(f"Found Dialogflow CX indicators: {found_indicators}")
-            
-            if found_indicators:
-                is_dialogflow_cx = True
-                print("🤖 DIALOGFLOW CX REQUEST DETECTED - Routing to CX handler")
-                logger.info("🤖 DIALOGFLOW CX REQUEST DETECTED - Routing to CX handler")
-                return handle_dialogflow_cx_webhook(request)
-        
-        # Check User-Agent as backup
-        if 'Google-Dialogflow' in user_agent:
-            print("🤖 DIALOGFLOW CX DETECTED BY USER-AGENT - Routing to CX handler")
-            logger.info("🤖 DIALOGFLOW CX DETECTED BY USER-AGENT - Routing to CX handler")
-            is_dialogflow_cx = True
-            return handle_dialogflow_cx_webhook(request)
-            
-        if not is_dialogflow_cx:
-            print("📱 TELEGRAM REQUEST DETECTED - Routing to Telegram handler")
-            logger.info("📱 TELEGRAM REQUEST DETECTED - Routing to Telegram handler")
-            return handle_telegram_webhook(request)
-            
+        # Parse once, classify on headers first, hand the parsed body down
+        req_json = parse_json_body(request)
+        route, reason = classify_request(request.headers, req_json)
+
+        begin_request(route)
+        log.info("📥 NEW REQUEST RECEIVED",
+                 method=request.method,
+                 user_agent=request.headers.get('User-Agent') or 'No User-Agent',
+                 content_type=request.content_type,
+                 route_reason=reason)
+        log.debug("Parsed JSON payload", payload=req_json, json_backend=JSON_BACKEND)
+
+        if route == ROUTE_DIALOGFLOW:
+            log.info("🤖 DIALOGFLOW CX REQUEST DETECTED - Routing to CX handler")
+            return handle_dialogflow_cx_webhook(req_json)
+
+        log.info("📱 TELEGRAM REQUEST DETECTED - Routing to Telegram handler")
+        if WEBHOOK_ASYNC_MODE:
+            # Thin adapter - the update runs on the async chain's event loop
+            import async_app
+            return async_app.run_sync(async_app.handle_telegram_update(req_json))
+        return handle_telegram_webhook(req_json)
+
     except Exception as e:
-        error_msg = f"❌ CRITICAL ERROR in main webhook handler: {str(e)}"
-        print(error_msg)
-        logger.error(error_msg)
-        import traceback
-        traceback_msg = f"Full traceback: {traceback.format_exc()}"
-        print(traceback_msg)
-        logger.error(traceback_msg)
-        
+        log.exception("❌ CRITICAL ERROR in main webhook handler", error=str(e))
+
         # Return appropriate response format based on request type
         user_agent = request.headers.get('User-Agent', '')
         if 'Google-Dialogflow' in user_agent:
@@ -122,177 +181,163 @@ def telegramWebhook(request):
         else:
             return {"status": "error", "message": "Internal server error"}, 500
 
-def handle_dialogflow_cx_webhook(request):
+def handle_dialogflow_cx_webhook(req_json):
     """Handle Dialogflow CX webhook requests with enhanced debugging"""
-    
-    print("=== ENTERING DIALOGFLOW CX HANDLER ===")
-    logger.info("=== ENTERING DIALOGFLOW CX HANDLER ===")
-    
+
     try:
-        req_json = request.get_json(silent=True)
-        
-        print(f"📝 Processing Dialogflow CX request: {req_json}")
-        logger.info(f"📝 Processing Dialogflow CX request: {req_json}")
-        
+        req_json = req_json or {}
         session_info = req_json.get("sessionInfo", {})
         fulfillment_info = req_json.get("fulfillmentInfo", {})
         page_info = req_json.get("pageInfo", {})
         webhook_tag = fulfillment_info.get("tag", "")
-        
-        print(f"🏷️ Webhook Tag: '{webhook_tag}'")
-        print(f"📋 Session Info: {session_info}")
-        print(f"🔧 Fulfillment Info: {fulfillment_info}")
-        print(f"📄 Page Info: {page_info}")
-        print(f"⚙️ Parameters: {session_info.get('parameters', {})}")
-        
-        logger.info(f"🏷️ Webhook Tag: '{webhook_tag}'")
-        logger.info(f"📋 Session Info: {session_info}")
-        logger.info(f"🔧 Fulfillment Info: {fulfillment_info}")
-        logger.info(f"📄 Page Info: {page_info}")
-        logger.info(f"⚙️ Parameters: {session_info.get('parameters', {})}")
-
-        # Enhanced routing with knowledge search support
-        if webhook_tag == "emergency-submission":
-            print("🚨 Routing to EMERGENCY REPORT handler")
-            logger.info("🚨 Routing to EMERGENCY REPORT handler")
-            return handle_emergency_report(session_info, page_info, req_json)
-        elif webhook_tag == "risk-assessment":
-            print("📊 Routing to RISK ASSESSMENT handler")
-            logger.info("📊 Routing to RISK ASSESSMENT handler")  
-            return handle_risk_assessment(session_info, page_info, req_json)
-        elif webhook_tag == "knowledge-search":  # ⭐ NEW
-            print("📚 Routing to KNOWLEDGE SEARCH handler")
-            logger.info("📚 Routing to KNOWLEDGE SEARCH handler")
-            return handle_knowledge_search(session_info, page_info, req_json)
-        else:
-            # ⭐ ENHANCED: Auto-route general questions to knowledge search
-            text_input = req_json.get("text", "")
-            if text_input and not is_emergency_or_risk_query(text_input):
-                print(f"🔀 Auto-routing general question to knowledge search: {text_input}")
-                logger.info(f"🔀 Auto-routing general question to knowledge search: {text_input}")
-                # Create mock session info for knowledge search
-                mock_session = {"parameters": {"user_question": text_input}}
-                return handle_knowledge_search(mock_session, page_info, req_json)
-            
-            warning_msg = f"⚠️ Unknown webhook tag: '{webhook_tag}' - Expected 'emergency-submission', 'risk-assessment', or 'knowledge-search'"
-            print(warning_msg)
-            logger.warning(warning_msg)
-            
-            print("Returning generic success response")
-            logger.info("Returning generic success response")
-            return {
-                "fulfillmentResponse": {
-                    "messages": [{"text": {"text": ["Request processed successfully."]}}]
-                }
-            }
-            
+
+        log.info("📝 Processing Dialogflow CX request",
+                 webhook_tag=webhook_tag,
+                 page=page_info.get("displayName", ""),
+                 parameters=session_info.get('parameters', {}))
+        log.debug("Dialogflow CX request details",
+                  session_info=session_info,
+                  fulfillment_info=fulfillment_info,
+                  page_info=page_info)
+
+        # Tag handlers are registered on dialogflow_router below
+        return dialogflow_router.dispatch(req_json)
+
     except Exception as e:
-        error_msg = f"❌ ERROR in Dialogflow CX webhook: {str(e)}"
-        print(error_msg)
-        logger.error(error_msg)
-        import traceback
-        traceback_msg = f"Full traceback: {traceback.format_exc()}"
-        print(traceback_msg)
-        logger.error(traceback_msg)
+        log.exception("❌ ERROR in Dialogflow CX webhook", error=str(e))
         return {
             "fulfillmentResponse": {
                 "messages": [{"text": {"text": ["System error occurred. Please try again."]}}]
             }
         }
 
+@dialogflow_router.fallback
+def handle_untagged_request(session_info, page_info, full_request):
+    """Auto-route general questions to knowledge search, acknowledge anything else"""
+    text_input = full_request.get("text", "")
+    if text_input and not is_emergency_or_risk_query(text_input):
+        log.info("🔀 Auto-routing general question to knowledge search", text=text_input)
+        # Create mock session info for knowledge search
+        mock_session = {"parameters": {"user_question": text_input}}
+        return handle_knowledge_search(mock_session, page_info, full_request)
+
+    log.warning("⚠️ Unknown webhook tag - returning generic success response",
+                webhook_tag=full_request.get("fulfillmentInfo", {}).get("tag", ""),
+                expected=dialogflow_router.tags)
+    return fulfillment_response("Request processed successfully.")
+
 # ⭐ NEW: Knowledge Search Handler
+@dialogflow_router.register("knowledge-search")
 def handle_knowledge_search(session_info, page_info, full_request):
     """Handle knowledge searches using AI Applications search engine"""
-    
-    print("📚 === PROCESSING KNOWLEDGE SEARCH ===")
-    logger.info("📚 === PROCESSING KNOWLEDGE SEARCH ===")
-    
+
     try:
         # Extract user question from parameters or text input
         user_question = session_info.get('parameters', {}).get('user_question', '') or \
                        full_request.get('text', '') or \
                        full_request.get('queryInput', {}).get('text', {}).get('text', '')
-        
-        print(f"📝 Knowledge search query: {user_question}")
-        logger.info(f"📝 Knowledge search query: {user_question}")
-        
+
+        log.info("📚 Processing knowledge search", query=user_question)
+
         if not user_question:
             return {
                 "fulfillmentResponse": {
                     "messages": [{"text": {"text": ["Please ask me about emergency procedures, evacuation plans, or safety guidelines."]}}]
                 }
             }
-        
+
         # Check if AI search engine is configured
         if not AI_SEARCH_ENGINE_ID:
-            print("⚠️ AI Search Engine not configured")
-            logger.warning("⚠️ AI Search Engine not configured")
+            log.warning("⚠️ AI Search Engine not configured")
             return {
                 "fulfillmentResponse": {
                     "messages": [{"text": {"text": ["Knowledge search is currently unavailable. Please contact emergency services for immediate assistance."]}}]
                 }
             }
-        
+
+        # Serve repeated questions from the answer cache
+        cached = answer_cache.get(user_question)
+        if cached is None:
+            match = semantic_index.lookup(user_question)
+            if match is not None:
+                # The index carries the answer, so a match never misses on another cache
+                matched, similarity, cached = match
+                log.info("🧭 Near-duplicate question", matched=matched, similarity=round(similarity, 2))
+        if cached is not None:
+            log.info("⚡ Answer cache hit", query=user_question, cache=answer_cache.stats)
+            return build_knowledge_response(cached["answer"], cached["sources"], user_question)
+
         # Search the disaster knowledge base
         search_results = search_ai_applications_engine(user_question)
-        
+
         if search_results and hasattr(search_results, 'results') and search_results.results:
             # Format comprehensive response
             answer = format_knowledge_response(search_results)
-            
-            print(f"✅ Knowledge search successful, returning answer: {answer[:100]}...")
-            logger.info(f"✅ Knowledge search successful, returning answer: {answer[:100]}...")
-            
-            return {
-                "fulfillmentResponse": {
-                    "messages": [{"text": {"text": [answer]}}]
-                },
-                "sessionInfo": {
-                    "parameters": {
-                        "knowledge_sources": extract_sources(search_results),
-                        "last_search_query": user_question
-                    }
-                }
-            }
+            sources = extract_sources(search_results)
+            if answer is not FORMAT_ERROR_ANSWER:
+                answer_cache.set(user_question, answer, sources)
+                semantic_index.add(user_question, answer, sources)
+                if semantic_index.needs_save():
+                    # Merging with the shared copy takes GCS round trips - keep them off the reply
+                    semantic_index.save_in_background(bucket=bucket)
+
+            log.info("✅ Knowledge search successful", answer=answer[:100], sources=sources)
+
+            return build_knowledge_response(answer, sources, user_question)
         else:
-            print("❌ No search results found")
-            logger.info("❌ No search results found")
+            log.info("❌ No search results found", query=user_question)
             return {
                 "fulfillmentResponse": {
                     "messages": [{"text": {"text": ["I couldn't find specific information about that. Please try rephrasing your question or contact emergency services for immediate assistance."]}}]
                 }
             }
-            
+
     except Exception as e:
-        error_msg = f"❌ ERROR IN KNOWLEDGE SEARCH: {str(e)}"
-        print(error_msg)
-        logger.error(error_msg)
-        import traceback
-        traceback_msg = f"Full traceback: {traceback.format_exc()}"
-        print(traceback_msg)
-        logger.error(traceback_msg)
+        log.exception("❌ ERROR IN KNOWLEDGE SEARCH", error=str(e))
         return {
             "fulfillmentResponse": {
                 "messages": [{"text": {"text": ["Error searching knowledge base. Please try again."]}}]
             }
         }
 
+def build_knowledge_response(answer, sources, user_question):
+    """Build the Dialogflow CX response for a knowledge answer"""
+    return {
+        "fulfillmentResponse": {
+            "messages": [{"text": {"text": [answer]}}]
+        },
+        "sessionInfo": {
+            "parameters": {
+                "knowledge_sources": sources,
+                "last_search_query": user_question
+            }
+        }
+    }
+
+def get_search_client():
+    """Return the process-wide SearchServiceClient, creating it on first use"""
+    global _search_client
+    if _search_client is None:
+        with _search_client_lock:
+            if _search_client is None:
+                start = time.perf_counter()
+                _search_client = discoveryengine.SearchServiceClient()
+                elapsed = time.perf_counter() - start
+                metrics.observe('knowledge_search.client_construction_seconds', elapsed)
+
+                log.info("🔌 Created Discovery Engine client", elapsed_ms=round(elapsed * 1000, 1))
+    return _search_client
+
 # ⭐ NEW: AI Applications Search Function
 def search_ai_applications_engine(query):
     """Search the AI Applications disaster knowledge engine"""
-    
-    print(f"🔍 Searching AI Applications engine for: {query}")
-    logger.info(f"🔍 Searching AI Applications engine for: {query}")
-    
+
     try:
-        client = discoveryengine.SearchServiceClient()
-        
-        # Construct serving config path using environment variable
-        serving_config = f"projects/arems-project/locations/global/collections/default_collection/engines/{AI_SEARCH_ENGINE_ID}/servingConfigs/default_config"
-        
-        print(f"📡 Using serving config: {serving_config}")
-        logger.info(f"📡 Using serving config: {serving_config}")
-        
+        client = get_search_client()
+        serving_config = AI_SEARCH_SERVING_CONFIG
+
+        log.debug("🔍 Searching AI Applications engine", query=query, serving_config=serving_config)
+
         # Enhanced search request with 2025 features
         request = discoveryengine.SearchRequest(
             serving_config=serving_config,
@@ -316,40 +361,36 @@ def search_ai_applications_engine(query):
                 )
             )
         )
-        
-        print("🔄 Executing search request...")
-        logger.info("🔄 Executing search request...")
-        
-        response = client.search(request=request)
-        
-        print(f"✅ Search completed. Results count: {len(list(response.results)) if response.results else 0}")
-        logger.info(f"✅ Search completed. Results count: {len(list(response.results)) if response.results else 0}")
-        
+
+        start = time.perf_counter()
+        response = client.search(request=request, retry=AI_SEARCH_RETRY, timeout=AI_SEARCH_TIMEOUT)
+        elapsed = time.perf_counter() - start
+        metrics.observe('knowledge_search.search_seconds', elapsed)
+
+        log.info("✅ Search completed",
+                 elapsed_ms=round(elapsed * 1000, 1),
+                 results=lambda: len(list(response.results)) if response.results else 0)
+
         return response
-        
+
     except Exception as e:
-        print(f"❌ Error in AI Applications search: {str(e)}")
-        logger.error(f"❌ Error in AI Applications search: {str(e)}")
-        import traceback
-        print(f"Full traceback: {traceback.format_exc()}")
-        logger.error(f"Full traceback: {traceback.format_exc()}")
+        log.exception("❌ Error in AI Applications search", error=str(e))
         return None
 
+# Returned when search results can't be formatted - shown to the user but never cached
+FORMAT_ERROR_ANSWER = "Error formatting search results."
+
 # ⭐ NEW: Response Formatting Function
 def format_knowledge_response(search_results):
     """Format search results into comprehensive emergency response"""
-    
-    print("📝 Formatting knowledge response...")
-    logger.info("📝 Formatting knowledge response...")
-    
+
     try:
         # Use AI-generated summary if available
         if hasattr(search_results, 'summary') and search_results.summary and search_results.summary.summary_text:
-            print("✅ Using AI-generated summary")
-            logger.info("✅ Using AI-generated summary")
-            
+            log.debug("✅ Using AI-generated summary")
+
             answer = search_results.summary.summary_text
-            
+
             # Add source citations
             citations = []
             for i, result in enumerate(search_results.results[:3], 1):
@@ -359,17 +400,16 @@ def format_knowledge_response(search_results):
                     doc_name = doc_parts[-1] if doc_parts else "Document"
                     doc_name = doc_name.replace('.pdf', '').replace('-', ' ').replace('_', ' ').title()
                     citations.append(f"[{i}] {doc_name}")
-            
+
             if citations:
                 answer += f"\n\n📚 **Sources**: {', '.join(citations)}"
-            
+
             return answer
-            
+
         else:
             # Fallback to document excerpts
-            print("⚠️ No AI summary available, using document excerpts")
-            logger.info("⚠️ No AI summary available, using document excerpts")
-            
+            log.info("⚠️ No AI summary available, using document excerpts")
+
             responses = []
             for result in search_results.results[:2]:
                 if hasattr(result, 'document') and hasattr(result.document, 'derived_struct_data'):
@@ -377,21 +417,20 @@ def format_knowledge_response(search_results):
                     struct_data = result.document.derived_struct_data
                     if 'snippets' in struct_data and struct_data['snippets']:
                         responses.append(struct_data['snippets'][0]['snippet'])
-            
+
             if responses:
                 return ". ".join(responses)
             else:
                 return "No specific information found in the knowledge base."
-        
+
     except Exception as e:
-        print(f"❌ Error formatting response: {str(e)}")
-        logger.error(f"❌ Error formatting response: {str(e)}")
-        return "Error formatting search results."
+        log.exception("❌ Error formatting response", error=str(e))
+        return FORMAT_ERROR_ANSWER
 
 # ⭐ NEW: Extract Sources Function
 def extract_sources(search_results):
     """Extract source information from search results"""
-    
+
     try:
         sources = []
         for result in search_results.results[:3]:
@@ -401,68 +440,35 @@ def extract_sources(search_results):
                 sources.append(doc_name)
         return sources
     except Exception as e:
-        print(f"❌ Error extracting sources: {str(e)}")
-        logger.error(f"❌ Error extracting sources: {str(e)}")
+        log.error("❌ Error extracting sources", error=str(e))
         return []
 
 # ⭐ NEW: Query Classification Function
 def is_emergency_or_risk_query(text):
     """Check if query should route to emergency/risk assessment flows"""
-    
-    emergency_keywords = [
-        'report', 'emergency', 'incident', 'urgent', 'help me report',
-        'assess risk', 'risk assessment', 'i need to report', 'there is an emergency'
-    ]
-    text_lower = text.lower()
-    
-    # Check for exact emergency/risk assessment intent
-    for keyword in emergency_keywords:
-        if keyword in text_lower:
-            return True
-    
-    return False
+    return keyword_matcher.category(text, CX_ROUTING_CATEGORIES) != GENERAL
 
+@dialogflow_router.register("emergency-submission")
 def handle_emergency_report(session_info, page_info, full_request):
     """Handle emergency report webhook - ONLY save when form is complete"""
-    
-    print("🚨 === PROCESSING EMERGENCY REPORT ===")
-    logger.info("🚨 === PROCESSING EMERGENCY REPORT ===")
-    
+
     try:
         parameters = session_info.get('parameters', {})
-        
-        print(f"📝 Emergency report parameters received: {parameters}")
-        logger.info(f"📝 Emergency report parameters received: {parameters}")
-        
+
         # ⭐ CRITICAL FIX: Check if this is the final form submission
         # Look for form completion indicators
-        page_name = page_info.get("displayName", "")
-        form_info = page_info.get("formInfo", {})
-        
-        print(f"🔍 FORM COMPLETION CHECK:")
-        print(f"   - Page Name: {page_name}")
-        print(f"   - Form Info: {form_info}")
-        print(f"   - Has incident_type: {'incident_type' in parameters}")
-        print(f"   - Has location: {'location' in parameters}")
-        print(f"   - Has severity_level: {'severity_level' in parameters}")
-        print(f"   - Has contact_info: {'contact_info' in parameters}")
-        
-        logger.info(f"🔍 FORM COMPLETION CHECK:")
-        logger.info(f"   - Page Name: {page_name}")
-        logger.info(f"   - Form Info: {form_info}")
-        logger.info(f"   - Has incident_type: {'incident_type' in parameters}")
-        logger.info(f"   - Has location: {'location' in parameters}")
-        logger.info(f"   - Has severity_level: {'severity_level' in parameters}")
-        logger.info(f"   - Has contact_info: {'contact_info' in parameters}")
-        
+        log.info("🚨 Processing emergency report",
+                 page=page_info.get("displayName", ""),
+                 parameters=parameters)
+        log.debug("Emergency report form info", form_info=page_info.get("formInfo", {}))
+
         # ⭐ ONLY SAVE IF ALL REQUIRED PARAMETERS ARE PRESENT
         required_params = ['incident_type', 'location', 'severity_level', 'contact_info']
         missing_params = [param for param in required_params if not parameters.get(param)]
-        
+
         if missing_params:
-            print(f"⏳ FORM NOT COMPLETE - Missing parameters: {missing_params}")
-            logger.info(f"⏳ FORM NOT COMPLETE - Missing parameters: {missing_params}")
-            
+            log.info("⏳ FORM NOT COMPLETE", missing_params=missing_params)
+
             # Return success response WITHOUT saving data
             return {
                 "fulfillmentResponse": {
@@ -470,15 +476,21 @@ def handle_emergency_report(session_info, page_info, full_request):
                 }
             }
 
-        # ⭐ ALL PARAMETERS PRESENT - PROCEED WITH SAVING
-        print("✅ ALL PARAMETERS PRESENT - PROCEEDING WITH SAVE")
-        logger.info("✅ ALL PARAMETERS PRESENT - PROCEEDING WITH SAVE")
+        # Generate a unique, time-sortable incident ID
+        incident_id = generate_id("INC")
+
+        # Structured values (e.g. @sys.location) are matched on their text
+        incident_type_text = parameter_text(parameters.get('incident_type'))
+        location_text = parameter_text(parameters.get('location'))
 
-        # Generate incident ID
-        incident_id = f"INC-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
-        
-        print(f"🆔 Generated incident ID: {incident_id}")
-        logger.info(f"🆔 Generated incident ID: {incident_id}")
+        # Place the reported location for the risk map (None when it can't be placed)
+        place = geo_scorer.locate(location_text) if geo_scorer is not None else None
+        geo = {
+            'place': place.name,
+            'lat': place.lat,
+            'lon': place.lon,
+            'geohash': geohash_encode(place.lat, place.lon)
+        } if place is not None else None
 
         # Structure incident data
         incident_data = {
@@ -487,108 +499,109 @@ def handle_emergency_report(session_info, page_info, full_request):
             'location': parameters.get('location', ''),
             'severity_level': parameters.get('severity_level', ''),
             'contact_info': parameters.get('contact_info', ''),
+            'geo': geo,
             'timestamp': firestore.SERVER_TIMESTAMP,
             'source': 'dialogflow_cx'
         }
-        
-        print(f"📊 Structured incident data: {incident_data}")
-        logger.info(f"📊 Structured incident data: {incident_data}")
-        
-        print("💾 Attempting to save to Firestore...")
-        logger.info("💾 Attempting to save to Firestore...")
-
-        # Save to Firestore with detailed logging
-        firestore_path = f"arems-profiles/emergency-reports/incidents/{incident_id}"
-        print(f"📁 Firestore path: {firestore_path}")
-        logger.info(f"📁 Firestore path: {firestore_path}")
-        
-        incident_ref = (db.collection('arems-profiles')
-                       .document('emergency-reports')
-                       .collection('incidents')
-                       .document(incident_id))
-        
-        # Try the save operation
-        print("🔄 Executing Firestore set operation...")
-        logger.info("🔄 Executing Firestore set operation...")
-        
-        result = incident_ref.set(incident_data)
-        
-        print(f"✅ Firestore set operation completed: {result}")
-        logger.info(f"✅ Firestore set operation completed: {result}")
-        
-        success_msg = f"✅ SUCCESSFULLY SAVED EMERGENCY REPORT: {incident_id}"
-        print(success_msg)
-        logger.info(success_msg)
+
+        # Group repeat reports of the same incident (same type, nearby, within the window) -
+        # the index itself only changes once the report is stored
+        lat, lon = (geo['lat'], geo['lon']) if geo else (None, None)
+        match = incident_clusters.find(incident_type_text, location_text, lat, lon)
+        new_cluster = match is None
+        cluster_id = generate_id("CLU") if new_cluster else match.cluster_id
+        report_count = 1 if new_cluster else match.report_count + 1
+        incident_data['cluster_id'] = cluster_id
+        incident_data['cluster_report_count'] = report_count
+        if not new_cluster:
+            incident_data['duplicate_of'] = match.first_incident_id
+
+        # Save to Firestore together with the cluster and risk map updates
+        reports_ref = db.collection('arems-profiles').document('emergency-reports')
+        incident_ref = reports_ref.collection('incidents').document(incident_id)
+
+        batch = db.batch()
+        batch.set(incident_ref, incident_data)
+        cluster_data = {
+            'cluster_id': cluster_id,
+            'report_count': firestore.Increment(1),
+            'max_severity': firestore.Maximum(severity_rank(incident_data['severity_level'])),
+            'last_report_id': incident_id,
+            'last_seen': firestore.SERVER_TIMESTAMP
+        }
+        if new_cluster:
+            cluster_data.update({
+                'incident_type': incident_data['incident_type'],
+                'location': incident_data['location'],
+                'geo': geo,
+                'first_incident_id': incident_id,
+                'first_seen': firestore.SERVER_TIMESTAMP
+            })
+        batch.set(reports_ref.collection('clusters').document(cluster_id), cluster_data, merge=True)
+        # Only the first report of a cluster counts towards the map, so a burst doesn't inflate it
+        if geo and new_cluster:
+            risk_map.add_event(batch, geo['geohash'], 'incident', severity_rank(incident_data['severity_level']))
+        batch.commit()
+        incident_clusters.add(incident_id, incident_type_text, location_text, lat, lon, cluster_id=cluster_id)
+
+        log.info("✅ SUCCESSFULLY SAVED EMERGENCY REPORT",
+                 incident_id=incident_id,
+                 cluster_id=cluster_id,
+                 cluster_report_count=report_count,
+                 firestore_path=f"arems-profiles/emergency-reports/incidents/{incident_id}",
+                 incident=incident_data)
+
+        reply = f"Emergency report saved with ID: {incident_id}"
+        if not new_cluster:
+            reply += (f". It has been linked to {report_count - 1} earlier report(s)"
+                      f" of this incident ({cluster_id})")
 
         # Return response
         response = {
             "fulfillmentResponse": {
-                "messages": [{"text": {"text": [f"Emergency report saved with ID: {incident_id}"]}}]
+                "messages": [{"text": {"text": [reply]}}]
             },
             "sessionInfo": {
                 "parameters": {
-                    "incident_id": incident_id
+                    "incident_id": incident_id,
+                    "cluster_id": cluster_id,
+                    "cluster_report_count": report_count
                 }
             }
         }
-        
-        print(f"📤 Returning response: {response}")
-        logger.info(f"📤 Returning response: {response}")
-        
+
+        log.debug("📤 Returning response", response=response)
+
         return response
-        
+
     except Exception as e:
-        error_msg = f"❌ ERROR IN EMERGENCY REPORT: {str(e)}"
-        print(error_msg)
-        logger.error(error_msg)
-        import traceback
-        traceback_msg = f"Full traceback: {traceback.format_exc()}"
-        print(traceback_msg)
-        logger.error(traceback_msg)
+        log.exception("❌ ERROR IN EMERGENCY REPORT", error=str(e))
         return {
             "fulfillmentResponse": {
                 "messages": [{"text": {"text": ["Error processing emergency report. Please try again."]}}]
             }
         }
 
+@dialogflow_router.register("risk-assessment")
 def handle_risk_assessment(session_info, page_info, full_request):
     """Handle risk assessment webhook - ONLY save when form is complete"""
-    
-    print("📊 === PROCESSING RISK ASSESSMENT ===")
-    logger.info("📊 === PROCESSING RISK ASSESSMENT ===")
-    
+
     try:
         parameters = session_info.get('parameters', {})
-        
-        print(f"📝 Risk assessment parameters received: {parameters}")
-        logger.info(f"📝 Risk assessment parameters received: {parameters}")
-        
+
         # ⭐ CRITICAL FIX: Check if this is the final form submission
-        page_name = page_info.get("displayName", "")
-        form_info = page_info.get("formInfo", {})
-        
-        print(f"🔍 RISK FORM COMPLETION CHECK:")
-        print(f"   - Page Name: {page_name}")
-        print(f"   - Form Info: {form_info}")
-        print(f"   - Has hazard_type: {'hazard_type' in parameters}")
-        print(f"   - Has affected_area: {'affected_area' in parameters}")
-        print(f"   - Has population_at_risk: {'population_at_risk' in parameters}")
-        
-        logger.info(f"🔍 RISK FORM COMPLETION CHECK:")
-        logger.info(f"   - Page Name: {page_name}")
-        logger.info(f"   - Form Info: {form_info}")
-        logger.info(f"   - Has hazard_type: {'hazard_type' in parameters}")
-        logger.info(f"   - Has affected_area: {'affected_area' in parameters}")
-        logger.info(f"   - Has population_at_risk: {'population_at_risk' in parameters}")
+        log.info("📊 Processing risk assessment",
+                 page=page_info.get("displayName", ""),
+                 parameters=parameters)
+        log.debug("Risk assessment form info", form_info=page_info.get("formInfo", {}))
 
         # ⭐ ONLY SAVE IF ALL REQUIRED PARAMETERS ARE PRESENT
         required_params = ['hazard_type', 'affected_area', 'population_at_risk']
         missing_params = [param for param in required_params if not parameters.get(param)]
-        
+
         if missing_params:
-            print(f"⏳ RISK FORM NOT COMPLETE - Missing parameters: {missing_params}")
-            logger.info(f"⏳ RISK FORM NOT COMPLETE - Missing parameters: {missing_params}")
-            
+            log.info("⏳ RISK FORM NOT COMPLETE", missing_params=missing_params)
+
             # Return success response WITHOUT saving data
             return {
                 "fulfillmentResponse": {
@@ -596,30 +609,22 @@ def handle_risk_assessment(session_info, page_info, full_request):
                 }
             }
 
-        # ⭐ ALL PARAMETERS PRESENT - PROCEED WITH SAVING
-        print("✅ ALL RISK PARAMETERS PRESENT - PROCEEDING WITH SAVE")
-        logger.info("✅ ALL RISK PARAMETERS PRESENT - PROCEEDING WITH SAVE")
-
-        # Generate assessment ID
-        assessment_id = f"RISK-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
-        
-        print(f"🆔 Generated assessment ID: {assessment_id}")
-        logger.info(f"🆔 Generated assessment ID: {assessment_id}")
+        # Generate a unique, time-sortable assessment ID
+        assessment_id = generate_id("RISK")
 
         # Extract parameters
         hazard_type = parameters.get('hazard_type', '')
         affected_area = parameters.get('affected_area', '')
         population_at_risk = parameters.get('population_at_risk', '')
-        
-        print(f"🔍 Extracted parameters - Hazard: {hazard_type}, Area: {affected_area}, Population: {population_at_risk}")
-        logger.info(f"🔍 Extracted parameters - Hazard: {hazard_type}, Area: {affected_area}, Population: {population_at_risk}")
 
-        # Calculate risk score and level
-        risk_score = calculate_risk_score(hazard_type, population_at_risk)
-        risk_level = get_risk_level(risk_score)
-        
-        print(f"🧮 Calculated risk - Score: {risk_score}, Level: {risk_level}")
-        logger.info(f"🧮 Calculated risk - Score: {risk_score}, Level: {risk_level}")
+        # Place the affected area on the hazard/density rasters (None when it can't be placed)
+        geo = (geo_scorer.assess(parameter_text(affected_area), parameter_text(hazard_type))
+               if geo_scorer is not None else None)
+
+        # Calculate risk score and level with one snapshot of the active model
+        risk_model = risk_models.get()
+        risk_score = calculate_risk_score(hazard_type, population_at_risk, risk_model, geo)
+        risk_level = get_risk_level(risk_score, risk_model)
 
         # Structure assessment data
         assessment_data = {
@@ -629,38 +634,30 @@ def handle_risk_assessment(session_info, page_info, full_request):
             'population_at_risk': population_at_risk,
             'risk_score': risk_score,
             'risk_level': risk_level,
+            'model_version': risk_model.version,
+            'geo': geo,
             'timestamp': firestore.SERVER_TIMESTAMP,
             'source': 'dialogflow_cx'
         }
 
-        print(f"📊 Structured assessment data: {assessment_data}")
-        logger.info(f"📊 Structured assessment data: {assessment_data}")
-        
-        print("💾 Attempting to save to Firestore...")
-        logger.info("💾 Attempting to save to Firestore...")
-
-        # Save to Firestore with detailed logging
-        firestore_path = f"arems-profiles/risk-assessments/assessments/{assessment_id}"
-        print(f"📁 Firestore path: {firestore_path}")
-        logger.info(f"📁 Firestore path: {firestore_path}")
-        
+        # Save to Firestore
         assessment_ref = (db.collection('arems-profiles')
                          .document('risk-assessments')
                          .collection('assessments')
                          .document(assessment_id))
-        
-        # Try the save operation
-        print("🔄 Executing Firestore set operation...")
-        logger.info("🔄 Executing Firestore set operation...")
-        
-        result = assessment_ref.set(assessment_data)
-        
-        print(f"✅ Firestore set operation completed: {result}")
-        logger.info(f"✅ Firestore set operation completed: {result}")
-        
-        success_msg = f"✅ SUCCESSFULLY SAVED RISK ASSESSMENT: {assessment_id}"
-        print(success_msg)
-        logger.info(success_msg)
+
+        batch = db.batch()
+        batch.set(assessment_ref, assessment_data)
+        if geo:
+            risk_map.add_event(batch, geo['geohash'], 'assessment', severity_rank(risk_level))
+        batch.commit()
+
+        log.info("✅ SUCCESSFULLY SAVED RISK ASSESSMENT",
+                 assessment_id=assessment_id,
+                 firestore_path=f"arems-profiles/risk-assessments/assessments/{assessment_id}",
+                 risk_score=risk_score,
+                 risk_level=risk_level,
+                 assessment=assessment_data)
 
         # Return response with session parameters for routing
         response = {
@@ -675,378 +672,646 @@ def handle_risk_assessment(session_info, page_info, full_request):
                 }
             }
         }
-        
-        print(f"📤 Returning response: {response}")
-        logger.info(f"📤 Returning response: {response}")
-        
+
+        log.debug("📤 Returning response", response=response)
+
         return response
-        
+
     except Exception as e:
-        error_msg = f"❌ ERROR IN RISK ASSESSMENT: {str(e)}"
-        print(error_msg)
-        logger.error(error_msg)
-        import traceback
-        traceback_msg = f"Full traceback: {traceback.format_exc()}"
-        print(traceback_msg)
-        logger.error(traceback_msg)
+        log.exception("❌ ERROR IN RISK ASSESSMENT", error=str(e))
         return {
             "fulfillmentResponse": {
                 "messages": [{"text": {"text": ["Error processing risk assessment. Please try again."]}}]
             }
         }
 
-def calculate_risk_score(hazard_type, population_risk):
-    """Calculate risk score based on hazard and population"""
-    
-    print(f"🧮 Calculating risk score for: {hazard_type} + {population_risk}")
-    logger.info(f"🧮 Calculating risk score for: {hazard_type} + {population_risk}")
-    
-    base_scores = {
-        'natural_disaster': 40,
-        'technological_hazard': 30,
-        'biological_hazard': 35,
-        'security_threat': 25
-    }
-
-    population_multipliers = {
-        'vulnerable_groups': 1.5,
-        'general_population': 1.0,
-        'emergency_workers': 1.2,
-        'tourists': 1.3
-    }
-
-    base_score = base_scores.get(hazard_type, 20)
-    multiplier = population_multipliers.get(population_risk, 1.0)
-    final_score = int(base_score * multiplier)
-    
-    calculation_msg = f"Risk calculation: {hazard_type} ({base_score}) × {population_risk} ({multiplier}) = {final_score}"
-    print(calculation_msg)
-    logger.info(calculation_msg)
-    
-    return min(final_score, 100)
-
-def get_risk_level(score):
-    """Convert risk score to risk level"""
-    if score >= 80:
-        level = 'CRITICAL'
-    elif score >= 60:
-        level = 'HIGH'
-    elif score >= 40:
-        level = 'MEDIUM'
-    else:
-        level = 'LOW'
-    
-    print(f"🏆 Risk level for score {score}: {level}")
-    logger.info(f"🏆 Risk level for score {score}: {level}")
-    
-    return level
-
 # ============================================================================
 # TELEGRAM WEBHOOK HANDLER - Full Featured (Same as before)
 # ============================================================================
 
-def handle_telegram_webhook(request):
+def handle_telegram_webhook(req_json):
     """Handle Telegram webhook requests with full functionality"""
-    
-    print("📱 === PROCESSING TELEGRAM WEBHOOK ===")
-    logger.info("📱 === PROCESSING TELEGRAM WEBHOOK ===")
-    
+
     try:
-        req_json = request.get_json(silent=True)
         if not req_json:
-            print("❌ No JSON data in Telegram request")
-            logger.error("❌ No JSON data in Telegram request")
+            log.error("❌ No JSON data in Telegram request")
             return {"status": "error", "message": "No data"}, 400
 
-        print(f"📱 Telegram request data: {req_json}")
-        logger.info(f"📱 Telegram request data: {req_json}")
+        # Redeliveries stop here, before any storage or network work
+        update_id = req_json.get("update_id")
+        if not update_deduplicator.claim(update_id):
+            log.info("🔁 Duplicate Telegram update skipped", update_id=update_id)
+            return {"status": "success", "message": "Duplicate update ignored"}
 
         # Handle different types of Telegram updates
         if "message" in req_json:
-            return handle_telegram_message(req_json["message"])
+            result = handle_telegram_message(req_json["message"])
+            if isinstance(result, tuple):
+                # Error response - let Telegram's retry of this update through
+                update_deduplicator.release(update_id)
+            elif update_id is not None and update_deduplicator.markers_ref is not None:
+                # The dedup marker create() is this update's first Firestore RPC
+                result["firestore_rpcs"] = result.get("firestore_rpcs", 0) + 1
+            return result
         else:
-            print("📱 Non-message Telegram update received")
-            logger.info("📱 Non-message Telegram update received")
+            log.info("📱 Non-message Telegram update received", update_keys=list(req_json))
             return {"status": "success", "message": "Update processed"}
 
     except Exception as e:
-        error_msg = f"❌ ERROR in Telegram webhook: {str(e)}"
-        print(error_msg)
-        logger.error(error_msg)
-        import traceback
-        traceback_msg = f"Full traceback: {traceback.format_exc()}"
-        print(traceback_msg)
-        logger.error(traceback_msg)
+        log.exception("❌ ERROR in Telegram webhook", error=str(e))
+        if req_json:
+            update_deduplicator.release(req_json.get("update_id"))
         return {"status": "error", "message": str(e)}, 500
 
+def route_text_intent(text):
+    """Intent label for a free-text message (None = no route)
+
+    An emergency keyword always wins - the model is never allowed to turn a
+    distress message into chit-chat or a knowledge question. Otherwise the
+    local model decides when confident, then the remaining keywords.
+    """
+    category = keyword_matcher.category(text, TELEGRAM_CATEGORIES)
+    if category == EMERGENCY:
+        return EMERGENCY_REPORT
+    if intent_classifier is not None:
+        with metrics.timed("telegram.intent_seconds"):
+            intent = intent_classifier.predict(text)
+        log.info("🧠 Intent classified", label=intent.label, confidence=round(intent.confidence, 3))
+        if intent.confidence >= intent_classifier.min_confidence:
+            return intent.label
+    if category == RISK:
+        return RISK_ASSESSMENT
+    return None
+
+def build_text_reply(text, intent=None):
+    """Reply for a free-text message - routed locally, no Dialogflow round-trip for the common intents"""
+    intent = intent or route_text_intent(text)
+    if intent == EMERGENCY_REPORT:
+        return f"🚨 Emergency detected! For immediate assistance, please use our Dialogflow CX emergency system or call emergency services. You said: {text}"
+    if intent == RISK_ASSESSMENT:
+        return "📊 To assess the risk for your area, please use our Dialogflow CX risk assessment flow and tell us the hazard, affected area and population at risk."
+    if intent == KNOWLEDGE_QUESTION:
+        result = handle_knowledge_search({"parameters": {"user_question": text}}, {}, {})
+        return result["fulfillmentResponse"]["messages"][0]["text"]["text"][0]
+    return f"Message received: {text}"
+
 def handle_telegram_message(message):
     """Process individual Telegram messages"""
-    
+
     try:
         chat_id = message["chat"]["id"]
         text = message.get("text", "")
         username = message["from"].get("username", "unknown")
-        
-        print(f"📱 Telegram message from {username} ({chat_id}): {text}")
-        logger.info(f"📱 Telegram message from {username} ({chat_id}): {text}")
-        
-        # Update user profile
-        update_user_profile(chat_id, {
-            'username': username,
-            'last_active': firestore.SERVER_TIMESTAMP
-        })
-        
-        # Store message
-        store_message(chat_id, text)
-        
-        # Handle different types of content
-        if "document" in message:
-            print(f"📄 Document received from {username}")
-            logger.info(f"📄 Document received from {username}")
-            handle_document(message["document"], chat_id)
-        elif "photo" in message:
-            print(f"📸 Photo received from {username}")
-            logger.info(f"📸 Photo received from {username}")
-            handle_photo(message["photo"], chat_id)
+
+        log.info("📱 Telegram message", username=username, chat_id=chat_id, text=text)
+
+        # The update is only acknowledged once its message is stored - that step never waits on the pool
+        return finish_message_steps(run_steps(build_message_steps(message, chat_id, text, username),
+                                              inline="store_message"))
+
+    except Exception as e:
+        log.exception("❌ ERROR processing Telegram message", error=str(e))
+        return {"status": "error", "message": str(e)}, 500
+
+def build_message_steps(message, chat_id, text, username, store=None, send=None, text_reply=None):
+    """The independent steps for one message - shared by the sync and async webhook chains
+
+    store, send and text_reply default to store_message, send_message and
+    send_text_reply; the async chain passes their coroutine versions, which
+    run_steps_async awaits on the loop instead of handing to a thread.
+    """
+    store = store or store_message
+    send = send or send_message
+    text_reply = text_reply or send_text_reply
+    # Store message and update user profile in a single batched write - independent of
+    # the reply/media work, so the two run side by side
+    profile_updates = {
+        'username': username,
+        'last_active': firestore.SERVER_TIMESTAMP
+    }
+    if "location" in message:
+        # Shared locations place the user for area broadcasts
+        lat, lon = message["location"]["latitude"], message["location"]["longitude"]
+        profile_updates['geohash'] = geohash_encode(lat, lon)
+        region = geo_scorer.region(lat, lon) if geo_scorer is not None else None
+        if region:
+            # Matched by AudienceFilter regions
+            profile_updates['region'] = region
+        profile_updates['location_updated_at'] = firestore.SERVER_TIMESTAMP
+    # Keyed by the Telegram message, so a redelivered update can't store it twice
+    message_id = (stable_id('MSG', message["date"], message["message_id"])
+                  if "date" in message and "message_id" in message else None)
+    steps = {"store_message": partial(store, chat_id, text, profile_updates, message_id)}
+
+    # Handle different types of content
+    if media_queue is not None and ("document" in message or "photo" in message):
+        # Acknowledge Telegram now - the media worker does getFile/download/upload
+        kind = "document" if "document" in message else "photo"
+        job = build_media_job(kind, chat_id, username, message[kind])
+        steps["media_queue"] = lambda: media_queue.put(job)
+    elif "document" in message:
+        log.info("📄 Document received", username=username)
+        steps["document"] = lambda: handle_document(message["document"], chat_id, username)
+    elif "photo" in message:
+        log.info("📸 Photo received", username=username)
+        steps["photo"] = lambda: handle_photo(message["photo"], chat_id, username)
+    elif "location" in message:
+        steps["reply"] = partial(send, chat_id, "📍 Location saved - you'll get emergency alerts for your area.")
+    else:
+        steps["reply"] = partial(text_reply, chat_id, text)
+    return steps
+
+def finish_message_steps(fan_out):
+    """Webhook response for a message's finished steps"""
+    rpc_count = fan_out.results.get("store_message", 0)
+    if "media_queue" in fan_out.results:
+        log.info("📥 Queued media job", job_id=fan_out.results["media_queue"])
+
+    if "store_message" not in fan_out.results:
+        # The message (and its profile update) isn't stored - fail so Telegram redelivers the update
+        log.error("❌ Message not stored", step_errors=fan_out.errors)
+        return {"status": "error", "message": "Message not stored", "step_errors": fan_out.errors}, 500
+
+    if "media_queue" in fan_out.errors:
+        # Nothing else holds the media job - fail so Telegram redelivers the update
+        log.error("❌ Could not queue media job", step_errors=fan_out.errors)
+        return {"status": "error", "message": "Media job not queued", "step_errors": fan_out.errors}, 500
+
+    result = {"status": "success", "message": "Telegram message processed", "firestore_rpcs": rpc_count}
+    if fan_out.errors:
+        log.warning("⚠️ Telegram message steps failed", step_errors=fan_out.errors)
+        result["step_errors"] = fan_out.errors
+    log.info("✅ Telegram message processed successfully", firestore_rpcs=rpc_count,
+             critical_path_ms=round(fan_out.elapsed * 1000, 1))
+    return result
+
+# ============================================================================
+# MEDIA WORKER - Drains deferred document/photo jobs
+# ============================================================================
+
+@functions_framework.http
+def mediaWorker(request):
+    """Process queued media jobs - Pub/Sub push delivery or a drain of the local queue"""
+
+    begin_request('media-worker')
+    try:
+        pushed = decode_pubsub_push(request.get_json(silent=True))
+        if pushed:
+            message_id, job, attempt = pushed
+            log.info("📦 Processing pushed media job", message_id=message_id, kind=job.get("kind"), attempt=attempt)
+            try:
+                process_media_job(job)
+            except Exception as e:
+                if not is_last_push_attempt(job, attempt):
+                    raise
+                # Out of attempts - ack so Pub/Sub stops redelivering, and tell the user
+                log.exception("❌ Media job given up", message_id=message_id, attempt=attempt, error=str(e))
+                give_up_media_job(job, e)
+                return {"status": "success", "processed": 0, "failed": 1}
+            return {"status": "success", "processed": 1}
+
+        if media_queue is None:
+            return {"status": "error", "message": "Media queue is not enabled"}, 400
+
+        stats = drain_media_queue(media_queue, process_media_job, MEDIA_WORKER_CONCURRENCY,
+                                  on_give_up=give_up_media_job)
+        return {"status": "success", **stats}
+
+    except Exception as e:
+        log.exception("❌ ERROR in media worker", error=str(e))
+        # Non-2xx makes Pub/Sub redeliver the job
+        return {"status": "error", "message": str(e)}, 500
+
+def process_media_job(job):
+    """Run a queued media job through the same upload steps as inline processing
+
+    A permanent MediaProcessingError (the file will never be handed over)
+    sends its reply and returns, so the job is acked. Other failures
+    propagate so the queue can retry the job (fail() locally, a non-2xx push
+    response on Pub/Sub) instead of acking a missing upload.
+    """
+    try:
+        if job["kind"] == "document":
+            store_document(job["payload"], job["chat_id"], job.get("username"))
+        elif job["kind"] == "photo":
+            store_photo(job["payload"], job["chat_id"], job.get("username"))
         else:
-            # Handle text message - you can add emergency keyword detection here
-            if any(keyword in text.lower() for keyword in ['emergency', 'urgent', 'help', 'disaster']):
-                response_text = f"🚨 Emergency detected! For immediate assistance, please use our Dialogflow CX emergency system or call emergency services. You said: {text}"
-            else:
-                response_text = f"Message received: {text}"
-            
-            send_message(chat_id, response_text)
-        
-        print("✅ Telegram message processed successfully")
-        logger.info("✅ Telegram message processed successfully")
-        return {"status": "success", "message": "Telegram message processed"}
-        
+            raise ValueError(f"Unknown media job kind: {job['kind']}")
+    except MediaProcessingError as e:
+        if not e.permanent:
+            raise
+        log.warning("⚠️ Media job failed permanently", kind=job["kind"], chat_id=job["chat_id"], error=str(e))
+        send_message(job["chat_id"], e.reply)
+
+def give_up_media_job(job, error):
+    """Tell the user about a queued document or photo whose last attempt failed"""
+    if isinstance(error, MediaProcessingError):
+        send_message(job["chat_id"], error.reply)
+    else:
+        send_message(job["chat_id"], f"Sorry, there was an error processing your {job.get('kind', 'file')}.")
+
+# ============================================================================
+# BROADCAST WORKER - Area alerts to stored profiles
+# ============================================================================
+
+_broadcast_runner = None
+_broadcast_lock = threading.Lock()
+
+def get_broadcast_runner():
+    """Broadcasts share the reply dispatcher's limits (own dispatcher when OUTBOUND_DISPATCH=0)"""
+    global _broadcast_runner
+    with _broadcast_lock:
+        if _broadcast_runner is None:
+            dispatcher = outbound or build_outbound_dispatcher(TELEGRAM_TOKEN, enabled=True)
+            _broadcast_runner = build_broadcast_runner(db, dispatcher)
+    return _broadcast_runner
+
+@functions_framework.http
+def broadcastWorker(request):
+    """Start, resume or inspect a broadcast - call again with broadcast_id while status is "running"
+
+    POST {"text": ..., "regions": [...], "cells": [...], "priority": "emergency"} starts one
+    (or {"text": ..., "all": true} to reach every profile - an empty audience is rejected),
+    POST {"broadcast_id": ...} resumes it, GET ?broadcast_id=... returns its progress.
+    Deploy without public access - anyone who can call this can message every user.
+    """
+
+    begin_request('broadcast')
+    try:
+        runner = get_broadcast_runner()
+        if request.method == 'GET':
+            job = runner.status(request.args.get('broadcast_id', ''))
+            if job is None:
+                return {"status": "error", "message": "Unknown broadcast"}, 404
+            return {"status": "success", "broadcast": job}
+
+        body = request.get_json(silent=True) or {}
+        broadcast_id = body.get('broadcast_id')
+        if not broadcast_id:
+            text = body.get('text', '')
+            if not text.strip():
+                return {"status": "error", "message": "text is required"}, 400
+            priority = SEND_EMERGENCY if body.get('priority') == 'emergency' else SEND_BROADCAST
+            try:
+                audience = AudienceFilter(body.get('regions') or (), body.get('cells') or (),
+                                          everyone=body.get('all') is True)
+            except ValueError as e:
+                return {"status": "error", "message": str(e)}, 400
+            broadcast_id = runner.create(text, audience, priority)
+
+        report = runner.run(broadcast_id)
+        return {"status": "success", "broadcast": report}
+
+    except KeyError as e:
+        return {"status": "error", "message": str(e)}, 404
     except Exception as e:
-        error_msg = f"❌ ERROR processing Telegram message: {str(e)}"
-        print(error_msg)
-        logger.error(error_msg)
+        log.exception("❌ ERROR in broadcast worker", error=str(e))
         return {"status": "error", "message": str(e)}, 500
 
+@functions_framework.http
+def riskMap(request):
+    """Serve one risk map tile - ?tile=<geohash prefix> or ?lat=..&lon=.."""
+
+    begin_request('risk-map')
+    try:
+        tile = request.args.get('tile', '')
+        if not tile and request.args.get('lat') and request.args.get('lon'):
+            tile = geohash_encode(float(request.args['lat']), float(request.args['lon']),
+                                  RISK_MAP_TILE_PRECISION)
+        if not tile:
+            return {"status": "error", "message": "Pass tile or lat and lon"}, 400
+
+        with metrics.timed('risk_map.read_seconds'):
+            return {"status": "success", **risk_map.read_tile(tile)}
+
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}, 400
+    except Exception as e:
+        log.exception("❌ ERROR serving risk map", error=str(e))
+        return {"status": "error", "message": "Internal server error"}, 500
+
 # ============================================================================
 # TELEGRAM UTILITY FUNCTIONS - Same as before
 # ============================================================================
 
-def get_file_path(file_id):
-    """Get file path from Telegram for download"""
+def is_permanent_telegram_status(status_code):
+    """A Bot API error retrying won't fix - bad or expired file_id, file is too big
+
+    401 (bad token) and 429 are left retryable, as are 5xx.
+    """
+    return 400 <= status_code < 500 and status_code not in (401, 408, 429)
+
+def get_file_path(file_id, kind="file"):
+    """Get file path from Telegram for download - raises MediaProcessingError when there isn't one"""
     try:
-        url = f"{TELEGRAM_API_URL}/getFile"
-        response = requests.get(url, params={"file_id": file_id})
+        response = telegram_client.get_file(file_id)
+    except Exception as e:
+        log.error("❌ Error getting file path", error=str(e))
+        raise MediaProcessingError(f"getFile failed for {kind} {file_id}: {e}",
+                                   f"Sorry, couldn't access your {kind}. Please try again.") from e
+
+    try:
+        body = response.json()
+    except ValueError:
+        body = {}
+    if response.status_code == 200 and (body.get("result") or {}).get("file_path"):
+        file_path = body["result"]["file_path"]
+        log.debug("📁 Retrieved file path", file_path=file_path)
+        return file_path
+
+    description = body.get("description", "")
+    log.error("❌ Failed to get file path", status_code=response.status_code, description=description)
+    if "too big" in description:
+        reply = f"Sorry, your {kind} is too large - bots can only download files up to 20 MB."
+    else:
+        reply = f"Sorry, couldn't access your {kind}. Please try again."
+    # A 200 without a path won't get one on retry either
+    permanent = response.status_code == 200 or is_permanent_telegram_status(response.status_code)
+    raise MediaProcessingError(f"No file path for {kind} {file_id}: {response.status_code} {description}",
+                               reply, permanent=permanent)
+
+def send_text_reply(chat_id, text):
+    """Reply to a free-text message - emergency reports jump the outbound queue"""
+    intent = route_text_intent(text)
+    send_message(chat_id, build_text_reply(text, intent),
+                 priority=SEND_EMERGENCY if intent == EMERGENCY_REPORT else SEND_NORMAL)
+
+async def send_text_reply_async(chat_id, text, client=None):
+    """send_text_reply() for the async chain - only a knowledge search (sync client) takes a thread"""
+    intent = route_text_intent(text)
+    if intent == KNOWLEDGE_QUESTION:
+        reply = await asyncio.to_thread(build_text_reply, text, intent)
+    else:
+        reply = build_text_reply(text, intent)
+    await send_message_async(chat_id, reply, priority=SEND_EMERGENCY if intent == EMERGENCY_REPORT else SEND_NORMAL,
+                             client=client)
+
+def _log_send_outcome(message):
+    # Failures are already logged by the dispatcher
+    if message.ok:
+        log.info("✅ Message sent", chat_id=message.chat_id, text=message.text[:50], attempts=message.attempts)
+
+def send_message(chat_id, text, priority=SEND_NORMAL):
+    """Send message to Telegram user - queued behind the outbound rate limits when the dispatcher is on
+
+    A queued message is left to the dispatcher and its outcome logged when it
+    goes out, so a reply never holds its caller while the per-chat bucket refills.
+    """
+    try:
+        if outbound is not None:
+            outbound.enqueue(chat_id, text, priority, on_done=_log_send_outcome)
+            return
+
+        response = telegram_client.send_message(chat_id, text)
         if response.status_code == 200:
-            file_path = response.json()["result"]["file_path"]
-            print(f"📁 Retrieved file path: {file_path}")
-            logger.info(f"📁 Retrieved file path: {file_path}")
-            return file_path
+            log.info("✅ Message sent", chat_id=chat_id, text=text[:50])
         else:
-            print(f"❌ Failed to get file path: {response.status_code}")
-            logger.error(f"❌ Failed to get file path: {response.status_code}")
-            return None
+            log.error("❌ Failed to send message", chat_id=chat_id, status_code=response.status_code)
     except Exception as e:
-        print(f"❌ Error getting file path: {str(e)}")
-        logger.error(f"❌ Error getting file path: {str(e)}")
-        return None
+        log.error("❌ Error sending message", chat_id=chat_id, error=str(e))
 
-def send_message(chat_id, text):
-    """Send message to Telegram user"""
+async def send_message_async(chat_id, text, priority=SEND_NORMAL, client=None):
+    """send_message() for the async chain - straight out through client (AsyncTelegramClient) when the dispatcher is off"""
+    if outbound is not None:
+        # Enqueueing never blocks
+        send_message(chat_id, text, priority)
+        return
+    if client is None:
+        await asyncio.to_thread(send_message, chat_id, text, priority)
+        return
     try:
-        url = f"{TELEGRAM_API_URL}/sendMessage"
-        response = requests.post(url, json={"chat_id": chat_id, "text": text})
+        response = await client.send_message(chat_id, text)
         if response.status_code == 200:
-            print(f"✅ Message sent to {chat_id}: {text[:50]}...")
-            logger.info(f"✅ Message sent to {chat_id}: {text[:50]}...")
+            log.info("✅ Message sent", chat_id=chat_id, text=text[:50])
         else:
-            print(f"❌ Failed to send message: {response.status_code}")
-            logger.error(f"❌ Failed to send message: {response.status_code}")
+            log.error("❌ Failed to send message", chat_id=chat_id, status_code=response.status_code)
     except Exception as e:
-        print(f"❌ Error sending message: {str(e)}")
-        logger.error(f"❌ Error sending message: {str(e)}")
+        log.error("❌ Error sending message", chat_id=chat_id, error=str(e))
+
+class MediaProcessingError(Exception):
+    """A document or photo couldn't be fetched from Telegram - carries the reply for the user
+
+    permanent means retrying the job can't help, so it is acked with the reply.
+    """
+
+    def __init__(self, message, reply, permanent=False):
+        super().__init__(message)
+        self.reply = reply
+        self.permanent = permanent
+
+def store_document(document, chat_id, username=None):
+    """Download a document into Cloud Storage - raises on any failure so queued jobs are retried"""
+    file_id = document.get("file_id")
+    file_name = document.get("file_name", "unnamed_file")
+    file_size = document.get("file_size", 0)
+
+    log.info("📄 Processing document", file_name=file_name, file_size=file_size)
+
+    file_path = get_file_path(file_id, "document")
+
+    response = telegram_client.download_file(file_path, stream=True)
+    if response.status_code != 200:
+        response.close()
+        log.error("❌ Failed to download document", status_code=response.status_code)
+        raise MediaProcessingError(f"Document download returned {response.status_code}",
+                                   "Sorry, couldn't process your document. Please try again.",
+                                   permanent=is_permanent_telegram_status(response.status_code))
+
+    # Get user info for organized storage (already known from the update)
+    if username is None:
+        username = profile_cache.get(chat_id).get('username') or 'unknown'
+
+    # Create organized storage path
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    date = datetime.now().strftime('%B_%d_%Y')
+    storage_path = f"users/{chat_id}_{username}/{date}/documents/{timestamp}_{file_name}"
 
-def handle_document(document, chat_id):
+    # Stream straight into Cloud Storage
+    blob = bucket.blob(storage_path)
+    with response:
+        upload_info = stream_to_blob(response, blob, file_name, expected_size=file_size)
+
+    log.info("✅ Document uploaded", storage_path=storage_path,
+             size=upload_info['size'], content_type=upload_info['content_type'])
+
+    send_message(chat_id, f"📄 Document '{file_name}' received and stored successfully!")
+
+def store_photo(photos, chat_id, username=None):
+    """Download the largest photo into Cloud Storage - raises on any failure so queued jobs are retried"""
+    # Get user profile info (already known from the update)
+    if username is None:
+        username = profile_cache.get(chat_id).get('username') or 'unknown'
+
+    # Process the highest resolution photo
+    photo = photos[-1]
+    file_id = photo.get("file_id")
+    file_size = photo.get("file_size", 0)
+
+    log.info("📸 Processing photo", username=username, file_size=file_size)
+
+    file_path = get_file_path(file_id, "photo")
+
+    response = telegram_client.download_file(file_path, stream=True)
+    if response.status_code != 200:
+        response.close()
+        log.error("❌ Failed to download photo", status_code=response.status_code)
+        raise MediaProcessingError(f"Photo download returned {response.status_code}",
+                                   "Sorry, couldn't process your photo. Please try again.",
+                                   permanent=is_permanent_telegram_status(response.status_code))
+
+    # Create organized storage path
+    timestamp = datetime.now().strftime('%I-%M-%p')
+    date = datetime.now().strftime('%B_%d_%Y')
+    storage_path = f"users/{chat_id}_{username}/{date}/photos/photo_{timestamp}.jpg"
+
+    # Stream straight into Cloud Storage
+    blob = bucket.blob(storage_path)
+    with response:
+        upload_info = stream_to_blob(response, blob, storage_path, expected_size=file_size)
+
+    log.info("✅ Photo uploaded", username=username, chat_id=chat_id,
+             storage_path=storage_path, size=upload_info['size'])
+
+    send_message(chat_id, "📸 Photo received and stored successfully!")
+
+def handle_document(document, chat_id, username=None):
     """Handle document uploads to Cloud Storage"""
     try:
-        file_id = document.get("file_id")
-        file_name = document.get("file_name", "unnamed_file")
-        file_size = document.get("file_size", 0)
-        
-        print(f"📄 Processing document: {file_name} ({file_size} bytes)")
-        logger.info(f"📄 Processing document: {file_name} ({file_size} bytes)")
-        
-        file_path = get_file_path(file_id)
-        if file_path:
-            file_url = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_path}"
-            response = requests.get(file_url)
-            
-            if response.status_code == 200:
-                # Get user info for organized storage
-                user_ref = db.collection('arems-profiles').document('users').collection('profiles').document(str(chat_id))
-                user_doc = user_ref.get()
-                username = user_doc.get('username') if user_doc.exists else 'unknown'
-                
-                # Create organized storage path
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                date = datetime.now().strftime('%B_%d_%Y')
-                storage_path = f"users/{chat_id}_{username}/{date}/documents/{timestamp}_{file_name}"
-                
-                # Upload to Cloud Storage
-                blob = bucket.blob(storage_path)
-                blob.upload_from_string(response.content)
-                
-                print(f"✅ Document uploaded: {storage_path}")
-                logger.info(f"✅ Document uploaded: {storage_path}")
-                
-                send_message(chat_id, f"📄 Document '{file_name}' received and stored successfully!")
-            else:
-                print(f"❌ Failed to download document: {response.status_code}")
-                logger.error(f"❌ Failed to download document: {response.status_code}")
-                send_message(chat_id, "Sorry, couldn't process your document. Please try again.")
-        else:
-            send_message(chat_id, "Sorry, couldn't access your document. Please try again.")
-            
+        store_document(document, chat_id, username)
+    except MediaProcessingError as e:
+        send_message(chat_id, e.reply)
     except Exception as e:
-        print(f"❌ Error handling document: {str(e)}")
-        logger.error(f"❌ Error handling document: {str(e)}")
+        log.exception("❌ Error handling document", error=str(e))
         send_message(chat_id, "Sorry, there was an error processing your document.")
 
-def handle_photo(photos, chat_id):
+def handle_photo(photos, chat_id, username=None):
     """Handle photo uploads to Cloud Storage with enhanced error handling"""
     try:
-        # Get user profile info
-        user_ref = db.collection('arems-profiles').document('users').collection('profiles').document(str(chat_id))
-        user_doc = user_ref.get()
-        username = user_doc.get('username') if user_doc.exists else 'unknown'
-        
-        # Process the highest resolution photo
-        photo = photos[-1]
-        file_id = photo.get("file_id")
-        file_size = photo.get("file_size", 0)
-        
-        print(f"📸 Processing photo from {username}: {file_size} bytes")
-        logger.info(f"📸 Processing photo from {username}: {file_size} bytes")
-        
-        file_path = get_file_path(file_id)
-        
-        if file_path:
-            file_url = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_path}"
-            response = requests.get(file_url)
-            
-            if response.status_code == 200:
-                # Create organized storage path
-                timestamp = datetime.now().strftime('%I-%M-%p')
-                date = datetime.now().strftime('%B_%d_%Y')
-                storage_path = f"users/{chat_id}_{username}/{date}/photos/photo_{timestamp}.jpg"
-                
-                # Upload to Cloud Storage
-                blob = bucket.blob(storage_path)
-                blob.upload_from_string(response.content)
-                
-                print(f"✅ Photo uploaded: {storage_path}")
-                logger.info(f"✅ Successfully uploaded photo from {username} ({chat_id}) to {storage_path}")
-                
-                send_message(chat_id, "📸 Photo received and stored successfully!")
-            else:
-                print(f"❌ Failed to download photo: {response.status_code}")
-                logger.error(f"❌ Failed to download photo: {response.status_code}")
-                send_message(chat_id, "Sorry, couldn't process your photo. Please try again.")
-        else:
-            send_message(chat_id, "Sorry, couldn't access your photo. Please try again.")
-            
+        store_photo(photos, chat_id, username)
+    except MediaProcessingError as e:
+        send_message(chat_id, e.reply)
     except Exception as e:
-        print(f"❌ Error handling photo: {str(e)}")
-        logger.error(f"❌ Error handling photo: {str(e)}")
+        log.exception("❌ Error handling photo", error=str(e))
         send_message(chat_id, "Sorry, there was an error processing your photo.")
 
-def update_user_profile(chat_id: str, updates: Dict[Any, Any]) -> None:
-    """Update user profile in Firestore with enhanced error handling"""
-    try:
-        user_ref = db.collection('arems-profiles').document('users').collection('profiles').document(str(chat_id))
-        user_doc = user_ref.get()
-        
-        if not user_doc.exists:
-            # Create new user profile
-            base_profile = {
-                'chat_id': chat_id,
-                'first_interaction': firestore.SERVER_TIMESTAMP,
-                'last_active': firestore.SERVER_TIMESTAMP,
-                'total_messages': 1,
-                'profile_created': datetime.now(),
-                'profile_status': 'new'
-            }
-            base_profile.update(updates)
-            user_ref.set(base_profile)
-            
-            print(f"👤 Created new user profile for {chat_id}")
-            logger.info(f"👤 Created new user profile for {chat_id}")
-        else:
-            # Update existing user profile
-            updates['last_active'] = firestore.SERVER_TIMESTAMP
-            if 'total_messages' in updates:
-                updates['total_messages'] = firestore.Increment(updates['total_messages'])
-            user_ref.update(updates)
-            
-            print(f"👤 Updated user profile for {chat_id}")
-            logger.info(f"👤 Updated user profile for {chat_id}")
-            
-    except Exception as e:
-        print(f"❌ Error updating user profile for {chat_id}: {str(e)}")
-        logger.error(f"❌ Error updating user profile for {chat_id}: {str(e)}")
+class _MessageWrite:
+    """One message's store batch on client - shared by store_message and store_message_async
+
+    Holds the message doc, daily summary shard increment and (coalesced)
+    profile create/update; the caller commits batch, then calls stored() or
+    restore() depending on how that went.
+    """
+
+    def __init__(self, client, chat_id, text, user_doc, profile_updates=None, message_id=None):
+        self.chat_id = chat_id
+        self.text = text
+        self.user_doc = user_doc
+        updates = dict(profile_updates or {})
+        self.username = updates.get('username') or \
+                        (user_doc.get('username') if user_doc.exists else 'unknown')
+
+        self.batch = client.batch()
+
+        # Append-only message doc plus a sharded daily summary increment
+        written = add_message_writes(client, self.batch, f"{chat_id}_{self.username}", text, self.username,
+                                     message_id=message_id)
 
-def store_message(chat_id, text):
-    """Store message in Firestore with organized structure"""
-    try:
-        # Get user info
-        user_ref = db.collection('arems-profiles').document('users').collection('profiles').document(str(chat_id))
-        user_doc = user_ref.get()
-        username = user_doc.get('username') if user_doc.exists else 'unknown'
-        
-        # Create organized message storage
-        chat_id_with_username = f"{chat_id}_{username}"
-        current_date = datetime.now()
-        date_str = current_date.strftime('%B_%d_%Y')
-        time_str = current_date.strftime('%I:%M %p')
-        
-        # Store individual message
-        messages_ref = (db.collection('arems-profiles')
-                       .document('messages')
-                       .collection(chat_id_with_username)
-                       .document(date_str)
-                       .collection('daily_messages'))
-        
-        messages_ref.document(f"{time_str}_message").set({
-            'text': text,
-            'timestamp': firestore.SERVER_TIMESTAMP,
-            'type': 'user_message',
-            'username': username
-        })
-        
-        # Update daily summary
-        daily_summary_ref = (db.collection('arems-profiles')
-                           .document('messages')
-                           .collection(chat_id_with_username)
-                           .document(date_str))
-        
-        daily_summary_ref.set({
-            'date': current_date,
-            'message_count': firestore.Increment(1),
-            'last_message_time': firestore.SERVER_TIMESTAMP,
-            'username': username
-        }, merge=True)
-        
         # Update user profile with latest message info
-        update_user_profile(chat_id, {
+        updates.update({
             'total_messages': 1,
             'last_message': text,
-            'last_message_time': f"{date_str} at {time_str}"
+            'last_message_time': f"{written['date_str']} at {written['sent_at'].strftime('%H:%M:%S')} UTC"
         })
-        
-        print(f"💬 Message stored for {username}: {text[:50]}...")
-        logger.info(f"💬 Message stored for {username}: {text[:50]}...")
-        
+        self.updates = updates
+        self.coalesced = profile_cache.coalesce(chat_id, user_doc, updates)
+        self.profile_data, self.is_new = None, False
+        if self.coalesced is not None:
+            self.profile_data, self.is_new = build_profile_write(chat_id, user_doc, self.coalesced)
+            user_ref = profiles_collection(client).document(str(chat_id))
+            if self.is_new:
+                self.batch.set(user_ref, self.profile_data)
+            else:
+                self.batch.update(user_ref, self.profile_data)
+
+    def stored(self, rpc_count):
+        if self.coalesced is not None:
+            profile_cache.write_through(self.chat_id, self.user_doc, self.profile_data, created=self.is_new)
+        log.info("💬 Message stored", username=self.username, text=self.text[:50],
+                 new_profile=self.is_new, profile_deferred=self.coalesced is None,
+                 firestore_rpcs=rpc_count, profile_cache=profile_cache.stats)
+
+    def restore(self):
+        """The batch didn't commit - hand the deferred profile fields it carried back"""
+        if self.coalesced is not None:
+            profile_cache.restore(self.chat_id, self.coalesced, self.updates)
+
+def store_message(chat_id, text, profile_updates: Dict[Any, Any] = None, message_id: str = None) -> int:
+    """Store message, daily summary and profile update as one batched write
+
+    The profile comes from profile_cache (at most one read) and the message doc,
+    daily summary shard increment and profile create/update are committed
+    together in a single WriteBatch.
+    Message docs have unique time-ordered IDs, so bursts are never overwritten.
+    With a message_id derived from the Telegram message the batch is
+    idempotent: a replay fails on the existing message doc and writes nothing.
+    The profile's per-message fields are debounced through profile_cache, so a
+    burst from one chat writes its profile doc once per PROFILE_WRITE_INTERVAL;
+    if the batch doesn't commit, the deferred fields it carried go back.
+    Returns the number of Firestore RPCs issued; raises if nothing was stored,
+    so the webhook fails and Telegram redelivers the update.
+    """
+    rpc_count = 0
+    write = None
+    try:
+        # Get user info - at most one read, none when the profile is cached
+        reads_before = profile_cache.reads
+        user_doc = profile_cache.get(chat_id)
+        rpc_count += profile_cache.reads - reads_before
+
+        write = _MessageWrite(db, chat_id, text, user_doc, profile_updates, message_id)
+        write.batch.commit()
+        rpc_count += 1
+        write.stored(rpc_count)
+
+    except api_exceptions.AlreadyExists:
+        rpc_count += 1
+        write.restore()
+        log.info("🔁 Message already stored - redelivered update", chat_id=chat_id, message_id=message_id)
+
+    except Exception as e:
+        if write is not None:
+            write.restore()
+        profile_cache.invalidate(chat_id)
+        log.error("❌ Error storing message", chat_id=chat_id, error=str(e))
+        raise
+
+    return rpc_count
+
+async def store_message_async(chat_id, text, profile_updates: Dict[Any, Any] = None, message_id: str = None,
+                              client=None) -> int:
+    """store_message() on client, the async Firestore client - same batch, cache and debounce"""
+    rpc_count = 0
+    write = None
+    try:
+        reads_before = profile_cache.reads
+        user_doc = await profile_cache.get_async(chat_id, profiles_collection(client))
+        rpc_count += profile_cache.reads - reads_before
+
+        write = _MessageWrite(client, chat_id, text, user_doc, profile_updates, message_id)
+        await write.batch.commit()
+        rpc_count += 1
+        write.stored(rpc_count)
+
+    except api_exceptions.AlreadyExists:
+        rpc_count += 1
+        write.restore()
+        log.info("🔁 Message already stored - redelivered update", chat_id=chat_id, message_id=message_id)
+
     except Exception as e:
-        print(f"❌ Error storing message: {str(e)}")
-        logger.error(f"❌ Error storing message: {str(e)}")
-    
-    return True
\ No newline at end of file
+        if write is not None:
+            write.restore()
+        profile_cache.invalidate(chat_id)
+        log.error("❌ Error storing message", chat_id=chat_id, error=str(e))
+        raise
+
+    return rpc_count
@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import base64
+import sqlite3
+import threading
+import queue as queue_lib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from structured_logging import get_logger
+
+log = get_logger(__name__)
+
+# Backend selection - 'inline' keeps the original synchronous behaviour
+MEDIA_QUEUE_BACKEND = os.getenv("MEDIA_QUEUE_BACKEND", "inline").lower()
+MEDIA_QUEUE_PATH = os.getenv("MEDIA_QUEUE_PATH", "/tmp/arems-media-queue.sqlite3")
+MEDIA_QUEUE_TOPIC = os.getenv("MEDIA_QUEUE_TOPIC", "")
+MEDIA_WORKER_CONCURRENCY = int(os.getenv("MEDIA_WORKER_CONCURRENCY", "4"))
+MEDIA_WORKER_BATCH_SIZE = int(os.getenv("MEDIA_WORKER_BATCH_SIZE", "32"))
+MEDIA_JOB_MAX_ATTEMPTS = int(os.getenv("MEDIA_JOB_MAX_ATTEMPTS", "3"))
+# Pushed jobs only carry deliveryAttempt under a dead-letter policy - past this age they are given up regardless
+MEDIA_JOB_MAX_AGE = float(os.getenv("MEDIA_JOB_MAX_AGE", "1800"))
+# A claimed job not acked or failed within this many seconds is assumed lost with its worker
+MEDIA_JOB_VISIBILITY_TIMEOUT = float(os.getenv("MEDIA_JOB_VISIBILITY_TIMEOUT", "600"))
+
+
+def build_media_job(kind: str, chat_id, username: str, payload: Any) -> Dict[str, Any]:
+    """Build a JSON-serialisable media job for a document or photo update"""
+    return {
+        "kind": kind,
+        "chat_id": chat_id,
+        "username": username,
+        "payload": payload,
+        "enqueued_at": time.time(),
+    }
+
+
+class InProcessMediaQueue:
+    """In-memory queue for local tests - jobs are lost when the process exits"""
+
+    def __init__(self):
+        self._queue = queue_lib.Queue()
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def put(self, job: Dict[str, Any]) -> str:
+        with self._lock:
+            self._next_id += 1
+            job_id = str(self._next_id)
+        self._queue.put((job_id, job))
+        return job_id
+
+    def claim(self, max_jobs: int) -> List[Tuple[str, Dict[str, Any]]]:
+        jobs = []
+        while len(jobs) < max_jobs:
+            try:
+                jobs.append(self._queue.get_nowait())
+            except queue_lib.Empty:
+                break
+        return jobs
+
+    def ack(self, job_id: str) -> None:
+        pass
+
+    def fail(self, job_id: str, job: Dict[str, Any]) -> bool:
+        job["attempts"] = job.get("attempts", 0) + 1
+        if job["attempts"] < MEDIA_JOB_MAX_ATTEMPTS:
+            self._queue.put((job_id, job))
+            return True
+        return False
+
+    def __len__(self):
+        return self._queue.qsize()
+
+
+class SQLiteMediaQueue:
+    """Durable single-host queue backed by SQLite - survives restarts of a local worker
+
+    claim() leases jobs for visibility_timeout seconds. A worker that crashes
+    mid-job leaves its rows 'running'; once the lease expires the next claim()
+    counts that as a failed attempt and hands the job out again.
+    """
+
+    def __init__(self, path: str = MEDIA_QUEUE_PATH, visibility_timeout: float = MEDIA_JOB_VISIBILITY_TIMEOUT):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS media_jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " job TEXT NOT NULL,"
+            " status TEXT NOT NULL DEFAULT 'pending',"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " created_at REAL NOT NULL,"
+            " claimed_at REAL)"
+        )
+        # Queues created before leases existed
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(media_jobs)")}
+        if "claimed_at" not in columns:
+            self._conn.execute("ALTER TABLE media_jobs ADD COLUMN claimed_at REAL")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS media_jobs_status ON media_jobs (status, id)")
+
+    def put(self, job: Dict[str, Any]) -> str:
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO media_jobs (job, created_at) VALUES (?, ?)",
+                (json.dumps(job), time.time()),
+            )
+            return str(cursor.lastrowid)
+
+    def claim(self, max_jobs: int) -> List[Tuple[str, Dict[str, Any]]]:
+        with self._lock:
+            now = time.time()
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Expired leases go back to pending, or to failed once out of attempts
+                self._conn.execute(
+                    "UPDATE media_jobs SET attempts = attempts + 1,"
+                    " status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END"
+                    " WHERE status = 'running' AND (claimed_at IS NULL OR claimed_at < ?)",
+                    (MEDIA_JOB_MAX_ATTEMPTS, now - self.visibility_timeout),
+                )
+                rows = self._conn.execute(
+                    "SELECT id, job FROM media_jobs WHERE status = 'pending' ORDER BY id LIMIT ?",
+                    (max_jobs,),
+                ).fetchall()
+                self._conn.executemany(
+                    "UPDATE media_jobs SET status = 'running', claimed_at = ? WHERE id = ?",
+                    [(now, row[0]) for row in rows],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [(str(row[0]), json.loads(row[1])) for row in rows]
+
+    def ack(self, job_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM media_jobs WHERE id = ?", (int(job_id),))
+
+    def fail(self, job_id: str, job: Dict[str, Any]) -> bool:
+        """Record a failed attempt - True if the job will be retried"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE media_jobs SET attempts = attempts + 1,"
+                " status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END"
+                " WHERE id = ?",
+                (MEDIA_JOB_MAX_ATTEMPTS, int(job_id)),
+            )
+            row = self._conn.execute("SELECT status FROM media_jobs WHERE id = ?", (int(job_id),)).fetchone()
+        return row is not None and row[0] == 'pending'
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM media_jobs WHERE status = 'pending'").fetchone()[0]
+
+
+class PubSubMediaQueue:
+    """Production adapter - publishes jobs to a Pub/Sub topic that push-delivers to the worker"""
+
+    def __init__(self, topic: str = MEDIA_QUEUE_TOPIC):
+        from google.cloud import pubsub_v1
+
+        if not topic:
+            raise ValueError("MEDIA_QUEUE_TOPIC must be set for the pubsub media queue")
+        self.topic = topic
+        self._publisher = pubsub_v1.PublisherClient()
+
+    def put(self, job: Dict[str, Any]) -> str:
+        future = self._publisher.publish(self.topic, json.dumps(job).encode("utf-8"), kind=job["kind"])
+        return future.result(timeout=10)
+
+    def claim(self, max_jobs: int) -> List[Tuple[str, Dict[str, Any]]]:
+        # Pub/Sub pushes each job to the worker - there's nothing to pull
+        return []
+
+    def ack(self, job_id: str) -> None:
+        pass
+
+    def fail(self, job_id: str, job: Dict[str, Any]) -> bool:
+        # Redelivery is driven by the push handler returning a non-2xx status
+        return True
+
+
+def decode_pubsub_push(envelope: Dict[str, Any]) -> Optional[Tuple[str, Dict[str, Any], Optional[int]]]:
+    """Extract (message_id, job, delivery_attempt) from a Pub/Sub push envelope, or None if it isn't one
+
+    delivery_attempt is only set when the subscription has a dead-letter policy.
+    """
+    message = (envelope or {}).get("message")
+    if not isinstance(message, dict) or "data" not in message:
+        return None
+    job = json.loads(base64.b64decode(message["data"]).decode("utf-8"))
+    return message.get("messageId", ""), job, envelope.get("deliveryAttempt")
+
+
+def is_last_push_attempt(job: Dict[str, Any], delivery_attempt: Optional[int]) -> bool:
+    """Whether a failed pushed job should be acked rather than redelivered again"""
+    if delivery_attempt is not None and delivery_attempt >= MEDIA_JOB_MAX_ATTEMPTS:
+        return True
+    return time.time() - job.get("enqueued_at", time.time()) >= MEDIA_JOB_MAX_AGE
+
+
+def get_media_queue(backend: str = MEDIA_QUEUE_BACKEND):
+    """Create the configured media queue - None means process media inline"""
+    if backend in ("", "inline"):
+        return None
+    if backend == "memory":
+        return InProcessMediaQueue()
+    if backend == "sqlite":
+        return SQLiteMediaQueue(MEDIA_QUEUE_PATH)
+    if backend == "pubsub":
+        return PubSubMediaQueue(MEDIA_QUEUE_TOPIC)
+    raise ValueError(f"Unknown MEDIA_QUEUE_BACKEND: {backend}")
+
+
+def drain_media_queue(media_queue, process_job: Callable[[Dict[str, Any]], None],
+                      max_workers: int = MEDIA_WORKER_CONCURRENCY,
+                      max_jobs: int = MEDIA_WORKER_BATCH_SIZE,
+                      on_give_up: Optional[Callable[[Dict[str, Any], Exception], None]] = None) -> Dict[str, int]:
+    """Claim up to max_jobs jobs and process them with at most max_workers in flight
+
+    on_give_up(job, error) is called when a job's last attempt fails.
+    """
+    stats = {"processed": 0, "failed": 0}
+    jobs = media_queue.claim(max_jobs)
+    if not jobs:
+        return stats
+
+    def run(job_id, job):
+        try:
+            process_job(job)
+            media_queue.ack(job_id)
+            return True
+        except Exception as e:
+            log.exception("❌ Media job failed", job_id=job_id, error=str(e))
+            if not media_queue.fail(job_id, job) and on_give_up is not None:
+                try:
+                    on_give_up(job, e)
+                except Exception as give_up_error:
+                    log.error("❌ Media job give-up handler failed", job_id=job_id, error=str(give_up_error))
+            return False
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for ok in executor.map(lambda item: run(*item), jobs):
+            stats["processed" if ok else "failed"] += 1
+
+    log.info("📦 Drained media queue", **stats)
+    return stats
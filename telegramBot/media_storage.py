@@ -0,0 +1,149 @@
+import os
+import base64
+import hashlib
+import mimetypes
+from typing import Any, Dict, Iterator, Optional
+
+import google_crc32c
+from google.api_core import exceptions as api_exceptions
+
+from structured_logging import get_logger
+
+log = get_logger(__name__)
+
+# Download chunk size - small enough to keep memory flat, large enough to keep syscalls down
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("MEDIA_DOWNLOAD_CHUNK_SIZE", str(64 * 1024)))
+
+# Resumable upload chunk size - GCS requires a multiple of 256 KiB. This bounds the
+# writer's buffer and therefore the peak memory of one upload.
+UPLOAD_CHUNK_SIZE = int(os.getenv("MEDIA_UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+
+# Magic-number signatures checked against the first downloaded chunk
+_MAGIC_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"%PDF-", "application/pdf"),
+    (b"OggS", "audio/ogg"),
+    (b"ID3", "audio/mpeg"),
+]
+
+
+class UploadIntegrityError(Exception):
+    """Raised when the checksums computed while streaming don't match the stored object"""
+
+
+class IncompleteDownloadError(Exception):
+    """Raised when the download ends with fewer (or more) bytes than Telegram announced"""
+
+
+def detect_content_type(first_chunk: bytes, file_name: Optional[str] = None) -> str:
+    """Detect content type from the first chunk's magic bytes, falling back to the file name"""
+    for signature, content_type in _MAGIC_SIGNATURES:
+        if first_chunk.startswith(signature):
+            return content_type
+    if first_chunk[:4] == b"RIFF" and first_chunk[8:12] == b"WEBP":
+        return "image/webp"
+    if first_chunk[4:8] == b"ftyp":
+        return "video/mp4"
+
+    # ZIP containers (docx, xlsx, ...) and text formats are better identified by extension
+    if file_name:
+        guessed, _ = mimetypes.guess_type(file_name)
+        if guessed:
+            return guessed
+    if first_chunk.startswith(b"PK\x03\x04"):
+        return "application/zip"
+    return "application/octet-stream"
+
+
+def _iter_chunks(response, chunk_size: int) -> Iterator[bytes]:
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        if chunk:
+            yield chunk
+
+
+def _abort_upload(writer, blob) -> None:
+    """Drop an unfinished upload so no truncated object is ever finalized"""
+    # BlobWriter.close() - run by with-blocks and by IOBase when the writer is garbage
+    # collected - uploads the buffered tail and finalizes the object; with its buffer
+    # closed first it has nothing left to send
+    writer._buffer.close()
+    if writer._upload_and_transport:
+        upload, transport = writer._upload_and_transport
+        try:
+            # Cancel the resumable session rather than leave it open for a week
+            if upload.resumable_url:
+                transport.request("DELETE", upload.resumable_url, timeout=10)
+        except Exception as e:
+            log.warning("⚠️ Could not cancel resumable upload", blob=blob.name, error=str(e))
+    try:
+        blob.delete()
+    except api_exceptions.NotFound:
+        pass
+    except Exception as e:
+        log.warning("⚠️ Could not delete partial upload", blob=blob.name, error=str(e))
+
+
+def stream_to_blob(response, blob, file_name: Optional[str] = None,
+                   download_chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+                   upload_chunk_size: int = UPLOAD_CHUNK_SIZE,
+                   verify: bool = True, expected_size: Optional[int] = None) -> Dict[str, Any]:
+    """Stream a download response into a resumable GCS upload with a bounded buffer
+
+    The response must have been opened with stream=True. MD5 and CRC32C are
+    computed incrementally and, when verify is set, compared against the
+    checksums GCS reports for the finished object. The object is only
+    finalized once the whole download has arrived (expected_size bytes, when
+    given) - a failed or short download discards the upload instead.
+    """
+    chunks = _iter_chunks(response, download_chunk_size)
+    first_chunk = next(chunks, b"")
+    content_type = detect_content_type(first_chunk, file_name)
+
+    md5 = hashlib.md5()
+    crc = google_crc32c.Checksum()
+    size = 0
+
+    blob.content_type = content_type
+    # Not a with-block: leaving it on an exception would finalize whatever was uploaded so far
+    writer = blob.open("wb", chunk_size=upload_chunk_size, content_type=content_type)
+    try:
+        if first_chunk:
+            md5.update(first_chunk)
+            crc.update(first_chunk)
+            writer.write(first_chunk)
+            size += len(first_chunk)
+        for chunk in chunks:
+            md5.update(chunk)
+            crc.update(chunk)
+            writer.write(chunk)
+            size += len(chunk)
+        if expected_size and size != expected_size:
+            raise IncompleteDownloadError(f"Downloaded {size} of {expected_size} bytes for {blob.name}")
+    except BaseException:
+        _abort_upload(writer, blob)
+        raise
+    writer.close()
+
+    md5_b64 = base64.b64encode(md5.digest()).decode("ascii")
+    crc_b64 = base64.b64encode(crc.digest()).decode("ascii")
+
+    if verify:
+        blob.reload()
+        # Composite objects have no MD5, so CRC32C is the authoritative check
+        if blob.crc32c and blob.crc32c != crc_b64:
+            blob.delete()
+            raise UploadIntegrityError(f"CRC32C mismatch for {blob.name}: expected {crc_b64}, got {blob.crc32c}")
+        if blob.md5_hash and blob.md5_hash != md5_b64:
+            blob.delete()
+            raise UploadIntegrityError(f"MD5 mismatch for {blob.name}: expected {md5_b64}, got {blob.md5_hash}")
+
+    log.info("📦 Streamed upload", size=size, content_type=content_type, blob=blob.name)
+    return {
+        "size": size,
+        "content_type": content_type,
+        "md5_hash": md5_b64,
+        "crc32c": crc_b64,
+    }
@@ -0,0 +1,86 @@
+import os
+import random
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from google.cloud import firestore
+
+from id_generator import generate_id, id_timestamp
+
+# Firestore sustains roughly one write per second per document. The daily
+# summary is split across this many shard docs so a chat sending a burst of
+# messages spreads its counter writes instead of queueing on one hot doc.
+MESSAGE_SUMMARY_SHARDS = int(os.getenv("MESSAGE_SUMMARY_SHARDS", "10"))
+
+DAY_FORMAT = '%B_%d_%Y'
+
+
+def message_day_ref(db, chat_key: str, date_str: str):
+    """Day document under which a chat's messages and summary shards live"""
+    return (db.collection('arems-profiles')
+            .document('messages')
+            .collection(chat_key)
+            .document(date_str))
+
+
+def add_message_writes(db, batch, chat_key: str, text: str, username: str,
+                       message_type: str = 'user_message',
+                       shards: int = MESSAGE_SUMMARY_SHARDS,
+                       message_id: Optional[str] = None) -> Dict[str, Any]:
+    """Queue an append-only message doc and a sharded summary increment on batch
+
+    The message doc ID is a time-ordered ULID-based ID, so messages sent within
+    the same second never overwrite each other and list in arrival order. The
+    day is taken from the ID's own (UTC) timestamp so both always agree.
+    The doc is written with create(): pass a message_id derived from the
+    source event and a replay fails the whole batch with AlreadyExists
+    instead of storing the message and counting it twice.
+    Returns the message ID and its timestamps for the caller's profile update.
+    """
+    message_id = message_id or generate_id('MSG')
+    sent_at = id_timestamp(message_id)
+    date_str = sent_at.strftime(DAY_FORMAT)
+    day_ref = message_day_ref(db, chat_key, date_str)
+    shard = random.randrange(shards)
+
+    batch.create(day_ref.collection('daily_messages').document(message_id), {
+        'text': text,
+        'timestamp': firestore.SERVER_TIMESTAMP,
+        'sent_at': sent_at,
+        'type': message_type,
+        'username': username,
+        'shard': shard
+    })
+
+    batch.set(day_ref.collection('summary_shards').document(str(shard)), {
+        'date': date_str,
+        'message_count': firestore.Increment(1),
+        'last_message_time': firestore.SERVER_TIMESTAMP,
+        'username': username
+    }, merge=True)
+
+    return {'message_id': message_id, 'sent_at': sent_at, 'date_str': date_str}
+
+
+def read_daily_summary(db, chat_key: str, date_str: str) -> Optional[Dict[str, Any]]:
+    """Sum a day's summary shards - returns None when the chat sent nothing that day"""
+    total = 0
+    last_message_time: Optional[datetime] = None
+    username = None
+    found = False
+    for shard in message_day_ref(db, chat_key, date_str).collection('summary_shards').stream():
+        data = shard.to_dict() or {}
+        found = True
+        total += data.get('message_count', 0)
+        shard_time = data.get('last_message_time')
+        if shard_time is not None and (last_message_time is None or shard_time > last_message_time):
+            last_message_time = shard_time
+            username = data.get('username', username)
+    if not found:
+        return None
+    return {
+        'date': date_str,
+        'message_count': total,
+        'last_message_time': last_message_time,
+        'username': username
+    }
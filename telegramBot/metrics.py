@@ -0,0 +1,66 @@
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Dict, Sequence
+
+# Latency buckets in seconds (upper bounds) - the last bucket catches everything above
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_histograms: Dict[str, Dict[str, Any]] = {}
+_counters: Dict[str, int] = {}
+
+
+def observe(name: str, value: float, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+    """Record one observation in a per-process histogram"""
+    with _lock:
+        hist = _histograms.get(name)
+        if hist is None:
+            hist = _histograms[name] = {
+                "count": 0, "sum": 0.0, "min": value, "max": value,
+                "bounds": tuple(buckets), "buckets": [0] * (len(buckets) + 1),
+            }
+        hist["count"] += 1
+        hist["sum"] += value
+        hist["min"] = min(hist["min"], value)
+        hist["max"] = max(hist["max"], value)
+        hist["buckets"][bisect_left(hist["bounds"], value)] += 1
+
+
+def incr(name: str, amount: int = 1) -> None:
+    """Increment a per-process counter"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+@contextmanager
+def timed(name: str):
+    """Time a block and record it under name (in seconds)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def snapshot() -> Dict[str, Any]:
+    """Copy of all counters and histograms, with mean latency filled in"""
+    with _lock:
+        histograms = {}
+        for name, hist in _histograms.items():
+            histograms[name] = {
+                "count": hist["count"],
+                "sum": hist["sum"],
+                "mean": hist["sum"] / hist["count"] if hist["count"] else 0.0,
+                "min": hist["min"],
+                "max": hist["max"],
+                "buckets": dict(zip([*map(str, hist["bounds"]), "+Inf"], hist["buckets"])),
+            }
+        return {"counters": dict(_counters), "histograms": histograms}
+
+
+def reset() -> None:
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
@@ -0,0 +1,419 @@
+"""Rate-limited outbound Telegram sender
+
+Every sendMessage goes through one per-process dispatcher that keeps under
+Telegram's limits instead of running into 429s:
+
+    global      ~30 messages/s for the bot (TELEGRAM_GLOBAL_RATE)
+    per chat    ~1 message/s in private chats, 20/min in groups
+
+Messages wait in a priority queue (emergency replies, then ordinary replies,
+then broadcasts), consecutive messages to one chat are coalesced into a
+single sendMessage, and a 429's retry_after pauses sending instead of being
+retried blindly. broadcast() sends one alert to many chats through the same
+limits.
+
+The buckets live in process memory, so every limit here is per instance:
+N function instances would together send N times the global rate. Deploy
+every function that sends (the webhook and the broadcast worker) with
+--max-instances, and set OUTBOUND_INSTANCES to the total of those caps -
+each instance then takes TELEGRAM_GLOBAL_RATE / OUTBOUND_INSTANCES (and the
+same share of the burst). A chat's updates can also land on different
+instances; the rare 429 that gets through pauses that instance for
+retry_after like any other.
+"""
+import os
+import time
+import heapq
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional
+
+import metrics
+from telegram_client import TelegramClient, retry_after_seconds, RETRYABLE_STATUS_CODES
+from ttl_cache import TTLCache
+from structured_logging import get_logger
+
+log = get_logger(__name__)
+
+# Set to 0 to call sendMessage directly from the request thread
+OUTBOUND_DISPATCH = os.getenv("OUTBOUND_DISPATCH", "1") != "0"
+# Bot-wide budget, split evenly across the instances that may send at once
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+# Sum of --max-instances over every deployed function that sends messages
+OUTBOUND_INSTANCES = max(1, int(os.getenv("OUTBOUND_INSTANCES", "1")))
+TELEGRAM_GLOBAL_BURST = float(os.getenv("TELEGRAM_GLOBAL_BURST", "5"))
+INSTANCE_GLOBAL_RATE = TELEGRAM_GLOBAL_RATE / OUTBOUND_INSTANCES
+INSTANCE_GLOBAL_BURST = TELEGRAM_GLOBAL_BURST / OUTBOUND_INSTANCES
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "2"))
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", str(20 / 60)))
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", "8"))
+OUTBOUND_MAX_ATTEMPTS = int(os.getenv("OUTBOUND_MAX_ATTEMPTS", "5"))
+# broadcast() waits for room once this many messages are queued
+OUTBOUND_MAX_PENDING = int(os.getenv("OUTBOUND_MAX_PENDING", "5000"))
+
+# Lower sends first
+EMERGENCY = 0
+NORMAL = 1
+BROADCAST = 2
+
+# Telegram's sendMessage text limit - coalesced messages stay under it
+MAX_MESSAGE_LENGTH = 4096
+_SEPARATOR = "\n\n"
+
+
+class TokenBucket:
+    """rate tokens/s up to burst; reserve() may hand out a token that only becomes usable later"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is free"""
+        self._refill(now)
+        return max(0.0, self.updated - now) + max(0.0, 1.0 - self.tokens) / self.rate
+
+    def reserve(self, now: float) -> float:
+        """Take a token - returns how long to wait before using it"""
+        wait = self.delay(now)
+        self.tokens -= 1.0
+        return wait
+
+    def pause_until(self, until: float) -> None:
+        """Nothing leaves the bucket before until (Telegram's retry_after), then at most one token"""
+        if until > self.updated:
+            self.tokens = min(self.tokens, 1.0)
+            self.updated = until
+
+
+class OutboundMessage:
+    """One queued sendMessage - wait() for the outcome, or pass on_done to be called with it"""
+
+    __slots__ = ("chat_id", "text", "priority", "extra", "on_done", "queued_at", "finished_at", "attempts",
+                 "ok", "status_code", "error", "_done")
+
+    def __init__(self, chat_id, text: str, priority: int, extra: Dict[str, Any],
+                 on_done: Optional[Callable[["OutboundMessage"], None]], queued_at: float):
+        self.chat_id = chat_id
+        self.text = text
+        self.priority = priority
+        self.extra = extra
+        self.on_done = on_done
+        self.queued_at = queued_at
+        self.finished_at: Optional[float] = None
+        self.attempts = 0
+        self.ok = False
+        self.status_code: Optional[int] = None
+        self.error: Optional[str] = None
+        self._done = threading.Event()
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """True once the message is sent or has finally failed"""
+        return self._done.wait(timeout)
+
+
+class Broadcast:
+    """The messages of one broadcast() call"""
+
+    def __init__(self, messages: List[OutboundMessage]):
+        self.messages = messages
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for message in self.messages:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not message.wait(remaining):
+                return False
+        return True
+
+    def summary(self) -> Dict[str, Any]:
+        sent = sum(m.ok for m in self.messages)
+        failed = sum(m.done and not m.ok for m in self.messages)
+        return {"recipients": len(self.messages), "sent": sent, "failed": failed,
+                "pending": len(self.messages) - sent - failed}
+
+
+class OutboundDispatcher:
+    """Priority queue of outbound messages drained by worker threads under global and per-chat buckets
+
+    send(chat_id, text, **extra) must make a single attempt (no built-in
+    retries) and return a response with status_code, json() and headers.
+    Messages to one chat go out in order, one request at a time. A 429 pauses
+    the chat and - since Telegram doesn't say which limit was hit - the
+    global bucket for retry_after; 5xx and connection errors back off
+    exponentially. Other 4xx (blocked bot, unknown chat) fail at once.
+    """
+
+    def __init__(self, send: Callable[..., Any], global_rate: float = INSTANCE_GLOBAL_RATE,
+                 global_burst: float = INSTANCE_GLOBAL_BURST, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 chat_burst: float = TELEGRAM_CHAT_BURST, group_rate: float = TELEGRAM_GROUP_RATE,
+                 workers: int = OUTBOUND_WORKERS, max_attempts: int = OUTBOUND_MAX_ATTEMPTS,
+                 max_pending: int = OUTBOUND_MAX_PENDING, coalesce: bool = True, backoff_factor: float = 0.5,
+                 clock: Callable[[], float] = time.monotonic):
+        self.send = send
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self.coalesce = coalesce
+        self.backoff_factor = backoff_factor
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._work = threading.Condition(self._lock)
+        self._room = threading.Condition(self._lock)
+        self._queues: Dict[Any, Deque[OutboundMessage]] = {}
+        # (priority, seq, chat_id) for chats that can send now, (not_before, seq, chat_id) for those that can't
+        self._ready: List[tuple] = []
+        self._delayed: List[tuple] = []
+        self._scheduled: Dict[Any, int] = {}
+        self._waiting = set()
+        self._in_flight = set()
+        self._seq = 0
+        self._pending = 0
+        self._threads: List[threading.Thread] = []
+        self._stopping = False
+
+        self.global_bucket = TokenBucket(global_rate, global_burst, clock())
+        # Idle chats' buckets are full again after burst/rate seconds - then they can be forgotten
+        self._chat_buckets = TTLCache(maxsize=100_000, ttl=chat_burst / min(chat_rate, group_rate), clock=clock)
+
+        self.sent = 0
+        self.failed = 0
+        self.requests = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.rate_limited = 0
+
+    # ------------------------------------------------------------------
+    # Public API
+    # ------------------------------------------------------------------
+
+    def enqueue(self, chat_id, text: str, priority: int = NORMAL,
+                on_done: Optional[Callable[[OutboundMessage], None]] = None, **extra: Any) -> OutboundMessage:
+        """Queue a message - never blocks"""
+        with self._lock:
+            message = self._add(chat_id, text, priority, on_done, extra)
+        self._start()
+        return message
+
+    def broadcast(self, chat_ids: Iterable[Any], text: str, priority: int = BROADCAST,
+                  on_done: Optional[Callable[[OutboundMessage], None]] = None, **extra: Any) -> Broadcast:
+        """Queue text for every chat, waiting for room whenever max_pending messages are queued"""
+        self._start()
+        messages = []
+        for chat_id in chat_ids:
+            with self._lock:
+                while self._pending >= self.max_pending and not self._stopping:
+                    self._room.wait()
+                messages.append(self._add(chat_id, text, priority, on_done, extra))
+        log.info("📢 Broadcast queued", recipients=len(messages), priority=priority)
+        return Broadcast(messages)
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Send what is queued, then stop the workers"""
+        with self._lock:
+            self._stopping = True
+            self._work.notify_all()
+            self._room.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"pending": self._pending, "in_flight": len(self._in_flight), "sent": self.sent,
+                    "failed": self.failed, "requests": self.requests, "coalesced": self.coalesced,
+                    "retries": self.retries, "rate_limited": self.rate_limited}
+
+    # ------------------------------------------------------------------
+    # Scheduling - all under self._lock
+    # ------------------------------------------------------------------
+
+    def _add(self, chat_id, text: str, priority: int, on_done, extra: Dict[str, Any]) -> OutboundMessage:
+        message = OutboundMessage(chat_id, text, priority, extra, on_done, self._clock())
+        self._queues.setdefault(chat_id, deque()).append(message)
+        self._pending += 1
+        self._schedule(chat_id)
+        return message
+
+    def _schedule(self, chat_id) -> None:
+        """Put a chat with queued messages on the ready heap at its most urgent message's priority"""
+        queue = self._queues.get(chat_id)
+        if not queue or chat_id in self._in_flight or chat_id in self._waiting:
+            return
+        priority = min(m.priority for m in queue)
+        if self._scheduled.get(chat_id, priority + 1) <= priority:
+            return
+        self._scheduled[chat_id] = priority
+        self._seq += 1
+        heapq.heappush(self._ready, (priority, self._seq, chat_id))
+        self._work.notify()
+
+    def _chat_bucket(self, chat_id, now: float) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Negative ids are groups and channels
+            rate = self.group_rate if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate
+            bucket = TokenBucket(rate, self.chat_burst, now)
+        return bucket
+
+    def _next_batch(self):
+        """Wait for a chat that may send, take its messages and a global token - None when stopped"""
+        while True:
+            now = self._clock()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, chat_id = heapq.heappop(self._delayed)
+                self._waiting.discard(chat_id)
+                self._schedule(chat_id)
+
+            while self._ready:
+                priority, _, chat_id = heapq.heappop(self._ready)
+                if self._scheduled.get(chat_id) != priority:
+                    continue
+                del self._scheduled[chat_id]
+                queue = self._queues.get(chat_id)
+                if not queue or chat_id in self._in_flight:
+                    continue
+                bucket = self._chat_bucket(chat_id, now)
+                delay = bucket.delay(now)
+                if delay > 0:
+                    self._waiting.add(chat_id)
+                    self._seq += 1
+                    heapq.heappush(self._delayed, (now + delay, self._seq, chat_id))
+                    continue
+                bucket.reserve(now)
+                self._chat_buckets.set(chat_id, bucket)
+                messages = self._take(queue)
+                if not queue:
+                    del self._queues[chat_id]
+                self._in_flight.add(chat_id)
+                self._pending -= len(messages)
+                self._room.notify_all()
+                return chat_id, messages, self.global_bucket.reserve(now)
+
+            if self._stopping and not self._pending and not self._in_flight:
+                return None
+            self._work.wait(self._delayed[0][0] - now if self._delayed else None)
+
+    def _take(self, queue: Deque[OutboundMessage]) -> List[OutboundMessage]:
+        """The head message plus, when coalescing, the consecutive ones that fit in one sendMessage"""
+        messages = [queue.popleft()]
+        length = len(messages[0].text)
+        while self.coalesce and queue and queue[0].extra == messages[0].extra \
+                and length + len(_SEPARATOR) + len(queue[0].text) <= MAX_MESSAGE_LENGTH:
+            length += len(_SEPARATOR) + len(queue[0].text)
+            messages.append(queue.popleft())
+        return messages
+
+    # ------------------------------------------------------------------
+    # Workers
+    # ------------------------------------------------------------------
+
+    def _start(self) -> None:
+        if self._threads:
+            return
+        with self._lock:
+            if not self._threads:
+                self._threads = [threading.Thread(target=self._run, name=f"outbound-{n}", daemon=True)
+                                 for n in range(self.workers)]
+                for thread in self._threads:
+                    thread.start()
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                batch = self._next_batch()
+            if batch is None:
+                return
+            chat_id, messages, wait = batch
+            if wait > 0:
+                time.sleep(wait)
+            self._deliver(chat_id, messages)
+
+    def _deliver(self, chat_id, messages: List[OutboundMessage]) -> None:
+        text = _SEPARATOR.join(m.text for m in messages)
+        response, error = None, None
+        try:
+            response = self.send(chat_id, text, **messages[0].extra)
+        except Exception as e:
+            error = f"{e.__class__.__name__}: {e}"
+        status = response.status_code if response is not None else None
+
+        finished: List[OutboundMessage] = []
+        with self._lock:
+            now = self._clock()
+            self.requests += 1
+            self._in_flight.discard(chat_id)
+            for message in messages:
+                message.attempts += 1
+                message.status_code = status
+            retryable = status is None or status in RETRYABLE_STATUS_CODES
+
+            if status == 200 or not retryable or messages[0].attempts >= self.max_attempts:
+                ok = status == 200
+                for message in messages:
+                    message.ok = ok
+                    message.finished_at = now
+                    message.error = None if ok else error or f"HTTP {status}"
+                finished = messages
+                if ok:
+                    self.sent += len(messages)
+                    self.coalesced += len(messages) - 1
+                else:
+                    self.failed += len(messages)
+            else:
+                retry_after = retry_after_seconds(response) if status == 429 else None
+                if retry_after is not None:
+                    self.rate_limited += 1
+                    metrics.incr("telegram.outbound.rate_limited")
+                    self.global_bucket.pause_until(now + retry_after)
+                delay = retry_after if retry_after is not None else self.backoff_factor * 2 ** (messages[0].attempts - 1)
+                bucket = self._chat_bucket(chat_id, now)
+                bucket.pause_until(now + delay)
+                self._chat_buckets.set(chat_id, bucket, ttl=delay + self._chat_buckets.ttl)
+                # Back at the front of the chat's queue, ahead of anything queued since
+                self._queues.setdefault(chat_id, deque()).extendleft(reversed(messages))
+                self._pending += len(messages)
+                self.retries += len(messages)
+                log.info("🔁 Outbound message retry", chat_id=chat_id, status=status or error,
+                         delay=round(delay, 2), attempt=messages[0].attempts)
+            self._schedule(chat_id)
+            self._work.notify_all()
+
+        for message in finished:
+            metrics.observe("telegram.outbound.queue_seconds", now - message.queued_at)
+            message._done.set()
+            if not message.ok:
+                log.error("❌ Outbound message failed", chat_id=chat_id, status_code=status,
+                          error=message.error, attempts=message.attempts)
+            if message.on_done is not None:
+                try:
+                    message.on_done(message)
+                except Exception as e:
+                    log.error("❌ Outbound on_done callback failed", chat_id=chat_id, error=str(e))
+
+
+def build_outbound_dispatcher(token: Optional[str], enabled: bool = OUTBOUND_DISPATCH) -> Optional[OutboundDispatcher]:
+    """The per-process dispatcher on its own single-attempt client - None when OUTBOUND_DISPATCH=0"""
+    if not enabled:
+        return None
+    client = TelegramClient(token, pool_size=OUTBOUND_WORKERS, max_retries=0)
+    log.info("📤 Outbound dispatcher limits are per instance", instances=OUTBOUND_INSTANCES,
+             global_rate=round(INSTANCE_GLOBAL_RATE, 3), bot_global_rate=TELEGRAM_GLOBAL_RATE)
+    return OutboundDispatcher(client.send_message)
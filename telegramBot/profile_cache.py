@@ -0,0 +1,267 @@
+import os
+import time
+import threading
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from google.cloud import firestore
+
+from ttl_cache import TTLCache
+from structured_logging import get_logger
+
+log = get_logger(__name__)
+
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "2048"))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "300"))
+# "No profile yet" is cached briefly - another instance may create it meanwhile
+PROFILE_CACHE_NEGATIVE_TTL = float(os.getenv("PROFILE_CACHE_NEGATIVE_TTL", "5"))
+# Per-message profile fields are written at most once per chat in this many seconds
+PROFILE_WRITE_INTERVAL = float(os.getenv("PROFILE_WRITE_INTERVAL", "10"))
+# Profiles per flush batch - Firestore's WriteBatch limit
+PROFILE_FLUSH_BATCH_SIZE = 500
+
+# Fields every message touches - changes to anything else are written immediately
+PER_MESSAGE_FIELDS = frozenset({'last_active', 'last_message', 'last_message_time', 'total_messages'})
+
+
+class CachedProfile:
+    """Read-only stand-in for a profile DocumentSnapshot (exists, get, to_dict)"""
+
+    __slots__ = ("exists", "_data")
+
+    def __init__(self, data: Optional[Dict[str, Any]]):
+        self.exists = data is not None
+        self._data = data or {}
+
+    def get(self, field: str) -> Any:
+        return self._data.get(field)
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return dict(self._data) if self.exists else None
+
+
+def _resolve_transforms(current: Dict[str, Any], updates: Dict[str, Any]) -> Dict[str, Any]:
+    """Apply a write to a cached copy - server timestamps are dropped, increments added locally"""
+    data = dict(current)
+    for field, value in updates.items():
+        if value is firestore.SERVER_TIMESTAMP:
+            data.pop(field, None)
+        elif isinstance(value, firestore.Increment):
+            if isinstance(data.get(field), (int, float)):
+                data[field] += value.value
+            else:
+                data.pop(field, None)
+        else:
+            data[field] = value
+    return data
+
+
+class ProfileCache:
+    """Per-instance TTL/LRU cache of profile docs keyed by chat_id
+
+    Reads go through get(); writes made by this instance are applied to the
+    cached copy (write_through) once committed, so one update needs at most
+    one profile read per chat per TTL window. coalesce() debounces the
+    per-message profile fields so a burst doesn't queue on the profile doc;
+    with a db client, a background thread writes out whatever a chat's next
+    message hasn't picked up once its interval has passed.
+    """
+
+    def __init__(self, profiles_ref, maxsize: int = PROFILE_CACHE_SIZE, ttl: float = PROFILE_CACHE_TTL,
+                 negative_ttl: float = PROFILE_CACHE_NEGATIVE_TTL, write_interval: float = PROFILE_WRITE_INTERVAL,
+                 clock=time.monotonic, db=None):
+        self.profiles_ref = profiles_ref
+        self.db = db
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.negative_ttl = negative_ttl
+        self.write_interval = write_interval
+        self.clock = clock
+        self.maxsize = maxsize
+        self.reads = 0
+        self.deferred_writes = 0
+        # chat_id -> [last profile write, messages not yet counted, latest deferred fields]
+        self._pending: Dict[str, list] = {}
+        self._pending_lock = threading.Lock()
+        self._flusher: Optional[threading.Thread] = None
+
+    def ref(self, chat_id):
+        return self.profiles_ref.document(str(chat_id))
+
+    def get(self, chat_id) -> CachedProfile:
+        key = str(chat_id)
+        cached = self.local.get(key)
+        if cached is not None:
+            return cached
+
+        snapshot = self.ref(key).get()
+        self.reads += 1
+        profile = CachedProfile(snapshot.to_dict() if snapshot.exists else None)
+        self._store(key, profile)
+        return profile
+
+    async def get_async(self, chat_id, profiles_ref) -> CachedProfile:
+        """get() reading through profiles_ref on the async Firestore client - same cache"""
+        key = str(chat_id)
+        cached = self.local.get(key)
+        if cached is not None:
+            return cached
+
+        snapshot = await profiles_ref.document(key).get()
+        self.reads += 1
+        profile = CachedProfile(snapshot.to_dict() if snapshot.exists else None)
+        self._store(key, profile)
+        return profile
+
+    def write_through(self, chat_id, profile: CachedProfile, updates: Dict[str, Any],
+                      created: bool = False) -> None:
+        """Record a committed set (created=True) or update made on top of profile"""
+        base = {} if created else profile.to_dict()
+        if base is None:
+            # An update against a profile we never saw - let the next read fetch it
+            self.invalidate(chat_id)
+            return
+        self._store(str(chat_id), CachedProfile(_resolve_transforms(base, updates)))
+
+    def coalesce(self, chat_id, profile: CachedProfile, updates: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Updates to write for one message now, or None when they can ride on a later write
+
+        Only PER_MESSAGE_FIELDS are deferred, and only if this instance wrote
+        the profile less than write_interval ago. The chat's next write, or
+        flush_deferred() once the interval has passed, carries the latest
+        deferred fields and the skipped messages in total_messages. If that
+        write doesn't commit, restore() puts them back. Deferred updates live
+        only in this instance's memory - one shut down before they are
+        flushed loses them.
+        """
+        key = str(chat_id)
+        now = self.clock()
+        with self._pending_lock:
+            last_write, skipped, deferred = self._pending.get(key) or (None, 0, {})
+            routine = profile.exists and all(
+                field in PER_MESSAGE_FIELDS or profile.get(field) == value for field, value in updates.items())
+            if routine and last_write is not None and now - last_write < self.write_interval:
+                self._pending[key] = [last_write, skipped + updates.get('total_messages', 0), {**deferred, **updates}]
+                self.deferred_writes += 1
+                self._start_flusher()
+                return None
+
+            merged = {**deferred, **updates}
+            if skipped:
+                merged['total_messages'] = merged.get('total_messages', 0) + skipped
+            self._pending[key] = [now, 0, {}]
+            if len(self._pending) > self.maxsize:
+                self._prune(now)
+            return merged
+
+    def restore(self, chat_id, written: Dict[str, Any], updates: Dict[str, Any]) -> None:
+        """Put back what coalesce() merged into a write that didn't commit
+
+        written is what coalesce() returned for updates; only the deferred
+        part is kept - the message's own updates come back with its retry.
+        """
+        skipped = written.get('total_messages', 0) - updates.get('total_messages', 0)
+        self._restore(str(chat_id), skipped, {f: v for f, v in written.items() if f not in updates})
+
+    def _restore(self, key: str, skipped: int, deferred: Dict[str, Any]) -> None:
+        with self._pending_lock:
+            _, pending_skipped, pending_deferred = self._pending.get(key) or (None, 0, {})
+            # No last write, so the chat's next message (or the next flush) writes it all
+            self._pending[key] = [None, pending_skipped + skipped, {**deferred, **pending_deferred}]
+
+    def _take_due(self, now: float):
+        with self._pending_lock:
+            due = []
+            for key, (last_write, skipped, deferred) in self._pending.items():
+                if (skipped or deferred) and (last_write is None or now - last_write >= self.write_interval):
+                    due.append((key, skipped, deferred))
+                    self._pending[key] = [now, 0, {}]
+            return due
+
+    def flush_deferred(self) -> int:
+        """Write deferred fields no message has picked up within write_interval - returns profiles written"""
+        due = self._take_due(self.clock())
+        written = 0
+        for start in range(0, len(due), PROFILE_FLUSH_BATCH_SIZE):
+            chunk = due[start:start + PROFILE_FLUSH_BATCH_SIZE]
+            batch = self.db.batch()
+            writes = []
+            for key, skipped, deferred in chunk:
+                data = {field: value for field, value in deferred.items() if field != 'total_messages'}
+                if skipped:
+                    data['total_messages'] = firestore.Increment(skipped)
+                # Only existing profiles are ever deferred; merge so a since-deleted one can't fail the batch
+                batch.set(self.ref(key), data, merge=True)
+                writes.append((key, data))
+            try:
+                batch.commit()
+            except Exception as e:
+                for key, skipped, deferred in chunk:
+                    self._restore(key, skipped, deferred)
+                log.error("❌ Deferred profile flush failed", profiles=len(chunk), error=str(e))
+                continue
+            for key, data in writes:
+                cached = self.local.get(key)
+                if cached is not None:
+                    self.write_through(key, cached, data)
+            written += len(chunk)
+        if written:
+            log.info("💾 Deferred profile updates flushed", profiles=written)
+        return written
+
+    def _start_flusher(self) -> None:
+        # Caller holds the pending lock
+        if self.db is None or self._flusher is not None:
+            return
+        self._flusher = threading.Thread(target=self._flush_loop, name="profile-flush", daemon=True)
+        self._flusher.start()
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(self.write_interval)
+            try:
+                self.flush_deferred()
+            except Exception as e:
+                log.error("❌ Deferred profile flush failed", error=str(e))
+
+    def _prune(self, now: float) -> None:
+        # Caller holds the lock; chats with nothing deferred and no recent write can go
+        for key in [k for k, (last_write, skipped, deferred) in self._pending.items()
+                    if not skipped and not deferred and (last_write is None or now - last_write >= self.write_interval)]:
+            del self._pending[key]
+
+    def invalidate(self, chat_id) -> None:
+        self.local.delete(str(chat_id))
+
+    def _store(self, key: str, profile: CachedProfile) -> None:
+        self.local.set(key, profile, ttl=None if profile.exists else self.negative_ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.local.stats()
+        stats["firestore_reads"] = self.reads
+        stats["deferred_writes"] = self.deferred_writes
+        stats["deferred_profiles"] = sum(1 for _, skipped, deferred in list(self._pending.values())
+                                         if skipped or deferred)
+        return stats
+
+
+def build_profile_write(chat_id, user_doc, updates: Dict[Any, Any]):
+    """Build the profile payload for an already-read snapshot - returns (data, is_new)"""
+    if not user_doc.exists:
+        # Create new user profile
+        base_profile = {
+            'chat_id': chat_id,
+            'first_interaction': firestore.SERVER_TIMESTAMP,
+            'last_active': firestore.SERVER_TIMESTAMP,
+            'total_messages': 1,
+            'profile_created': datetime.now(),
+            'profile_status': 'new'
+        }
+        base_profile.update(updates)
+        return base_profile, True
+
+    # Update existing user profile
+    updates = dict(updates)
+    updates['last_active'] = firestore.SERVER_TIMESTAMP
+    if 'total_messages' in updates:
+        updates['total_messages'] = firestore.Increment(updates['total_messages'])
+    return updates, False
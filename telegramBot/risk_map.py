@@ -0,0 +1,144 @@
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from google.cloud import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from geo_risk import geohash_center
+from ttl_cache import TTLCache
+from structured_logging import get_logger
+
+log = get_logger(__name__)
+
+# Geohash length of a map cell (5 ~ 4.9 x 4.9 km) and of a served tile (4 ~ 39 x 20 km)
+RISK_MAP_PRECISION = int(os.getenv("RISK_MAP_PRECISION", "5"))
+RISK_MAP_TILE_PRECISION = int(os.getenv("RISK_MAP_TILE_PRECISION", "4"))
+# Shortest tile a client may ask for, and a hard cap on cells read for one tile
+RISK_MAP_MIN_TILE_PRECISION = int(os.getenv("RISK_MAP_MIN_TILE_PRECISION", "4"))
+RISK_MAP_MAX_TILE_CELLS = int(os.getenv("RISK_MAP_MAX_TILE_CELLS", "1024"))
+# Activity loses half its weight in the map score every half-life
+RISK_MAP_HALF_LIFE_HOURS = float(os.getenv("RISK_MAP_HALF_LIFE_HOURS", "24"))
+RISK_MAP_CACHE_TTL = float(os.getenv("RISK_MAP_CACHE_TTL", "30"))
+
+# Decay sums are kept per epoch so the growth factor stays bounded; epochs older
+# than this many half-lives contribute under 2^-30 and are ignored on read
+_EPOCH_HALF_LIVES = 16
+_MAX_EPOCH_AGE_HALF_LIVES = 30
+
+_GEOHASH_CHARS = frozenset("0123456789bcdefghjkmnpqrstuvwxyz")
+
+SEVERITY_LEVELS = ('low', 'medium', 'high', 'critical')
+_SEVERITY_RANKS = {level: rank for rank, level in enumerate(SEVERITY_LEVELS, start=1)}
+
+
+def severity_rank(value: Any) -> int:
+    """1..4 for low..critical (incident severity_level or assessment risk_level), 1 when unknown"""
+    return _SEVERITY_RANKS.get(str(value or '').strip().lower(), 1)
+
+
+class RiskMapAggregator:
+    """Per-geohash-cell counts, max severity and a time-decayed score, updated incrementally
+
+    Every incident or assessment adds field transforms (Increment / Maximum)
+    for its cell to the write batch that stores it, so the map never needs a
+    collection rescan and concurrent instances can't lose updates. The decayed
+    score is stored as sum(weight * 2^((t - epoch_start) / half_life)) per
+    epoch and scaled to "now" when read.
+    """
+
+    def __init__(self, cells_ref, precision: int = RISK_MAP_PRECISION,
+                 half_life_hours: float = RISK_MAP_HALF_LIFE_HOURS,
+                 cache_ttl: float = RISK_MAP_CACHE_TTL, clock=time.time,
+                 min_tile_precision: int = RISK_MAP_MIN_TILE_PRECISION,
+                 max_tile_cells: int = RISK_MAP_MAX_TILE_CELLS):
+        self.cells_ref = cells_ref
+        self.precision = precision
+        self.min_tile_precision = min(min_tile_precision, precision)
+        self.max_tile_cells = max_tile_cells
+        self.half_life = half_life_hours * 3600.0
+        self.epoch_seconds = self.half_life * _EPOCH_HALF_LIVES
+        self._clock = clock
+        self.tiles = TTLCache(maxsize=256, ttl=cache_ttl)
+
+    def add_event(self, batch, geohash: str, kind: str, severity: int,
+                  at: Optional[float] = None) -> Optional[str]:
+        """Queue the cell update for one stored incident/assessment; returns the cell ID"""
+        if not geohash or len(geohash) < self.precision:
+            return None
+        cell = geohash[:self.precision]
+        at = self._clock() if at is None else at
+        epoch = int(at // self.epoch_seconds)
+        growth = 2.0 ** ((at - epoch * self.epoch_seconds) / self.half_life)
+
+        batch.set(self.cells_ref.document(cell), {
+            'cell': cell,
+            f'{kind}_count': firestore.Increment(1),
+            'max_severity': firestore.Maximum(severity),
+            'decay': {str(epoch): firestore.Increment(severity * growth)},
+            'updated_at': firestore.SERVER_TIMESTAMP
+        }, merge=True)
+        return cell
+
+    def cell_view(self, data: Dict[str, Any], now: Optional[float] = None) -> Dict[str, Any]:
+        """Public shape of a cell with its decayed score evaluated at now"""
+        now = self._clock() if now is None else now
+        score = 0.0
+        for epoch, value in (data.get('decay') or {}).items():
+            epoch_start = int(epoch) * self.epoch_seconds
+            age = (now - epoch_start) / self.half_life
+            if age <= _MAX_EPOCH_AGE_HALF_LIVES + _EPOCH_HALF_LIVES:
+                score += value * 2.0 ** -age
+        lat, lon = geohash_center(data['cell'])
+        max_severity = int(data.get('max_severity') or 0)
+        return {
+            'geohash': data['cell'],
+            'lat': round(lat, 5),
+            'lon': round(lon, 5),
+            'incident_count': data.get('incident_count', 0),
+            'assessment_count': data.get('assessment_count', 0),
+            'max_severity': SEVERITY_LEVELS[max_severity - 1] if max_severity else None,
+            'score': round(score, 3)
+        }
+
+    def read_tile(self, tile: str) -> Dict[str, Any]:
+        """Cells whose geohash starts with tile - served from the instance cache when fresh
+
+        Tiles shorter than min_tile_precision are rejected, and at most
+        max_tile_cells cells are read, so one request can't scan the map.
+        """
+        tile = tile.lower()[:self.precision]
+        if any(char not in _GEOHASH_CHARS for char in tile):
+            raise ValueError(f"Invalid geohash tile: {tile!r}")
+        if len(tile) < self.min_tile_precision:
+            raise ValueError(f"Tile must be at least {self.min_tile_precision} geohash characters: {tile!r}")
+        cached = self.tiles.get(tile)
+        if cached is None:
+            # Document IDs are the cell geohashes, so a tile is one ID range query
+            start = self.cells_ref.document(tile)
+            end = self.cells_ref.document(tile + '~')
+            docs = (self.cells_ref
+                    .where(filter=firestore.FieldFilter(FieldPath.document_id(), '>=', start))
+                    .where(filter=firestore.FieldFilter(FieldPath.document_id(), '<', end))
+                    .limit(self.max_tile_cells)
+                    .stream())
+            cached = {'tile': tile, 'cells': [doc.to_dict() for doc in docs], 'fetched_at': self._clock()}
+            if len(cached['cells']) >= self.max_tile_cells:
+                log.warning("⚠️ Risk map tile hit the cell cap", tile=tile, max_tile_cells=self.max_tile_cells)
+            self.tiles.set(tile, cached)
+
+        now = self._clock()
+        cells = [self.cell_view(data, now) for data in cached['cells'] if data.get('cell')]
+        cells.sort(key=lambda c: c['score'], reverse=True)
+        return {
+            'tile': tile,
+            'cells': cells,
+            'as_of': datetime.fromtimestamp(now, timezone.utc).isoformat(),
+            'data_age_seconds': round(now - cached['fetched_at'], 1)
+        }
+
+
+def build_risk_map(db) -> RiskMapAggregator:
+    return RiskMapAggregator(db.collection('arems-profiles').document('risk-map').collection('cells'))
+
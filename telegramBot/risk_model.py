@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import threading
+from itertools import repeat
+from typing import Any, Dict, Iterable, Optional
+
+import numpy as np
+
+from structured_logging import get_logger
+
+log = get_logger(__name__)
+
+# Where the active model comes from: '' (built-in tables), 'file' or 'firestore'
+RISK_MODEL_SOURCE = os.getenv("RISK_MODEL_SOURCE", "").lower()
+RISK_MODEL_PATH = os.getenv("RISK_MODEL_PATH", "risk_model.json")
+# How often an instance checks the source for a new version
+RISK_MODEL_REFRESH_SECONDS = float(os.getenv("RISK_MODEL_REFRESH_SECONDS", "60"))
+
+# The tables the platform shipped with - used when no source is configured
+DEFAULT_TABLES = {
+    'version': 'builtin-1',
+    'base_scores': {
+        'natural_disaster': 40,
+        'technological_hazard': 30,
+        'biological_hazard': 35,
+        'security_threat': 25
+    },
+    'default_base_score': 20,
+    'population_multipliers': {
+        'vulnerable_groups': 1.5,
+        'general_population': 1.0,
+        'emergency_workers': 1.2,
+        'tourists': 1.3
+    },
+    'default_multiplier': 1.0,
+    'max_score': 100,
+    # Geospatial uplift: score * (1 + hazard_weight * hazard_index + density_weight * density_index),
+    # where both indexes are 0..1 raster reads (see geo_risk) and 0 when the area can't be placed
+    'geo_hazard_weight': 0.5,
+    'geo_density_weight': 0.25,
+    # Lower bounds of every level but the first, ascending
+    'level_thresholds': [40, 60, 80],
+    'risk_levels': ['LOW', 'MEDIUM', 'HIGH', 'CRITICAL']
+}
+
+
+class RiskModel:
+    """One version of the scoring tables, compiled into lookup arrays
+
+    The (hazard x population) score table includes an "unknown" code on each
+    axis and is filled with the scalar score(), so batch and scalar results
+    are identical by construction.
+    """
+
+    def __init__(self, tables: Dict[str, Any]):
+        self.version = str(tables['version'])
+        self.base_scores = {str(k): float(v) for k, v in tables['base_scores'].items()}
+        self.default_base_score = float(tables.get('default_base_score', 0))
+        self.population_multipliers = {str(k): float(v) for k, v in tables['population_multipliers'].items()}
+        self.default_multiplier = float(tables.get('default_multiplier', 1.0))
+        self.max_score = int(tables.get('max_score', 100))
+        self.geo_hazard_weight = float(tables.get('geo_hazard_weight', 0.0))
+        self.geo_density_weight = float(tables.get('geo_density_weight', 0.0))
+        self.level_thresholds = [float(t) for t in tables['level_thresholds']]
+        self.risk_levels = [str(level) for level in tables['risk_levels']]
+
+        if len(self.risk_levels) != len(self.level_thresholds) + 1:
+            raise ValueError(f"Risk model {self.version}: need exactly one more level than thresholds")
+        if self.level_thresholds != sorted(self.level_thresholds):
+            raise ValueError(f"Risk model {self.version}: level_thresholds must be ascending")
+
+        self.hazard_codes = {h: i for i, h in enumerate(self.base_scores)}
+        self.population_codes = {p: i for i, p in enumerate(self.population_multipliers)}
+        self.score_table = np.array(
+            [[self.score(h, p) for p in [*self.population_multipliers, None]]
+             for h in [*self.base_scores, None]],
+            dtype=np.int16)
+        self._thresholds = np.asarray(self.level_thresholds)
+        self._levels = np.asarray(self.risk_levels, dtype=object)
+
+    # Scalar scoring - one assessment at a time
+
+    def score(self, hazard_type, population_risk) -> int:
+        base_score = self.base_scores.get(hazard_type, self.default_base_score)
+        multiplier = self.population_multipliers.get(population_risk, self.default_multiplier)
+        return min(int(base_score * multiplier), self.max_score)
+
+    def combine(self, score, hazard_index: float = 0.0, density_index: float = 0.0) -> int:
+        """Apply the geospatial uplift to a hazard x population score"""
+        factor = 1.0 + self.geo_hazard_weight * hazard_index + self.geo_density_weight * density_index
+        return min(int(score * factor), self.max_score)
+
+    def level(self, score) -> str:
+        for threshold, level in zip(reversed(self.level_thresholds), reversed(self.risk_levels)):
+            if score >= threshold:
+                return level
+        return self.risk_levels[0]
+
+    # Batch scoring - whole columns through the compiled arrays
+
+    def encode_hazards(self, hazard_types: Iterable[Any]) -> np.ndarray:
+        # Same dict semantics as the scalar lookup; map() keeps the per-row work in C
+        return np.fromiter(map(self.hazard_codes.get, hazard_types, repeat(len(self.hazard_codes))), dtype=np.intp)
+
+    def encode_populations(self, populations: Iterable[Any]) -> np.ndarray:
+        return np.fromiter(map(self.population_codes.get, populations, repeat(len(self.population_codes))),
+                           dtype=np.intp)
+
+    def score_codes(self, hazard_codes: np.ndarray, population_codes: np.ndarray) -> np.ndarray:
+        return self.score_table[hazard_codes, population_codes]
+
+    def combine_batch(self, scores: np.ndarray, hazard_index: np.ndarray, density_index: np.ndarray) -> np.ndarray:
+        """Vectorized combine() - same float64 operations, truncated like int()"""
+        factor = 1.0 + self.geo_hazard_weight * hazard_index + self.geo_density_weight * density_index
+        return np.minimum(np.trunc(scores * factor), self.max_score).astype(np.int16)
+
+    def level_codes(self, scores: np.ndarray) -> np.ndarray:
+        """Index into risk_levels for each score"""
+        return np.searchsorted(self._thresholds, scores, side='right')
+
+    def levels(self, scores: np.ndarray) -> np.ndarray:
+        return self._levels[self.level_codes(scores)]
+
+
+class FileModelSource:
+    """Model tables in a JSON file - re-read only when its mtime changes"""
+
+    def __init__(self, path: str = RISK_MODEL_PATH):
+        self.path = path
+        self._mtime = None
+
+    def fetch(self) -> Optional[Dict[str, Any]]:
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self._mtime:
+            return None
+        with open(self.path, encoding='utf-8') as f:
+            tables = json.load(f)
+        self._mtime = mtime
+        return tables
+
+
+class FirestoreModelSource:
+    """Model tables in one Firestore document (arems-profiles/risk-model by default)"""
+
+    def __init__(self, doc_ref):
+        self.doc_ref = doc_ref
+
+    def fetch(self) -> Optional[Dict[str, Any]]:
+        doc = self.doc_ref.get()
+        return doc.to_dict() if doc.exists else None
+
+
+class RiskModelRegistry:
+    """Holds the active RiskModel and hot-swaps it when the source's version changes
+
+    get() never blocks on a refresh: one caller re-checks the source every
+    refresh_seconds while the others keep scoring with the current model. A
+    model is compiled only when its version differs from the active one, and
+    a broken source leaves the last good model in place.
+    """
+
+    def __init__(self, source=None, refresh_seconds: float = RISK_MODEL_REFRESH_SECONDS,
+                 clock=time.monotonic):
+        self.source = source
+        self.refresh_seconds = refresh_seconds
+        self._clock = clock
+        self._model = RiskModel(DEFAULT_TABLES)
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self.reloads = 0
+
+    def get(self) -> RiskModel:
+        if self.source is not None and self._clock() >= self._next_check and self._lock.acquire(blocking=False):
+            try:
+                self._refresh()
+            finally:
+                self._next_check = self._clock() + self.refresh_seconds
+                self._lock.release()
+        return self._model
+
+    def _refresh(self) -> None:
+        try:
+            tables = self.source.fetch()
+            if not tables or str(tables.get('version')) == self._model.version:
+                return
+            model = RiskModel(tables)
+        except Exception as e:
+            log.warning("⚠️ Risk model refresh failed - keeping current model",
+                        version=self._model.version, error=str(e))
+            return
+        log.info("🔄 Risk model reloaded", previous_version=self._model.version, version=model.version)
+        self._model = model
+        self.reloads += 1
+
+
+def build_model_registry(db=None, source: str = RISK_MODEL_SOURCE) -> RiskModelRegistry:
+    """Create the registry for the configured model source"""
+    if source == "file":
+        return RiskModelRegistry(FileModelSource(RISK_MODEL_PATH))
+    if source == "firestore":
+        if db is None:
+            raise ValueError("RISK_MODEL_SOURCE=firestore needs a Firestore client")
+        return RiskModelRegistry(FirestoreModelSource(db.collection('arems-profiles').document('risk-model')))
+    if source:
+        raise ValueError(f"Unknown RISK_MODEL_SOURCE: {source}")
+    return RiskModelRegistry()
+
+
+def load_model(path: Optional[str] = None) -> RiskModel:
+    """Compile a model from a JSON file, or the built-in tables when path is None"""
+    if path is None:
+        return RiskModel(DEFAULT_TABLES)
+    with open(path, encoding='utf-8') as f:
+        return RiskModel(json.load(f))
+
@@ -0,0 +1,191 @@
+"""Risk scoring - scalar functions used by the webhook and re-scoring jobs
+
+Re-score assessments with a compiled risk model (built-in tables unless
+--model points at a model JSON) after the weights change:
+
+    python risk_scoring.py --model risk_model.json file assessments.jsonl -o rescored.jsonl
+    python risk_scoring.py --model risk_model.json firestore --dry-run
+
+Exports are JSON lines or CSV with hazard_type and population_at_risk columns;
+a stored 'geo' map (hazard_index, density_index) keeps its geospatial uplift.
+"""
+import csv
+import sys
+import json
+import argparse
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from risk_model import RiskModel, load_model
+from structured_logging import get_logger
+
+log = get_logger(__name__)
+
+# Used when a caller doesn't pass the model it scored with
+_builtin_model = load_model()
+
+
+def calculate_risk_score(hazard_type, population_risk, model: Optional[RiskModel] = None,
+                         geo: Optional[Dict[str, Any]] = None):
+    """Calculate risk score based on hazard, population and, when placed, location"""
+    model = model or _builtin_model
+    final_score = model.score(hazard_type, population_risk)
+    if geo:
+        final_score = model.combine(final_score, geo['hazard_index'], geo['density_index'])
+
+    log.debug("🧮 Risk calculation",
+              hazard_type=hazard_type, population_at_risk=population_risk,
+              geo=geo, score=final_score, model_version=model.version)
+
+    return final_score
+
+
+def get_risk_level(score, model: Optional[RiskModel] = None):
+    """Convert risk score to risk level"""
+    return (model or _builtin_model).level(score)
+
+
+# ============================================================================
+# RE-SCORING CLI
+# ============================================================================
+
+def _read_rows(path: str) -> List[Dict[str, Any]]:
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.csv'):
+            return list(csv.DictReader(f))
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _write_rows(path: Optional[str], rows: List[Dict[str, Any]], csv_format: bool) -> None:
+    out = open(path, 'w', newline='', encoding='utf-8') if path else sys.stdout
+    try:
+        if csv_format:
+            writer = csv.DictWriter(out, fieldnames=list(dict.fromkeys(k for row in rows for k in row)))
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                out.write(json.dumps(row, default=str) + '\n')
+    finally:
+        if path:
+            out.close()
+
+
+def rescore_rows(rows: Sequence[Dict[str, Any]], model: Optional[RiskModel] = None) -> Dict[str, Any]:
+    """Overwrite risk_score / risk_level / model_version in place and return a change summary"""
+    model = model or _builtin_model
+    scores = model.score_codes(model.encode_hazards([r.get('hazard_type') for r in rows]),
+                               model.encode_populations([r.get('population_at_risk') for r in rows]))
+    # Geospatial indexes recorded at assessment time (absent -> no uplift)
+    geo = [r.get('geo') if isinstance(r.get('geo'), dict) else {} for r in rows]
+    scores = model.combine_batch(scores,
+                                 np.fromiter((g.get('hazard_index', 0.0) for g in geo), dtype=np.float64, count=len(rows)),
+                                 np.fromiter((g.get('density_index', 0.0) for g in geo), dtype=np.float64, count=len(rows)))
+    levels = model.levels(scores)
+
+    changed = Counter()
+    for row, score, level in zip(rows, scores.tolist(), levels):
+        previous = row.get('risk_level')
+        if previous is not None and previous != level:
+            changed[f"{previous}->{level}"] += 1
+        row['risk_score'] = score
+        row['risk_level'] = level
+        row['model_version'] = model.version
+    return {
+        'rows': len(rows),
+        'model_version': model.version,
+        'levels': dict(Counter(levels.tolist())),
+        'level_changes': dict(changed),
+    }
+
+
+def rescore_firestore(db, model: RiskModel, page_size: int = 500, dry_run: bool = False) -> Dict[str, Any]:
+    """Re-score stored assessments page by page with one compiled model
+
+    Pages are read in document-ID order and scored as a batch; only documents
+    recorded with another model version are rewritten, one WriteBatch per page,
+    so an interrupted job can simply be run again.
+    """
+    from google.cloud import firestore
+
+    assessments_ref = db.collection('arems-profiles').document('risk-assessments').collection('assessments')
+    summary = Counter()
+    level_changes = Counter()
+    last_doc = None
+    while True:
+        query = assessments_ref.order_by('__name__').limit(page_size)
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        docs = list(query.stream())
+        if not docs:
+            break
+        last_doc = docs[-1]
+
+        stale, rows = [], []
+        for doc in docs:
+            data = doc.to_dict() or {}
+            if data.get('model_version') != model.version:
+                stale.append(doc)
+                rows.append(data)
+        page = rescore_rows(rows, model)
+        level_changes.update(page['level_changes'])
+        summary['scanned'] += len(docs)
+        summary['rescored'] += len(rows)
+
+        if rows and not dry_run:
+            batch = db.batch()
+            for doc, row in zip(stale, rows):
+                batch.update(doc.reference, {
+                    'risk_score': row['risk_score'],
+                    'risk_level': row['risk_level'],
+                    'model_version': model.version,
+                    'rescored_at': firestore.SERVER_TIMESTAMP
+                })
+            batch.commit()
+        log.info("📊 Re-scored assessment page", scanned=summary['scanned'], rescored=summary['rescored'],
+                 dry_run=dry_run)
+
+    return {**summary, 'model_version': model.version, 'level_changes': dict(level_changes), 'dry_run': dry_run}
+
+
+def _rescore_file(args, model: RiskModel) -> Dict[str, Any]:
+    rows = _read_rows(args.input)
+    summary = rescore_rows(rows, model)
+    _write_rows(args.output, rows, (args.output or args.input).endswith('.csv'))
+    return summary
+
+
+def _rescore_firestore(args, model: RiskModel) -> Dict[str, Any]:
+    from google.cloud import firestore
+
+    db = firestore.Client(project=args.project, database=args.database)
+    return rescore_firestore(db, model, page_size=args.page_size, dry_run=args.dry_run)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', help='Risk model JSON to score with (default: built-in tables)')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    from_file = sub.add_parser('file', help='Re-score an exported dataset')
+    from_file.add_argument('input', help='Exported assessments (.jsonl or .csv)')
+    from_file.add_argument('-o', '--output', help='Where to write the re-scored rows (default: stdout)')
+    from_file.set_defaults(func=_rescore_file)
+
+    stored = sub.add_parser('firestore', help='Re-score stored assessments in place')
+    stored.add_argument('--project', default='arems-project')
+    stored.add_argument('--database', default='arems-platform-core-db')
+    stored.add_argument('--page-size', type=int, default=500)
+    stored.add_argument('--dry-run', action='store_true')
+    stored.set_defaults(func=_rescore_firestore)
+
+    args = parser.parse_args(argv)
+    # Compiled once and reused for every row and page
+    model = load_model(args.model)
+    print(json.dumps(args.func(args, model)), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+import os
+import json
+import time
+import struct
+import hashlib
+import threading
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from answer_cache import normalize_query, ANSWER_CACHE_TTL
+from structured_logging import get_logger
+
+log = get_logger(__name__)
+
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.6"))
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "/tmp/arems-semantic-index.json")
+# Optional object in the uploads bucket the index is loaded from and saved to
+SEMANTIC_CACHE_GCS_OBJECT = os.getenv("SEMANTIC_CACHE_GCS_OBJECT", "")
+# Persist after this many newly indexed questions
+SEMANTIC_CACHE_SAVE_EVERY = int(os.getenv("SEMANTIC_CACHE_SAVE_EVERY", "20"))
+# Past this size the least recently matched questions are evicted
+SEMANTIC_CACHE_MAX_QUESTIONS = int(os.getenv("SEMANTIC_CACHE_MAX_QUESTIONS", "100000"))
+# Read-merge-write rounds against the shared GCS copy before a save gives up
+SEMANTIC_CACHE_SAVE_ATTEMPTS = int(os.getenv("SEMANTIC_CACHE_SAVE_ATTEMPTS", "5"))
+
+# 32 bands x 4 rows - pairs at Jaccard 0.6 collide in at least one band ~99% of the time
+NUM_PERMUTATIONS = 128
+BANDS = 32
+ROWS_PER_BAND = NUM_PERMUTATIONS // BANDS
+
+# Universal hashing modulo the largest 32-bit prime keeps every product inside uint64
+_PRIME = (1 << 32) - 5
+
+# Words that carry no meaning for matching disaster questions
+STOPWORDS = frozenset("""
+a an the is are was were be been am do does did i me my we our you your it its to of in on at
+for from by with and or what where when how which who whom can could should would will shall
+there here this that these those please tell about any some if so up out into as just
+""".split())
+
+# Fixed seed so signatures are stable across processes and persisted indexes
+_rng = np.random.default_rng(0xA4E35)
+_PERM_A = _rng.integers(1, _PRIME, size=NUM_PERMUTATIONS, dtype=np.uint64)
+_PERM_B = _rng.integers(0, _PRIME, size=NUM_PERMUTATIONS, dtype=np.uint64)
+
+
+def question_features(question: str) -> FrozenSet[str]:
+    """Content words plus adjacent-word bigrams of the normalized question"""
+    words = [w for w in normalize_query(question).split() if w not in STOPWORDS]
+    features = set(words)
+    features.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+    return frozenset(features)
+
+
+def _feature_hash(feature: str) -> int:
+    return struct.unpack("<I", hashlib.blake2b(feature.encode("utf-8"), digest_size=4).digest())[0]
+
+
+def minhash_signature(features: Iterable[str]) -> np.ndarray:
+    hashes = np.fromiter((_feature_hash(f) for f in features), dtype=np.uint64)
+    if not hashes.size:
+        return np.empty(0, dtype=np.uint64)
+    return ((np.outer(hashes, _PERM_A) + _PERM_B) % _PRIME).min(axis=0)
+
+
+def _band_keys(signature: np.ndarray) -> List[Tuple[int, bytes]]:
+    rows = signature.reshape(BANDS, ROWS_PER_BAND)
+    return [(band, rows[band].tobytes()) for band in range(BANDS)]
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class SemanticQueryIndex:
+    """MinHash-LSH index mapping new questions to previously answered near-duplicates
+
+    Candidates come from LSH band collisions and are confirmed with the exact
+    Jaccard similarity of their feature sets, so lookups stay sub-linear in the
+    number of indexed questions. Each question carries its answer and sources
+    until ttl passes (wall clock, so copies shared through GCS agree), so a
+    match never depends on another cache still holding the answer; expired
+    questions are dropped as lookups meet them and left out of saves.
+    Questions are kept in recency order (a match refreshes one), and once
+    max_questions is reached the oldest is evicted.
+    """
+
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 max_questions: int = SEMANTIC_CACHE_MAX_QUESTIONS,
+                 ttl: float = ANSWER_CACHE_TTL, clock=time.time):
+        self.threshold = threshold
+        self.max_questions = max_questions
+        self.ttl = ttl
+        self._clock = clock
+        self._features: Dict[str, FrozenSet[str]] = {}
+        # key -> {"answer", "sources", "expires_at"}
+        self._answers: Dict[str, Dict[str, Any]] = {}
+        self._buckets: Dict[Tuple[int, bytes], List[str]] = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._saving = False
+        self.unsaved = 0
+
+    def __len__(self) -> int:
+        return len(self._features)
+
+    def add(self, question: str, answer: str, sources: Iterable[str] = (),
+            expires_at: Optional[float] = None) -> Optional[str]:
+        """Index a question with its answer; returns its cache key (the normalized question)
+
+        Re-adding a question replaces its answer and extends its expiry.
+        """
+        key = normalize_query(question)
+        features = question_features(question)
+        if not key or not features:
+            return None
+        entry = {"answer": answer, "sources": list(sources),
+                 "expires_at": self._clock() + self.ttl if expires_at is None else expires_at}
+        with self._lock:
+            if key in self._features:
+                self._answers[key] = entry
+                return key
+        signature = minhash_signature(features)
+        with self._lock:
+            if key in self._features:
+                self._answers[key] = entry
+                return key
+            while len(self._features) >= self.max_questions:
+                # Dicts keep insertion order, so the first key is the stalest
+                self._remove(next(iter(self._features)))
+            self._features[key] = features
+            self._answers[key] = entry
+            for band_key in _band_keys(signature):
+                self._buckets.setdefault(band_key, []).append(key)
+            self.unsaved += 1
+        return key
+
+    def _remove(self, key: str) -> None:
+        # Caller holds the lock
+        self._answers.pop(key, None)
+        for band_key in _band_keys(minhash_signature(self._features.pop(key))):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.remove(key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def _live(self, key: str, now: float) -> bool:
+        # Caller holds the lock; an expired question leaves the index when first met
+        if self._answers[key]["expires_at"] > now:
+            return True
+        self._remove(key)
+        return False
+
+    def lookup(self, question: str) -> Optional[Tuple[str, float, Dict[str, Any]]]:
+        """(cache key, similarity, {"answer", "sources"}) of the closest live question above the threshold
+
+        Candidates are tried best first, so an expired best match falls
+        through to the next one instead of ending the lookup.
+        """
+        features = question_features(question)
+        if not features:
+            return None
+        key = normalize_query(question)
+        now = self._clock()
+        with self._lock:
+            if key in self._features and self._live(key, now):
+                self._touch(key)
+                return key, 1.0, self._public(key)
+        band_keys = _band_keys(minhash_signature(features))
+        with self._lock:
+            candidates = set()
+            for band_key in band_keys:
+                candidates.update(self._buckets.get(band_key, ()))
+            scored = [(jaccard(features, self._features[candidate]), candidate) for candidate in candidates]
+            for score, candidate in sorted(scored, reverse=True):
+                if score < self.threshold:
+                    break
+                if self._live(candidate, now):
+                    self._touch(candidate)
+                    return candidate, score, self._public(candidate)
+        return None
+
+    def _public(self, key: str) -> Dict[str, Any]:
+        entry = self._answers[key]
+        return {"answer": entry["answer"], "sources": list(entry["sources"])}
+
+    def _touch(self, key: str) -> None:
+        # Move a matched question to the young end of the eviction order
+        self._features[key] = self._features.pop(key)
+
+    def needs_save(self, every: int = SEMANTIC_CACHE_SAVE_EVERY) -> bool:
+        return self.unsaved >= every
+
+    def to_json(self) -> str:
+        """Live questions with their answers, least recently matched first"""
+        now = self._clock()
+        with self._lock:
+            entries = [{"question": key, **self._answers[key]} for key in self._features
+                       if self._answers[key]["expires_at"] > now]
+        return json.dumps({"version": 2, "entries": entries})
+
+    def merge_json(self, raw: str) -> int:
+        """Add the live questions from a serialized index - signatures are recomputed
+
+        Version 1 files carry no answers and are ignored. For a question
+        already indexed, the later expiry wins.
+        """
+        count = 0
+        now = self._clock()
+        for item in json.loads(raw).get("entries", []):
+            expires_at = float(item.get("expires_at") or 0)
+            if expires_at <= now:
+                continue
+            key = normalize_query(item.get("question", ""))
+            with self._lock:
+                current = self._answers.get(key)
+            if current is not None:
+                if expires_at > current["expires_at"]:
+                    self.add(key, item["answer"], item.get("sources") or (), expires_at=expires_at)
+                continue
+            if self.add(key, item["answer"], item.get("sources") or (), expires_at=expires_at):
+                count += 1
+        return count
+
+    def load_json(self, raw: str) -> int:
+        count = self.merge_json(raw)
+        self.unsaved = 0
+        return count
+
+    def save(self, path: str = SEMANTIC_CACHE_PATH, bucket=None, gcs_object: str = SEMANTIC_CACHE_GCS_OBJECT) -> None:
+        """Persist to a local file and, when configured, merge into the shared GCS copy
+
+        Other instances save the same object, so each round reads the remote
+        index, merges it in and writes back only if the object's generation is
+        unchanged; a concurrent writer makes the round start over.
+        """
+        unsaved = self.unsaved
+        if bucket is not None and gcs_object:
+            # Questions merged in from the remote copy are already saved there
+            unsaved += self._save_gcs(bucket, gcs_object)
+        raw = self.to_json()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(raw)
+        os.replace(tmp_path, path)
+        # Questions added while saving stay counted for the next save
+        self.unsaved = max(0, self.unsaved - unsaved)
+
+    def _save_gcs(self, bucket, gcs_object: str) -> int:
+        from google.api_core.exceptions import NotFound, PreconditionFailed
+
+        merged = 0
+        for attempt in range(1, SEMANTIC_CACHE_SAVE_ATTEMPTS + 1):
+            blob = bucket.get_blob(gcs_object)
+            # Generation 0 means "only if the object doesn't exist yet"
+            generation = blob.generation if blob is not None else 0
+            try:
+                if blob is not None:
+                    merged += self.merge_json(blob.download_as_text(if_generation_match=generation))
+                bucket.blob(gcs_object).upload_from_string(self.to_json(), content_type="application/json",
+                                                           if_generation_match=generation)
+                return merged
+            except (PreconditionFailed, NotFound):
+                log.info("🔁 Semantic index changed remotely - merging again", attempt=attempt)
+        raise RuntimeError(f"Semantic index save lost {SEMANTIC_CACHE_SAVE_ATTEMPTS} races for {gcs_object}")
+
+    def save_in_background(self, **kwargs) -> bool:
+        """Start save() on a daemon thread unless one is already running; returns whether it started"""
+        with self._save_lock:
+            if self._saving:
+                return False
+            self._saving = True
+
+        def run():
+            try:
+                self.save(**kwargs)
+            except Exception as e:
+                log.warning("⚠️ Could not save semantic query index", error=str(e))
+            finally:
+                with self._save_lock:
+                    self._saving = False
+
+        threading.Thread(target=run, name="semantic-index-save", daemon=True).start()
+        return True
+
+    def load(self, path: str = SEMANTIC_CACHE_PATH, bucket=None, gcs_object: str = SEMANTIC_CACHE_GCS_OBJECT) -> int:
+        """Load from a local file, falling back to GCS on a cold instance"""
+        try:
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    return self.load_json(f.read())
+            if bucket is not None and gcs_object:
+                blob = bucket.blob(gcs_object)
+                if blob.exists():
+                    return self.load_json(blob.download_as_text())
+        except Exception as e:
+            log.warning("⚠️ Could not load semantic query index", error=str(e))
+        return 0
@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import random
+import logging
+import contextvars
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+# Per-route sampling of sub-WARNING logs, e.g. "telegram=0.1,dialogflow=1"
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "300"))
+LOG_MAX_ITEMS = int(os.getenv("LOG_MAX_ITEMS", "20"))
+LOG_MAX_DEPTH = 4
+
+# Field names whose values never reach the logs
+REDACTED_KEYS = frozenset(
+    k.strip().lower() for k in os.getenv(
+        "LOG_REDACTED_KEYS", "contact_info,phone,phone_number,token,password,first_name,last_name"
+    ).split(",") if k.strip()
+)
+
+_route = contextvars.ContextVar("log_route", default=None)
+_sampled = contextvars.ContextVar("log_sampled", default=True)
+
+
+def _parse_sample_rates(raw: str) -> Dict[str, float]:
+    rates = {}
+    for part in raw.split(","):
+        if "=" in part:
+            route, rate = part.split("=", 1)
+            rates[route.strip()] = float(rate)
+    return rates
+
+
+SAMPLE_RATES = _parse_sample_rates(LOG_SAMPLE_RATES)
+
+
+def begin_request(route: str) -> bool:
+    """Tag the current request with a route and decide once whether its info logs are kept"""
+    _route.set(route)
+    sampled = random.random() < SAMPLE_RATES.get(route, 1.0)
+    _sampled.set(sampled)
+    return sampled
+
+
+def current_route() -> Optional[str]:
+    return _route.get()
+
+
+def sanitize(value: Any, depth: int = 0) -> Any:
+    """Redact sensitive keys and truncate long strings/collections so payloads stay cheap to log"""
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, str):
+        if len(value) > LOG_MAX_FIELD_CHARS:
+            return f"{value[:LOG_MAX_FIELD_CHARS]}…(+{len(value) - LOG_MAX_FIELD_CHARS} chars)"
+        return value
+    if depth >= LOG_MAX_DEPTH:
+        return "…"
+    if isinstance(value, dict):
+        out = {}
+        for i, (k, v) in enumerate(value.items()):
+            if i >= LOG_MAX_ITEMS:
+                out["…"] = f"+{len(value) - LOG_MAX_ITEMS} keys"
+                break
+            key = str(k)
+            out[key] = "[REDACTED]" if key.lower() in REDACTED_KEYS else sanitize(v, depth + 1)
+        return out
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = list(value)
+        out = [sanitize(v, depth + 1) for v in items[:LOG_MAX_ITEMS]]
+        if len(items) > LOG_MAX_ITEMS:
+            out.append(f"…(+{len(items) - LOG_MAX_ITEMS} items)")
+        return out
+    return sanitize(str(value), depth)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line - Cloud Logging picks up severity and message"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "severity": record.levelname,
+            "message": record.getMessage(),
+            "logger": record.name,
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+        }
+        route = getattr(record, "route", None)
+        if route:
+            entry["route"] = route
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["traceback"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class StructuredLogger:
+    """Thin wrapper over logging.Logger - fields are only sanitized and serialized if the line is emitted
+
+    Field values may be zero-argument callables for anything expensive to compute.
+    Sub-WARNING lines from requests that lost the route's sampling draw are dropped;
+    warnings and errors are always kept.
+    """
+
+    def __init__(self, name: str):
+        self._logger = logging.getLogger(name)
+
+    def isEnabledFor(self, level: int) -> bool:
+        return self._logger.isEnabledFor(level)
+
+    def log(self, level: int, message: str, exc_info: Any = None, **fields: Any) -> None:
+        if not self._logger.isEnabledFor(level):
+            return
+        if level < logging.WARNING and not _sampled.get():
+            return
+        clean = {k: sanitize(v() if callable(v) else v) for k, v in fields.items()}
+        self._logger.log(level, message, exc_info=exc_info, stacklevel=3,
+                         extra={"fields": clean, "route": _route.get()})
+
+    def debug(self, message: str, **fields: Any) -> None:
+        self.log(logging.DEBUG, message, **fields)
+
+    def info(self, message: str, **fields: Any) -> None:
+        self.log(logging.INFO, message, **fields)
+
+    def warning(self, message: str, **fields: Any) -> None:
+        self.log(logging.WARNING, message, **fields)
+
+    def error(self, message: str, **fields: Any) -> None:
+        self.log(logging.ERROR, message, **fields)
+
+    def exception(self, message: str, **fields: Any) -> None:
+        """Log at ERROR with the current exception's traceback"""
+        self.log(logging.ERROR, message, exc_info=True, **fields)
+
+
+def get_logger(name: str) -> StructuredLogger:
+    return StructuredLogger(name)
+
+
+def setup_logging(level: str = LOG_LEVEL, stream=None) -> None:
+    """Route all logging through a single JSON-lines handler on stdout"""
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
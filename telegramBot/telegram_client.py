@@ -0,0 +1,190 @@
+import os
+import time
+import asyncio
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from structured_logging import get_logger
+
+log = get_logger(__name__)
+
+# Status codes worth retrying - Telegram flood control and transient server errors
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def retry_after_seconds(response) -> Optional[float]:
+    """Telegram's flood-control wait from the body's parameters.retry_after or the Retry-After header"""
+    if response is None:
+        return None
+    retry_after = None
+    try:
+        retry_after = response.json().get("parameters", {}).get("retry_after")
+    except ValueError:
+        pass
+    if retry_after is None:
+        retry_after = response.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+class TelegramClient:
+    """Shared, keep-alive Telegram Bot API client with pooling, timeouts and retries"""
+
+    def __init__(self, token: Optional[str],
+                 pool_size: Optional[int] = None,
+                 connect_timeout: Optional[float] = None,
+                 read_timeout: Optional[float] = None,
+                 max_retries: Optional[int] = None,
+                 backoff_factor: Optional[float] = None,
+                 max_retry_after: Optional[float] = None):
+        self.token = token
+        self.api_url = f"https://api.telegram.org/bot{token}"
+        self.file_url = f"https://api.telegram.org/file/bot{token}"
+
+        self.pool_size = pool_size or int(os.getenv("TELEGRAM_POOL_SIZE", "10"))
+        self.timeout = (
+            connect_timeout or float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "3.05")),
+            read_timeout or float(os.getenv("TELEGRAM_READ_TIMEOUT", "10")),
+        )
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+        self.backoff_factor = backoff_factor if backoff_factor is not None else float(os.getenv("TELEGRAM_BACKOFF_FACTOR", "0.5"))
+        # Never park a function instance longer than this on a single retry_after
+        self.max_retry_after = max_retry_after if max_retry_after is not None else float(os.getenv("TELEGRAM_MAX_RETRY_AFTER", "30"))
+
+        self.session = self._make_session()
+
+    def _make_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def _retry_delay(self, response: Optional[requests.Response], attempt: int) -> float:
+        """Delay before the next attempt - Telegram's retry_after wins over exponential backoff"""
+        retry_after = retry_after_seconds(response)
+        if retry_after is not None:
+            return retry_after
+        return self.backoff_factor * (2 ** attempt)
+
+    def request(self, http_method: str, url: str, **kwargs) -> requests.Response:
+        """Send a request through the pooled session, retrying 429/5xx and connection errors"""
+        kwargs.setdefault("timeout", self.timeout)
+
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = self.session.request(http_method, url, **kwargs)
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    return response
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                log.warning("⚠️ Telegram request failed, retrying", error=e.__class__.__name__, attempt=attempt + 1)
+
+            if response is not None and attempt >= self.max_retries:
+                return response
+
+            delay = self._retry_delay(response, attempt)
+            if delay > self.max_retry_after:
+                log.warning("⚠️ Telegram retry delay exceeds limit - giving up", retry_after=delay)
+                if response is not None:
+                    return response
+                raise requests.ConnectionError(f"Retry delay {delay}s exceeds limit")
+
+            status = response.status_code if response is not None else "no response"
+            log.info("🔁 Retrying Telegram request", delay=round(delay, 2), attempt=attempt + 1, status=status)
+            if response is not None:
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def call(self, method: str, http_method: str = "POST", **kwargs) -> requests.Response:
+        """Call a Bot API method, e.g. call('sendMessage', json={...})"""
+        return self.request(http_method, f"{self.api_url}/{method}", **kwargs)
+
+    def send_message(self, chat_id, text: str, **extra: Any) -> requests.Response:
+        payload: Dict[str, Any] = {"chat_id": chat_id, "text": text}
+        payload.update(extra)
+        return self.call("sendMessage", json=payload)
+
+    def get_file(self, file_id: str) -> requests.Response:
+        return self.call("getFile", http_method="GET", params={"file_id": file_id})
+
+    def download_file(self, file_path: str, stream: bool = False) -> requests.Response:
+        """Download a file previously resolved through getFile"""
+        return self.request("GET", f"{self.file_url}/{file_path}", stream=stream)
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class AsyncTelegramClient(TelegramClient):
+    """TelegramClient on httpx.AsyncClient - same pooling, timeouts and retry policy, awaitable calls"""
+
+    def _make_session(self):
+        import httpx
+
+        connect_timeout, read_timeout = self.timeout
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size))
+
+    async def request(self, http_method: str, url: str, **kwargs):
+        """Send a request, retrying 429/5xx and connection errors without blocking the event loop"""
+        import httpx
+
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = await self.session.request(http_method, url, **kwargs)
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    return response
+            except (httpx.ConnectError, httpx.TimeoutException) as e:
+                if attempt >= self.max_retries:
+                    raise
+                log.warning("⚠️ Telegram request failed, retrying", error=e.__class__.__name__, attempt=attempt + 1)
+
+            if response is not None and attempt >= self.max_retries:
+                return response
+
+            delay = self._retry_delay(response, attempt)
+            if delay > self.max_retry_after:
+                log.warning("⚠️ Telegram retry delay exceeds limit - giving up", retry_after=delay)
+                if response is not None:
+                    return response
+                raise httpx.ConnectError(f"Retry delay {delay}s exceeds limit")
+
+            status = response.status_code if response is not None else "no response"
+            log.info("🔁 Retrying Telegram request", delay=round(delay, 2), attempt=attempt + 1, status=status)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def call(self, method: str, http_method: str = "POST", **kwargs):
+        return await self.request(http_method, f"{self.api_url}/{method}", **kwargs)
+
+    async def send_message(self, chat_id, text: str, **extra: Any):
+        payload: Dict[str, Any] = {"chat_id": chat_id, "text": text}
+        payload.update(extra)
+        return await self.call("sendMessage", json=payload)
+
+    async def get_file(self, file_id: str):
+        return await self.call("getFile", http_method="GET", params={"file_id": file_id})
+
+    async def download_file(self, file_path: str, stream: bool = False):
+        """Download a file previously resolved through getFile - stream=True leaves the body unread (aclose() it)"""
+        if stream:
+            request = self.session.build_request("GET", f"{self.file_url}/{file_path}")
+            return await self.session.send(request, stream=True)
+        return await self.request("GET", f"{self.file_url}/{file_path}")
+
+    async def close(self) -> None:
+        await self.session.aclose()
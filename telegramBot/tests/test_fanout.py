@@ -0,0 +1,60 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fanout import run_steps, run_steps_async
+
+
+def test_inline_step_runs_while_the_pool_is_busy():
+    pool = ThreadPoolExecutor(max_workers=1)
+    release = threading.Event()
+    pool.submit(release.wait)  # every pool thread taken by another update
+    try:
+        stored = []
+        result = run_steps({"store_message": lambda: stored.append(threading.current_thread().name) or 1,
+                            "reply": lambda: time.sleep(0.01)},
+                           executor=pool, queue_timeout=0.05, inline="store_message")
+    finally:
+        release.set()
+        pool.shutdown()
+
+    assert result.results["store_message"] == 1
+    assert stored == [threading.current_thread().name]
+    assert "reply" in result.errors and "store_message" not in result.errors
+
+
+def test_inline_step_error_is_recorded():
+    def store():
+        raise RuntimeError("commit failed")
+
+    result = run_steps({"store_message": store, "reply": lambda: "sent"}, inline="store_message")
+    assert result.errors["store_message"] == "RuntimeError: commit failed"
+    assert result.results == {"reply": "sent"}
+
+
+def test_coroutine_steps_run_on_the_loop_and_are_cancelled_on_timeout():
+    threads = []
+    cancelled = []
+
+    async def store():
+        threads.append(threading.current_thread().name)
+        await asyncio.sleep(0.01)
+        return 1
+
+    async def reply():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def handle():
+        threads.append(threading.current_thread().name)
+        return await run_steps_async({"store_message": store, "reply": reply, "media": lambda: "queued"},
+                                     deadlines={"reply": 0.05}, inline="store_message")
+
+    result = asyncio.run(handle())
+    assert result.results == {"store_message": 1, "media": "queued"}
+    assert result.errors == {"reply": "timed out after 0.05s"}
+    assert threads[0] == threads[1] and cancelled == [True]
@@ -0,0 +1,46 @@
+import threading
+
+from id_generator import IdGenerator, generate_id, id_timestamp
+
+THREADS = 8
+PER_THREAD = 5000
+
+
+def _generate_in_threads(new_id):
+    chunks = [None] * THREADS
+    barrier = threading.Barrier(THREADS)
+
+    def worker(n):
+        barrier.wait()
+        chunks[n] = [new_id() for _ in range(PER_THREAD)]
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return chunks
+
+
+def test_ids_are_unique_across_threads():
+    chunks = _generate_in_threads(lambda: generate_id("MSG"))
+    ids = [i for chunk in chunks for i in chunk]
+    assert len(ids) == THREADS * PER_THREAD
+    assert len(set(ids)) == len(ids)
+
+
+def test_ids_increase_within_each_thread():
+    generator = IdGenerator(node=1)
+    for chunk in _generate_in_threads(lambda: generator.new_id("MSG")):
+        assert all(a < b for a, b in zip(chunk, chunk[1:]))
+
+
+def test_generators_on_different_nodes_never_collide():
+    first, second = IdGenerator(node=1), IdGenerator(node=2)
+    ids = {first.new_ulid() for _ in range(PER_THREAD)} | {second.new_ulid() for _ in range(PER_THREAD)}
+    assert len(ids) == 2 * PER_THREAD
+
+
+def test_id_date_matches_its_timestamp():
+    generated = generate_id("INC")
+    assert generated.split("-")[1] == id_timestamp(generated).strftime("%Y%m%d")
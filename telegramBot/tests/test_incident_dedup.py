@@ -0,0 +1,31 @@
+from incident_dedup import IncidentClusterIndex, parameter_text
+
+
+def test_structured_parameters_become_text():
+    assert parameter_text({"city": "Lagos", "street-address": "Ikeja Road"}) == "Lagos Ikeja Road"
+    assert parameter_text(["flood", "fire"]) == "flood fire"
+    assert parameter_text(3) == "3"
+    assert parameter_text(None) == ""
+
+
+def test_structured_location_reports_cluster():
+    index = IncidentClusterIndex(clock=lambda: 1000.0)
+    location = {"city": "Lagos", "street-address": "Ikeja Road"}
+    first, new = index.add("INC-1", "flood", location)
+    second, again = index.add("INC-2", "Flood", dict(location))
+    assert new and not again
+    assert second is first and first.report_count == 2
+
+
+def test_find_leaves_the_index_unchanged_until_the_report_is_added():
+    index = IncidentClusterIndex(clock=lambda: 1000.0)
+    assert index.find("flood", "ikeja") is None
+    assert len(index) == 0
+
+    cluster, new = index.add("INC-1", "flood", "ikeja", cluster_id="CLU-1")
+    assert new and cluster.cluster_id == "CLU-1"
+    match = index.find("flood", "Ikeja")
+    assert match is cluster and match.report_count == 1
+
+    index.add("INC-2", "flood", "ikeja", cluster_id=match.cluster_id)
+    assert cluster.report_count == 2 and len(index) == 1
@@ -0,0 +1,26 @@
+import time
+
+from media_queue import MEDIA_JOB_MAX_ATTEMPTS, SQLiteMediaQueue, drain_media_queue, is_last_push_attempt
+
+
+def test_last_failed_attempt_gives_the_job_up_once():
+    queue = SQLiteMediaQueue(":memory:")
+    queue.put({"kind": "photo", "chat_id": 7})
+    given_up = []
+
+    def process(job):
+        raise ConnectionError("Telegram unreachable")
+
+    for _ in range(MEDIA_JOB_MAX_ATTEMPTS + 1):
+        drain_media_queue(queue, process, on_give_up=lambda job, error: given_up.append((job["chat_id"], error)))
+
+    assert [(chat_id, type(error)) for chat_id, error in given_up] == [(7, ConnectionError)]
+    assert len(queue) == 0
+
+
+def test_pushed_jobs_are_capped_by_delivery_attempt_or_age():
+    job = {"kind": "document", "chat_id": 7, "enqueued_at": time.time()}
+    assert not is_last_push_attempt(job, 1)
+    assert not is_last_push_attempt(job, None)
+    assert is_last_push_attempt(job, MEDIA_JOB_MAX_ATTEMPTS)
+    assert is_last_push_attempt({**job, "enqueued_at": 0}, None)
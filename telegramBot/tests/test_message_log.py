@@ -0,0 +1,170 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import exceptions as api_exceptions
+from google.cloud import firestore
+
+from id_generator import stable_id
+from message_log import add_message_writes
+from profile_cache import CachedProfile, ProfileCache
+
+BURST = 2000
+
+
+class _Ref:
+    def __init__(self, path):
+        self.path = path
+
+    def collection(self, name):
+        return _Ref(f"{self.path}/{name}" if self.path else name)
+
+    def document(self, name):
+        return _Ref(f"{self.path}/{name}")
+
+
+class _Store:
+    """Docs by path; batches commit atomically and create() fails on an existing doc"""
+
+    def __init__(self):
+        self.docs = {}
+        self.lock = threading.Lock()
+
+    def batch(self):
+        return _Batch(self)
+
+
+class _Batch:
+    def __init__(self, store):
+        self.store = store
+        self.ops = []
+
+    def create(self, ref, data):
+        self.ops.append(("create", ref.path, data))
+
+    def set(self, ref, data, merge=False):
+        self.ops.append(("set", ref.path, data))
+
+    def commit(self):
+        with self.store.lock:
+            if any(op == "create" and path in self.store.docs for op, path, _ in self.ops):
+                raise api_exceptions.AlreadyExists("document exists")
+            for _, path, data in self.ops:
+                doc = self.store.docs.setdefault(path, {})
+                for key, value in data.items():
+                    if isinstance(value, firestore.Increment):
+                        doc[key] = doc.get(key, 0) + value.value
+                    else:
+                        doc[key] = value
+
+
+def _store_burst(store, db, messages, threads=16):
+    def store_one(i):
+        batch = store.batch()
+        add_message_writes(db, batch, "7_reporter", f"message {i}", "reporter")
+        batch.commit()
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(store_one, range(messages)))
+
+
+def test_burst_keeps_every_message():
+    store = _Store()
+    _store_burst(store, _Ref(""), BURST)
+    messages = [doc for path, doc in store.docs.items() if "/daily_messages/" in path]
+    assert len(messages) == BURST
+    assert sorted(doc["text"] for doc in messages) == sorted(f"message {i}" for i in range(BURST))
+
+
+def test_burst_summary_shards_count_every_message():
+    store = _Store()
+    _store_burst(store, _Ref(""), BURST)
+    shards = [doc for path, doc in store.docs.items() if "/summary_shards/" in path]
+    assert len(shards) > 1
+    assert sum(doc["message_count"] for doc in shards) == BURST
+
+
+def test_replayed_message_is_stored_once():
+    store, db = _Store(), _Ref("")
+    for _ in range(2):
+        batch = store.batch()
+        # What store_message derives from the Telegram message's date and message_id
+        add_message_writes(db, batch, "7_reporter", "flooding", "reporter",
+                           message_id=stable_id("MSG", 1735689600, 42))
+        try:
+            batch.commit()
+        except api_exceptions.AlreadyExists:
+            pass
+    messages = [path for path in store.docs if "/daily_messages/" in path]
+    assert len(messages) == 1
+    shards = [doc for path, doc in store.docs.items() if "/summary_shards/" in path]
+    assert sum(doc["message_count"] for doc in shards) == 1
+
+
+def test_coalesced_profile_writes_count_every_message():
+    clock = [0.0]
+    cache = ProfileCache(None, write_interval=10, clock=lambda: clock[0])
+    profile = CachedProfile({"username": "reporter"})
+    written = []
+    lock = threading.Lock()
+
+    def message(i):
+        updates = cache.coalesce(7, profile, {"username": "reporter", "total_messages": 1,
+                                              "last_message": f"message {i}"})
+        if updates is not None:
+            with lock:
+                written.append(updates)
+
+    # A burst inside one write interval, then one more message after it
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        list(pool.map(message, range(BURST)))
+    clock[0] = 11.0
+    message(BURST)
+
+    assert len(written) == 2
+    assert sum(updates["total_messages"] for updates in written) == BURST + 1
+    assert written[-1]["last_message"] == f"message {BURST}"
+
+
+def test_profile_changes_are_never_deferred():
+    clock = [0.0]
+    cache = ProfileCache(None, write_interval=10, clock=lambda: clock[0])
+    profile = CachedProfile({"username": "reporter"})
+    assert cache.coalesce(7, profile, {"username": "reporter", "total_messages": 1}) is not None
+    assert cache.coalesce(7, profile, {"username": "reporter", "total_messages": 1}) is None
+    updates = cache.coalesce(7, profile, {"username": "reporter", "total_messages": 1, "geohash": "s14ms1"})
+    assert updates == {"username": "reporter", "total_messages": 2, "geohash": "s14ms1"}
+
+
+def test_uncommitted_profile_write_keeps_the_deferred_messages():
+    clock = [0.0]
+    cache = ProfileCache(None, write_interval=10, clock=lambda: clock[0])
+    profile = CachedProfile({"username": "reporter"})
+    assert cache.coalesce(7, profile, {"total_messages": 1, "last_message": "first"}) is not None
+    for i in range(5):
+        assert cache.coalesce(7, profile, {"total_messages": 1, "last_message": f"burst {i}"}) is None
+
+    clock[0] = 11.0
+    own = {"total_messages": 1, "last_message": "after"}
+    written = cache.coalesce(7, profile, own)
+    assert written["total_messages"] == 6
+    cache.restore(7, written, own)  # the batch failed
+
+    # The retried message writes at once and still counts the burst
+    assert cache.coalesce(7, profile, dict(own)) == {"total_messages": 6, "last_message": "after"}
+
+
+def test_deferred_fields_are_flushed_once_the_interval_passes():
+    clock = [0.0]
+    store = _Store()
+    profiles = _Ref("arems-profiles/users/profiles")
+    cache = ProfileCache(profiles, write_interval=10, clock=lambda: clock[0], db=store)
+    profile = CachedProfile({"username": "reporter"})
+    assert cache.coalesce(7, profile, {"total_messages": 1, "last_message": "first"}) is not None
+    for i in range(3):
+        assert cache.coalesce(7, profile, {"total_messages": 1, "last_message": f"burst {i}"}) is None
+
+    assert cache.flush_deferred() == 0
+    clock[0] = 10.0
+    assert cache.flush_deferred() == 1
+    assert store.docs["arems-profiles/users/profiles/7"] == {"total_messages": 3, "last_message": "burst 2"}
+    assert cache.flush_deferred() == 0
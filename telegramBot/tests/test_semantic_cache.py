@@ -0,0 +1,46 @@
+import json
+
+from semantic_cache import SemanticQueryIndex
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_match_returns_the_stored_answer():
+    index = SemanticQueryIndex(ttl=60, clock=_Clock())
+    index.add("how do I evacuate during a flood", "Move to higher ground.", ["flood.pdf"])
+    key, similarity, entry = index.lookup("what should I do to evacuate during a flood")
+    assert key == "how do i evacuate during a flood"
+    assert similarity >= index.threshold
+    assert entry == {"answer": "Move to higher ground.", "sources": ["flood.pdf"]}
+
+
+def test_expired_best_match_falls_through_to_the_next_candidate():
+    clock = _Clock()
+    index = SemanticQueryIndex(threshold=0.3, ttl=60, clock=clock)
+    index.add("flood evacuation routes near the river", "old answer", expires_at=clock.now + 10)
+    index.add("flood evacuation routes", "live answer")
+    clock.now += 30
+    key, _, entry = index.lookup("flood evacuation routes near the river")
+    assert entry["answer"] == "live answer"
+    # The expired question is gone for good
+    assert len(index) == 1
+
+
+def test_saved_index_keeps_only_live_answers():
+    clock = _Clock()
+    index = SemanticQueryIndex(ttl=60, clock=clock)
+    index.add("earthquake safety steps", "Drop, cover and hold on.", expires_at=clock.now + 10)
+    index.add("wildfire smoke precautions", "Stay indoors.")
+    clock.now += 30
+    saved = json.loads(index.to_json())
+    assert [entry["question"] for entry in saved["entries"]] == ["wildfire smoke precautions"]
+
+    copy = SemanticQueryIndex(ttl=60, clock=clock)
+    assert copy.load_json(index.to_json()) == 1
+    assert copy.lookup("wildfire smoke precautions")[2]["answer"] == "Stay indoors."
@@ -0,0 +1,74 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core import exceptions as api_exceptions
+
+from update_dedup import UpdateDeduplicator
+
+
+class _Markers:
+    """Marker collection shared by every instance - create() fails on an existing doc"""
+
+    def __init__(self):
+        self.docs = {}
+        self.lock = threading.Lock()
+
+    def document(self, key):
+        return _Marker(self, key)
+
+
+class _Marker:
+    def __init__(self, markers, key):
+        self.markers = markers
+        self.key = key
+
+    def create(self, data):
+        with self.markers.lock:
+            if self.key in self.markers.docs:
+                raise api_exceptions.AlreadyExists("marker exists")
+            self.markers.docs[self.key] = data
+
+    def delete(self):
+        with self.markers.lock:
+            self.markers.docs.pop(self.key, None)
+
+
+def test_concurrent_redeliveries_are_processed_once():
+    dedup = UpdateDeduplicator(_Markers())
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        claims = list(pool.map(lambda _: dedup.claim(912345678), range(64)))
+    assert claims.count(True) == 1
+    assert dedup.duplicates == 63
+
+
+def test_replays_across_instances_are_processed_once():
+    markers = _Markers()
+    instances = [UpdateDeduplicator(markers) for _ in range(3)]
+    # Every update reaches every instance, several times over
+    deliveries = [(instance, update_id) for update_id in range(500) for instance in instances for _ in range(2)]
+    processed = []
+    lock = threading.Lock()
+
+    def deliver(delivery):
+        instance, update_id = delivery
+        if instance.claim(update_id):
+            with lock:
+                processed.append(update_id)
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        list(pool.map(deliver, deliveries))
+    assert sorted(processed) == list(range(500))
+
+
+def test_released_update_is_processed_once_more():
+    markers = _Markers()
+    first, second = UpdateDeduplicator(markers), UpdateDeduplicator(markers)
+    assert first.claim(42)
+    # Processing failed - Telegram's retries may land on any instance
+    first.release(42)
+    assert [second.claim(42), first.claim(42), second.claim(42)] == [True, False, False]
+
+
+def test_updates_without_an_id_are_always_processed():
+    dedup = UpdateDeduplicator(_Markers())
+    assert dedup.claim(None) and dedup.claim(None)
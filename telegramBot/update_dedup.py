@@ -0,0 +1,136 @@
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict
+
+from google.api_core import exceptions as api_exceptions
+from google.cloud import firestore
+
+import metrics
+from ttl_cache import TTLCache
+from structured_logging import get_logger
+
+log = get_logger(__name__)
+
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", "10000"))
+# Telegram gives up redelivering long before this; pair with a TTL policy on expires_at
+UPDATE_DEDUP_TTL_SECONDS = float(os.getenv("UPDATE_DEDUP_TTL_SECONDS", "86400"))
+# Set to 0 to dedup in memory only (redeliveries to another instance are then processed again)
+UPDATE_DEDUP_FIRESTORE = os.getenv("UPDATE_DEDUP_FIRESTORE", "1") != "0"
+
+
+class UpdateDeduplicator:
+    """Claims each Telegram update_id once, so redeliveries skip all storage and network work
+
+    The in-memory set answers repeats on the same instance without an RPC;
+    the Firestore marker is created with create(), which fails with
+    AlreadyExists when another delivery got there first, so exactly one
+    instance wins. If the marker can't be written the update is processed
+    anyway - a rare double store beats dropping a report. A repeat that
+    arrives while the first delivery is still running is acknowledged and
+    skipped, so if that first delivery then fails the update is not retried.
+    """
+
+    def __init__(self, markers_ref=None, maxsize: int = UPDATE_DEDUP_SIZE,
+                 ttl: float = UPDATE_DEDUP_TTL_SECONDS):
+        self.markers_ref = markers_ref
+        self.ttl = ttl
+        self.seen = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.duplicates = 0
+        self.marker_errors = 0
+
+    def claim(self, update_id: Any) -> bool:
+        """True when this delivery should be processed, False for a repeat"""
+        if update_id is None:
+            return True
+        key = str(update_id)
+        if not self._claim_locally(key):
+            return False
+        if self.markers_ref is not None:
+            try:
+                self.markers_ref.document(key).create(self._marker(update_id))
+            except api_exceptions.AlreadyExists:
+                return self._claimed_elsewhere(key)
+            except Exception as e:
+                self._marker_failed(update_id, e)
+        return True
+
+    async def claim_async(self, update_id: Any, markers_ref) -> bool:
+        """claim() with the marker created through markers_ref on the async Firestore client"""
+        if update_id is None:
+            return True
+        key = str(update_id)
+        if not self._claim_locally(key):
+            return False
+        if markers_ref is not None:
+            try:
+                await markers_ref.document(key).create(self._marker(update_id))
+            except api_exceptions.AlreadyExists:
+                return self._claimed_elsewhere(key)
+            except Exception as e:
+                self._marker_failed(update_id, e)
+        return True
+
+    def release(self, update_id: Any) -> None:
+        """Forget a claim whose processing failed, so Telegram's retry is handled"""
+        if update_id is None:
+            return
+        key = str(update_id)
+        self.seen.delete(key)
+        if self.markers_ref is not None:
+            try:
+                self.markers_ref.document(key).delete()
+            except Exception as e:
+                log.warning("⚠️ Update marker release failed", update_id=update_id, error=str(e))
+
+    async def release_async(self, update_id: Any, markers_ref) -> None:
+        """release() on the async Firestore client"""
+        if update_id is None:
+            return
+        key = str(update_id)
+        self.seen.delete(key)
+        if markers_ref is not None:
+            try:
+                await markers_ref.document(key).delete()
+            except Exception as e:
+                log.warning("⚠️ Update marker release failed", update_id=update_id, error=str(e))
+
+    def _claim_locally(self, key: str) -> bool:
+        if self.seen.get(key) is not None:
+            self.duplicates += 1
+            metrics.incr("telegram.duplicate_updates")
+            return False
+        # Mark before the RPC so concurrent repeats on this instance stop here too
+        self.seen.set(key, True)
+        return True
+
+    def _marker(self, update_id: Any) -> Dict[str, Any]:
+        return {
+            'update_id': update_id,
+            'claimed_at': firestore.SERVER_TIMESTAMP,
+            'expires_at': datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+        }
+
+    def _claimed_elsewhere(self, key: str) -> bool:
+        # Another instance owns it; don't remember that here, its claim may yet be released
+        self.seen.delete(key)
+        self.duplicates += 1
+        metrics.incr("telegram.duplicate_updates")
+        return False
+
+    def _marker_failed(self, update_id: Any, error: Exception) -> None:
+        self.marker_errors += 1
+        log.warning("⚠️ Update marker write failed - processing anyway", update_id=update_id, error=str(error))
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.seen.stats(), "duplicates": self.duplicates, "marker_errors": self.marker_errors}
+
+
+def markers_collection(db):
+    """The marker collection on db - a sync or an async Firestore client"""
+    if not UPDATE_DEDUP_FIRESTORE or db is None:
+        return None
+    return db.collection('arems-profiles').document('telegram-updates').collection('processed')
+
+
+def build_update_deduplicator(db=None) -> UpdateDeduplicator:
+    return UpdateDeduplicator(markers_collection(db))
@@ -0,0 +1,101 @@
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import metrics
+
+# A tag handler receives (session_info, page_info, full_request) and returns the webhook response
+Handler = Callable[[Dict[str, Any], Dict[str, Any], Dict[str, Any]], Any]
+# Middleware wraps a handler for one tag: middleware(tag, handler) -> handler
+Middleware = Callable[[str, Handler], Handler]
+
+FALLBACK = "fallback"
+
+
+def fulfillment_response(text: str) -> Dict[str, Any]:
+    """Dialogflow CX webhook response carrying a single text message"""
+    return {"fulfillmentResponse": {"messages": [{"text": {"text": [text]}}]}}
+
+
+def _unknown_tag(session_info, page_info, full_request):
+    return fulfillment_response("Request processed successfully.")
+
+
+class WebhookRouter:
+    """Dict-based Dialogflow CX tag router with decorator registration and middleware
+
+    Handlers are composed with their middleware when registered, so dispatch
+    is one dict lookup. Every dispatch is timed into a per-tag histogram
+    named '<name>.tag.<tag>.seconds'; unregistered tags share the fallback's.
+    """
+
+    def __init__(self, name: str = "dialogflow"):
+        self.name = name
+        self._handlers: Dict[str, Handler] = {}
+        self._middleware: Dict[Optional[str], List[Middleware]] = {}
+        self._routes: Dict[str, Handler] = {}
+        self._fallback: Handler = _unknown_tag
+        self._fallback_route: Handler = _unknown_tag
+        self._compile()
+
+    def register(self, tag: str, *middleware: Middleware) -> Callable[[Handler], Handler]:
+        """Decorator registering a handler (and tag-specific middleware) for tag"""
+        def decorator(handler: Handler) -> Handler:
+            self.add_route(tag, handler, *middleware)
+            return handler
+        return decorator
+
+    def add_route(self, tag: str, handler: Handler, *middleware: Middleware) -> None:
+        if tag in self._handlers:
+            raise ValueError(f"Webhook tag already registered: {tag}")
+        self._handlers[tag] = handler
+        if middleware:
+            self._middleware.setdefault(tag, []).extend(middleware)
+        self._compile()
+
+    def fallback(self, handler: Handler) -> Handler:
+        """Decorator for the handler of untagged or unregistered requests"""
+        self._fallback = handler
+        self._compile()
+        return handler
+
+    def use(self, middleware: Middleware, tags: Optional[List[str]] = None) -> None:
+        """Add middleware to the given tags, or to every route (fallback included) when tags is None"""
+        for tag in tags or [None]:
+            self._middleware.setdefault(tag, []).append(middleware)
+        self._compile()
+
+    @property
+    def tags(self) -> List[str]:
+        return list(self._handlers)
+
+    def _wrap(self, tag: str, handler: Handler) -> Handler:
+        # Tag middleware runs innermost, shared middleware outside it; timing wraps everything
+        for middleware in reversed(self._middleware.get(tag, [])):
+            handler = middleware(tag, handler)
+        for middleware in reversed(self._middleware.get(None, [])):
+            handler = middleware(tag, handler)
+        return self._timed(tag, handler)
+
+    def _timed(self, tag: str, handler: Handler) -> Handler:
+        metric = f"{self.name}.tag.{tag}.seconds"
+
+        def timed_handler(session_info, page_info, full_request):
+            start = time.perf_counter()
+            try:
+                return handler(session_info, page_info, full_request)
+            finally:
+                metrics.observe(metric, time.perf_counter() - start)
+        return timed_handler
+
+    def _compile(self) -> None:
+        self._routes = {tag: self._wrap(tag, handler) for tag, handler in self._handlers.items()}
+        self._fallback_route = self._wrap(FALLBACK, self._fallback)
+
+    def dispatch(self, full_request: Dict[str, Any]) -> Any:
+        """Route a parsed Dialogflow CX request to the handler for its fulfillment tag"""
+        session_info = full_request.get("sessionInfo", {})
+        page_info = full_request.get("pageInfo", {})
+        tag = full_request.get("fulfillmentInfo", {}).get("tag", "")
+
+        route = self._routes.get(tag, self._fallback_route)
+        return route(session_info, page_info, full_request)